@@ -8,22 +8,34 @@ import logging
 import hashlib
 import json
 import re
+import sys
 import mimetypes
 import calendar
+import glob
+import threading
+from multiprocessing.pool import ThreadPool
 from contextlib import closing  # for Python2.6 compatibility
-from gzip import GzipFile
 
 import yaml
-from beefish import decrypt, encrypt_file
 import aaargh
 import grandfatherson
 from byteformat import ByteFormatter
 
-from bakthat.backends import GlacierBackend, S3Backend, RotationConfig
+from bakthat.backends import GlacierBackend, S3Backend, RotationConfig, CompressionConfig, get_backend
 from bakthat.conf import config, DEFAULT_DESTINATION, DEFAULT_LOCATION, CONFIG_FILE
 from bakthat.utils import _interval_string_to_seconds
-from bakthat.models import Backups, Inventory
+from bakthat.models import database, Backups, Inventory, Manifest, Uploads, Members, Frames
 from bakthat.sync import BakSyncer
+from bakthat.stream import DecryptReader, HashWriter, HashReader, copy_stream
+from bakthat.encryption import ChunkEncryptWriter, ChunkDecryptReader, CHUNKED_VERSION, SALT_SIZE
+from bakthat.compression import get_codec, parse_compression, DEFAULT_CODEC
+from bakthat.dedup import DedupUpload, DedupReader, collect_chunks
+from bakthat.incremental import scan, add_changed, prune
+from bakthat.index import IndexedTarFile, restore_path
+from bakthat.verify import verify_backups, DEFAULT_VERIFY_WORKERS
+from bakthat.cache import start_uploader, wait_uploaders
+from bakthat.retrieval import RetrievalScheduler, DEFAULT_MAX_JOBS, DEFAULT_RETRIEVAL_WORKERS
+from bakthat.inventory import sync_inventory
 
 __version__ = "0.4.4"
 
@@ -36,11 +48,17 @@ if not log.handlers:
 
 STORAGE_BACKEND = dict(s3=S3Backend, glacier=GlacierBackend)
 
+DEFAULT_BACKUP_WORKERS = 4
+
+# Stored filenames reserved by the backups running in this process
+_reserved_lock = threading.Lock()
+_reserved_filenames = set()
+
 
 def _get_store_backend(conf, destination=DEFAULT_DESTINATION, profile="default"):
     if not destination:
         destination = config.get("aws", "default_destination")
-    return STORAGE_BACKEND[destination](conf, profile)
+    return get_backend(STORAGE_BACKEND[destination], conf, profile)
 
 
 def _match_filename(filename, destination=DEFAULT_DESTINATION, conf=None, profile="default"):
@@ -49,15 +67,13 @@ def _match_filename(filename, destination=DEFAULT_DESTINATION, conf=None, profil
         raise Exception("Filename can't be blank")
     storage_backend = _get_store_backend(conf, destination, profile)
 
-    keys = [name for name in storage_backend.ls() if name.startswith(filename)]
-    keys.sort(reverse=True)
-    return keys
+    return sorted(storage_backend.ls(filename), reverse=True)
 
 
 def match_filename(filename, destination=DEFAULT_DESTINATION, conf=None, profile="default"):
     """Return a list of dict with backup_name, date_component, and is_enc."""
     _keys = _match_filename(filename, destination, conf, profile)
-    regex_key = re.compile(r"(?P<backup_name>.+)\.(?P<date_component>\d{14})\.tgz(?P<is_enc>\.enc)?")
+    regex_key = re.compile(r"(?P<backup_name>.+)\.(?P<date_component>\d{14})(\.\d+)?\.(tgz|tar\.zst|tar\.lz4|txz|dedup)(?P<is_enc>\.enc)?")
 
     # old regex for backward compatibility (for files without dot before the date component).
     old_regex_key = re.compile(r"(?P<backup_name>.+)(?P<date_component>\d{14})\.tgz(?P<is_enc>\.enc)?")
@@ -78,6 +94,39 @@ def match_filename(filename, destination=DEFAULT_DESTINATION, conf=None, profile
     return keys
 
 
+def _delete_backups(storage_backend, backups):
+    """Delete backups in bulk (remotely and in the catalog),
+    backups needed by live incremental backups are kept.
+
+    :type backups: list
+    :param backups: Backups to delete.
+
+    :rtype: list
+    :return: The deleted stored filenames.
+
+    """
+    backups, kept = Backups.without_dependents(backups)
+    for backup in kept:
+        log.info("Keeping {0}, needed by incremental backups".format(backup.stored_filename))
+
+    keynames = [backup.stored_filename for backup in backups]
+    if not keynames:
+        return []
+    log.info("Deleting {0} backups".format(len(keynames)))
+    for keyname in keynames:
+        log.debug("Deleting {0}".format(keyname))
+
+    deleted = set(storage_backend.delete_many(keynames))
+    deleted = [keyname for keyname in keynames if keyname in deleted]
+    Backups.set_deleted_many(deleted)
+    if storage_backend.cache:
+        storage_backend.cache.remove(storage_backend, deleted)
+    # Only the chunks of dedup backups need to be collected
+    if any(backup.metadata.get("dedup") for backup in backups if backup.stored_filename in deleted):
+        collect_chunks(storage_backend)
+    return deleted
+
+
 @app.cmd(help="Delete backups older than the given interval string.")
 @app.cmd_arg('filename', type=str, help="Filename to delete")
 @app.cmd_arg('interval', type=str, help="Interval string like 1M, 1W, 1M3W4h2s")
@@ -107,22 +156,47 @@ def delete_older_than(filename, interval, destination=DEFAULT_DESTINATION, profi
     storage_backend = _get_store_backend(conf, destination, profile)
     interval_seconds = _interval_string_to_seconds(interval)
 
-    deleted = []
-
     backup_date_filter = int(datetime.utcnow().strftime("%s")) - interval_seconds
-    for backup in Backups.search(filename, destination, older_than=backup_date_filter, profile=profile):
-        real_key = backup.stored_filename
-        log.info("Deleting {0}".format(real_key))
-
-        storage_backend.delete(real_key)
-        backup.set_deleted()
-        deleted.append(real_key)
+    backups = list(Backups.search(filename, destination, older_than=backup_date_filter, profile=profile))
+    deleted = _delete_backups(storage_backend, backups)
 
     BakSyncer(conf).sync_auto()
 
     return deleted
 
 
+def _rotation_plan(backups, rotation_conf, now=None, group=lambda backup: backup.filename):
+    """Return the backups to delete according to the grandfather-father-son
+    rotation scheme, applied separately to each group of backups (by filename by default).
+
+    :type backups: list
+    :param backups: Backups to rotate.
+
+    :type rotation_conf: dict
+    :param rotation_conf: Rotation configuration (days, weeks, months and first_week_day).
+
+    :rtype: list
+    :return: The backups to delete.
+
+    """
+    now = now or datetime.utcnow()
+    dates = {}
+    for backup in backups:
+        dates.setdefault(group(backup), set()).add(datetime.fromtimestamp(float(backup.backup_date)))
+
+    to_delete = {}
+    for key, backups_date in dates.items():
+        to_delete[key] = grandfatherson.to_delete(backups_date,
+                                                  days=int(rotation_conf["days"]),
+                                                  weeks=int(rotation_conf["weeks"]),
+                                                  months=int(rotation_conf["months"]),
+                                                  firstweekday=int(rotation_conf["first_week_day"]),
+                                                  now=now)
+
+    return [backup for backup in backups
+            if datetime.fromtimestamp(float(backup.backup_date)) in to_delete[group(backup)]]
+
+
 @app.cmd(help="Rotate backups using Grandfather-father-son backup rotation scheme.")
 @app.cmd_arg('filename', type=str)
 @app.cmd_arg('-d', '--destination', type=str, help="s3|glacier", default=DEFAULT_DESTINATION)
@@ -158,48 +232,204 @@ def rotate_backups(filename, destination=DEFAULT_DESTINATION, profile="default",
     conf = kwargs.get("conf", None)
     storage_backend = _get_store_backend(conf, destination, profile)
     rotate = RotationConfig(conf, profile)
-    if not rotate:
+    if not rotate.conf:
         raise Exception("You must run bakthat configure_backups_rotation or provide rotation configuration.")
 
-    deleted = []
+    backups = list(Backups.search(filename, destination, profile=profile))
+    # Backups.search matches filename as a substring, the rotation applies to all the matched backups
+    to_delete = _rotation_plan(backups, rotate.conf, group=lambda backup: filename)
 
-    backups = Backups.search(filename, destination, profile=profile)
-    backups_date = [datetime.fromtimestamp(float(backup.backup_date)) for backup in backups]
+    deleted = _delete_backups(storage_backend, to_delete)
+
+    BakSyncer(conf).sync_auto()
+
+    return deleted
 
-    to_delete = grandfatherson.to_delete(backups_date,
-                                         days=int(rotate.conf["days"]),
-                                         weeks=int(rotate.conf["weeks"]),
-                                         months=int(rotate.conf["months"]),
-                                         firstweekday=int(rotate.conf["first_week_day"]),
-                                         now=datetime.utcnow())
 
-    for delete_date in to_delete:
-        backup_date = int(delete_date.strftime("%s"))
-        backup = Backups.search(filename, destination, backup_date=backup_date, profile=profile).get()
-        if backup:
-            real_key = backup.stored_filename
-            log.info("Deleting {0}".format(real_key))
+@app.cmd(help="Rotate the backups of every filename of a profile using Grandfather-father-son backup rotation scheme.")
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier", default=DEFAULT_DESTINATION)
+@app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
+@app.cmd_arg('--dry-run', action="store_true", help="only show the rotation plan")
+def rotate_all(destination=DEFAULT_DESTINATION, profile="default", **kwargs):
+    """Rotate the backups of every filename of the profile, the rotation plan
+    (backups and bytes to delete for each filename) is shown, then the backups are deleted in bulk.
 
-            storage_backend.delete(real_key)
-            backup.set_deleted()
-            deleted.append(real_key)
+    :type destination: str
+    :param destination: s3|glacier
+
+    :type profile: str
+    :param profile: Profile name (default by default).
+
+    :type conf: dict
+    :keyword conf: Override/set AWS configuration.
+
+    :type dry_run: bool
+    :keyword dry_run: Only show the rotation plan.
+
+    :rtype: list
+    :return: A list containing the deleted keys (S3) or archives (Glacier),
+        the keys to delete if dry_run is set.
+
+    """
+    conf = kwargs.get("conf", None)
+    storage_backend = _get_store_backend(conf, destination, profile)
+    rotate = RotationConfig(conf, profile)
+    if not rotate.conf:
+        raise Exception("You must run bakthat configure_backups_rotation or provide rotation configuration.")
+
+    backups = list(Backups.select().where(Backups.backend == storage_backend.name,
+                                          Backups.backend_hash == storage_backend.get_backend_hash(),
+                                          Backups.is_deleted == False))
+    to_delete, kept = Backups.without_dependents(_rotation_plan(backups, rotate.conf))
+
+    bytefmt = ByteFormatter()
+    plan = {}
+    for backup in to_delete:
+        count, size = plan.get(backup.filename, (0, 0))
+        plan[backup.filename] = (count + 1, size + backup.size)
+    for filename, (count, size) in sorted(plan.items()):
+        log.info("{0}: {1} backups to delete ({2})".format(filename, count, bytefmt(size)))
+    for backup in kept:
+        log.info("Keeping {0}, needed by incremental backups".format(backup.stored_filename))
+    log.info("{0} backups of {1} filenames to delete ({2} reclaimed), {3} backups kept".format(
+             len(to_delete), len(plan), bytefmt(sum(backup.size for backup in to_delete)),
+             len(backups) - len(to_delete)))
+
+    if kwargs.get("dry_run"):
+        return [backup.stored_filename for backup in to_delete]
+
+    deleted = _delete_backups(storage_backend, to_delete)
 
     BakSyncer(conf).sync_auto()
 
     return deleted
 
 
-@app.cmd(help="Backup a file or a directory, backup the current directory if no arg is provided.")
-@app.cmd_arg('filename', type=str, default=os.getcwd(), nargs="?")
+def _prompt_password():
+    """Ask for the backup password, return None if the confirmation doesn't match."""
+    password = getpass("Password (blank to disable encryption): ")
+    if password:
+        password2 = getpass("Password confirmation: ")
+        if password != password2:
+            log.error("Password confirmation doesn't match")
+            return
+    return password
+
+
+def _reserve_stored_filename(backup_name, date_component, extension, encrypted):
+    """Return a stored filename not used by another backup or upload,
+    a sequence number is added after the date component if needed
+    (like name.20130101000000.1.tgz)."""
+    with _reserved_lock:
+        seq = 0
+        while 1:
+            components = [backup_name, date_component] + ([str(seq)] if seq else []) + [extension]
+            stored_filename = ".".join(components)
+            if encrypted:
+                stored_filename += ".enc"
+            if stored_filename not in _reserved_filenames and \
+                    not Backups.select().where(Backups.stored_filename == stored_filename).count() and \
+                    not Uploads.select().where(Uploads.stored_filename == stored_filename).count():
+                _reserved_filenames.add(stored_filename)
+                return stored_filename
+            seq += 1
+
+
+def _release_stored_filename(stored_filename):
+    """Release a name reserved by _reserve_stored_filename."""
+    with _reserved_lock:
+        _reserved_filenames.discard(stored_filename)
+
+
+def _expand_paths(filenames, manifest=None):
+    """Return the paths matching the given paths/globs and the ones listed in the manifest file.
+
+    :type filenames: list
+    :param filenames: Paths or glob patterns.
+
+    :type manifest: str
+    :param manifest: Path of a file with a path/glob per line,
+        blank lines and lines starting with # are ignored.
+
+    """
+    patterns = list(filenames)
+    if manifest:
+        with open(manifest) as f:
+            patterns.extend(line.strip() for line in f
+                            if line.strip() and not line.strip().startswith("#"))
+    paths = []
+    for pattern in patterns:
+        pattern = os.path.expanduser(pattern)
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            log.warning("No file matching {0}".format(pattern))
+        for path in matches:
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def _estimate_size(filename):
+    """Return the total size of the files under filename (symbolic links are not followed)."""
+    try:
+        return sum(st.st_size for path, name, st in scan(filename, ""))
+    except OSError:
+        return 0
+
+
+def _backup_batch(paths, destination, prompt, tags, profile, compression, workers, **kwargs):
+    """Backup each path with a pool of workers, the largest first,
+    so the compression of a backup overlaps with the upload of another."""
+    password = kwargs.pop("password", None)
+    if password is None and prompt.lower() != "no":
+        password = _prompt_password()
+        if password is None:
+            return
+    kwargs.pop("custom_filename", None)
+
+    paths = sorted(paths, key=_estimate_size, reverse=True)
+    log.info("Backing up {0} paths with {1} workers".format(len(paths), workers))
+
+    def run(path):
+        try:
+            return backup(path, destination, "no", tags, profile, compression,
+                          password=password, sync=False, **kwargs)
+        except Exception, exc:
+            log.exception("Backup of {0} failed: {1}".format(path, exc))
+
+    pool = ThreadPool(max(1, min(workers, len(paths))))
+    try:
+        results = pool.map(run, paths)
+    finally:
+        pool.close()
+        pool.join()
+
+    BakSyncer(kwargs.get("conf", None)).sync_auto()
+
+    failed = len([result for result in results if result is None])
+    if failed:
+        log.error("{0}/{1} backups failed".format(failed, len(paths)))
+    return results
+
+
+@app.cmd(help="Backup files or directories (paths or globs), backup the current directory if no arg is provided.")
+@app.cmd_arg('filename', type=str, default=os.getcwd(), nargs="*")
 @app.cmd_arg('-d', '--destination', type=str, help="s3|glacier", default=DEFAULT_DESTINATION)
 @app.cmd_arg('--prompt', type=str, help="yes|no", default="yes")
 @app.cmd_arg('-t', '--tags', type=str, help="space separated tags", default="")
 @app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
-def backup(filename=os.getcwd(), destination=None, prompt="yes", tags=[], profile="default", **kwargs):
+@app.cmd_arg('-c', '--compression', type=str, default="", help="gzip|zstd|lz4|xz, with an optional level like zstd:3")
+@app.cmd_arg('--dedup', action="store_true", help="only upload chunks not already stored (S3 only)")
+@app.cmd_arg('-i', '--incremental', action="store_true", help="only backup files changed since the last incremental backup")
+@app.cmd_arg('-m', '--manifest', type=str, default=None, help="file listing a path/glob to backup per line")
+@app.cmd_arg('-w', '--workers', type=int, default=DEFAULT_BACKUP_WORKERS, help="number of backups running concurrently (4 by default)")
+@app.cmd_arg('--no-cache', action="store_true", help="upload directly, even if a local cache is configured")
+def backup(filename=os.getcwd(), destination=None, prompt="yes", tags=[], profile="default", compression="", **kwargs):
     """Perform backup.
 
-    :type filename: str
-    :param filename: File/directory to backup.
+    :type filename: str or list
+    :param filename: File/directory to backup, a list of paths or a glob
+        to backup several files/directories concurrently.
 
     :type destination: str
     :param destination: s3|glacier
@@ -212,6 +442,13 @@ def backup(filename=os.getcwd(), destination=None, prompt="yes", tags=[], profil
     :param tags: Tags either in a str space separated,
         either directly a list of str (if calling from Python).
 
+    :type profile: str
+    :param profile: Profile name (default by default).
+
+    :type compression: str
+    :param compression: Compression codec (gzip|zstd|lz4|xz) with an optional level (like zstd:3),
+        the profile compression codec (gzip by default) if blank.
+
     :type password: str
     :keyword password: Password, empty string to disable encryption.
 
@@ -221,19 +458,57 @@ def backup(filename=os.getcwd(), destination=None, prompt="yes", tags=[], profil
     :type custom_filename: str
     :keyword custom_filename: Override the original filename (only in metadata)
 
-    :rtype: dict
-    :return: A dict containing the following keys: stored_filename, size, metadata, backend and filename.
+    :type dedup: bool
+    :keyword dedup: Store the backup as deduplicated chunks (S3 only),
+        only the chunks not already stored are uploaded.
+
+    :type incremental: bool
+    :keyword incremental: Only archive files whose size, mtime or inode changed
+        since the last incremental backup of the same filename (a full backup if there is none).
+
+    :type manifest: str
+    :keyword manifest: File listing a path/glob to backup per line.
+
+    :type workers: int
+    :keyword workers: Number of backups running concurrently when backing up several paths.
+
+    :type sync: bool
+    :keyword sync: Sync the backups metadata after the backup (True by default).
+
+    :type no_cache: bool
+    :keyword no_cache: Upload directly, even if a local cache is configured
+        (by default the backup is written in the cache and uploaded in a background thread).
+
+    :rtype: dict or list
+    :return: A dict containing the following keys: stored_filename, size, metadata, backend and filename,
+        a list of dict (None for the failed backups) when backing up several paths.
 
     """
+    manifest_path = kwargs.pop("manifest", None)
+    workers = kwargs.pop("workers", None) or DEFAULT_BACKUP_WORKERS
+    filenames = [filename] if isinstance(filename, basestring) else filename
+    if len(filenames) == 1 and not glob.has_magic(filenames[0]) and not manifest_path:
+        filename = filenames[0]
+    else:
+        paths = _expand_paths(filenames, manifest_path)
+        return _backup_batch(paths, destination, prompt, tags, profile, compression, workers, **kwargs)
+
     conf = kwargs.get("conf", None)
     storage_backend = _get_store_backend(conf, destination, profile)
-    backup_file_fmt = "{0}.{1}.tgz"
+    dedup = kwargs.get("dedup", False)
+    incremental = kwargs.get("incremental", False)
+
+    compression_conf = CompressionConfig(conf, profile).conf
+    codec_name, level = parse_compression(compression or compression_conf.get("codec", DEFAULT_CODEC))
+    if level is None and codec_name == compression_conf.get("codec", DEFAULT_CODEC):
+        level = compression_conf.get("level")
+    codec = get_codec(codec_name)
+    codec.check()
 
     log.info("Backing up " + filename)
     arcname = filename.strip('/').split('/')[-1]
     now = datetime.utcnow()
     date_component = now.strftime("%Y%m%d%H%M%S")
-    stored_filename = backup_file_fmt.format(arcname, date_component)
 
     backup_date = int(now.strftime("%s"))
     backup_data = dict(filename=kwargs.get("custom_filename", arcname),
@@ -242,82 +517,199 @@ def backup(filename=os.getcwd(), destination=None, prompt="yes", tags=[], profil
                        backend=destination,
                        is_deleted=False)
 
+    backup_data["backend_hash"] = storage_backend.get_backend_hash()
+
+    parent = None
+    previous_manifest = {}
+    if incremental:
+        parent = Backups.get_last_incremental(backup_data["filename"], backup_data["backend_hash"])
+        if parent:
+            log.info("Incremental backup since {0}".format(parent.stored_filename))
+            previous_manifest = Manifest.load(parent.stored_filename)
+
     password = kwargs.get("password")
     if password is None and prompt.lower() != "no":
-        password = getpass("Password (blank to disable encryption): ")
-        if password:
-            password2 = getpass("Password confirmation: ")
-            if password != password2:
-                log.error("Password confirmation doesn't match")
-                return
+        password = _prompt_password()
+        if password is None:
+            return
 
     # Check if the file is not already compressed
     if mimetypes.guess_type(arcname) == ('application/x-tar', 'gzip'):
         log.info("File already compressed")
-        outname = filename
 
         # removing extension to reformat filename
-        new_arcname = re.sub(r'(\.t(ar\.)?gz)', '', arcname)
-        stored_filename = backup_file_fmt.format(new_arcname, date_component)
-
-        with open(outname) as outfile:
-            backup_data["size"] = os.fstat(outfile.fileno()).st_size
+        backup_name = re.sub(r'(\.t(ar\.)?gz)', '', arcname)
 
+        codec = get_codec("gzip")
         bakthat_compression = False
     else:
-        # If not we compress it
-        log.info("Compressing...")
-        with tempfile.NamedTemporaryFile(delete=False) as out:
-            with closing(tarfile.open(fileobj=out, mode="w:gz")) as tar:
-                tar.add(filename, arcname=arcname)
-            outname = out.name
-            out.seek(0)
-            backup_data["size"] = os.fstat(out.fileno()).st_size
+        backup_name = arcname
         bakthat_compression = True
 
-    bakthat_encryption = False
-    if password:
-        bakthat_encryption = True
-        log.info("Encrypting...")
-        encrypted_out = tempfile.NamedTemporaryFile(delete=False)
-        encrypt_file(outname, encrypted_out.name, password)
-        stored_filename += ".enc"
-
-        # We only remove the file if the archive is created by bakthat
-        if bakthat_compression:
-            os.remove(outname)  # remove non-encrypted tmp file
-
-        outname = encrypted_out.name
-
-        encrypted_out.seek(0)
-        backup_data["size"] = os.fstat(encrypted_out.fileno()).st_size
-
-    # Handling tags metadata
-    if isinstance(tags, list):
-        tags = " ".join(tags)
-
-    backup_data["tags"] = tags
-
-    backup_data["metadata"] = dict(is_enc=bakthat_encryption)
-    backup_data["stored_filename"] = stored_filename
-
-    access_key = storage_backend.conf.get("access_key")
-    container_key = storage_backend.conf.get(storage_backend.container_key)
-    backup_data["backend_hash"] = hashlib.sha512(access_key + container_key).hexdigest()
-
-    log.info("Uploading...")
-    storage_backend.upload(stored_filename, outname)
-
-    # We only remove the file if the archive is created by bakthat
-    if bakthat_encryption:
-        os.remove(outname)
-
-    log.debug(backup_data)
-
-    # Insert backup metadata in SQLite
-    Backups.create(**backup_data)
-
-    BakSyncer(conf).sync_auto()
+    if dedup and not isinstance(storage_backend, S3Backend):
+        raise Exception("Deduplication is only available for S3 backups.")
+
+    bakthat_encryption = bool(password)
+    # Backups started in the same second would share the same stored filename
+    stored_filename = _reserve_stored_filename(backup_name, date_component,
+                                               "dedup" if dedup else codec.extension,
+                                               bakthat_encryption)
+    reserved_filename = stored_filename
+    try:
+        # An interrupted upload of the same source with the same options is resumed,
+        # the stream is generated again with the same gzip mtime (and KDF salt),
+        # so only the parts not uploaded yet are sent.
+        stream_metadata = dict(backup_date=backup_date)
+        if bakthat_encryption:
+            stream_metadata["salt"] = os.urandom(SALT_SIZE).encode("hex")
+
+        # With a local cache, the backup is written in the cache
+        # and uploaded in the background (resumable from the cache)
+        cache = None if dedup or kwargs.get("no_cache") else storage_backend.cache
+
+        upload_state = None
+        if cache:
+            upload_state = Uploads(metadata=stream_metadata)
+        elif not dedup:
+            resume_key = hashlib.sha1(json.dumps([os.path.abspath(filename), backup_data["filename"],
+                                                  codec.name, level, bakthat_compression, bakthat_encryption,
+                                                  parent.stored_filename if parent else None])).hexdigest()
+            storage_backend.abort_stale_uploads()
+            upload_state = storage_backend.resume_upload(resume_key)
+            if upload_state and bakthat_encryption and not upload_state.metadata.get("salt"):
+                # Encrypted by an older version, the salt is unknown
+                log.info("Restarting encrypted upload of {0}".format(upload_state.stored_filename))
+                storage_backend.abort_upload(upload_state)
+                upload_state = None
+            if upload_state:
+                log.info("Resuming upload of {0}".format(upload_state.stored_filename))
+                stored_filename = upload_state.stored_filename
+                backup_data["backup_date"] = upload_state.metadata["backup_date"]
+            else:
+                upload_state = Uploads.create(resume_key=resume_key,
+                                              backend=storage_backend.name,
+                                              backend_hash=backup_data["backend_hash"],
+                                              stored_filename=stored_filename,
+                                              part_size=storage_backend.part_size(),
+                                              created=backup_date,
+                                              metadata=stream_metadata,
+                                              parts={})
+
+        # The archive is compressed, encrypted and uploaded on the fly,
+        # without temporary files.
+        if dedup:
+            # Chunks are compressed and encrypted one by one
+            upload = DedupUpload(storage_backend, stored_filename, password, codec, level)
+        elif cache:
+            upload = cache.open_write(storage_backend, stored_filename)
+        else:
+            upload = storage_backend.open_upload(stored_filename, state=upload_state)
+        stages = [upload]
+        try:
+            out = upload
+            if not dedup:
+                # SHA-256 of the stored object, computed as it's uploaded
+                out = checksum = HashWriter(out)
+                stages.append(out)
+            if bakthat_encryption and not dedup:
+                log.info("Encrypting...")
+                # The uploaded parts of a resumed upload are encrypted with the same salt again,
+                # a part whose content changed is never uploaded again (see Uploads.can_replace_part)
+                out = ChunkEncryptWriter(out, password, salt=upload_state.metadata["salt"].decode("hex"),
+                                         pool=storage_backend.worker_pool())
+                stages.append(out)
+
+            if bakthat_compression:
+                if not dedup:
+                    log.info("Compressing ({0})...".format(codec.name))
+                    out = codec.writer(out, level,
+                                       block_size=compression_conf.get("block_size"),
+                                       workers=compression_conf.get("workers"),
+                                       detect_incompressible=compression_conf.get("detect_incompressible"),
+                                       mtime=upload_state.metadata["backup_date"])
+                    stages.append(out)
+                # gzip backups are seekable, the members and frames are indexed
+                # to allow restoring a single file without downloading the whole archive
+                seekable = not dedup and codec.name == "gzip"
+                if not dedup:
+                    # Members already compressed are marked as incompressible
+                    tar = IndexedTarFile.open(fileobj=out, mode="w|", compressor=out)
+                else:
+                    tar = tarfile.TarFile.open(fileobj=out, mode="w|")
+                with closing(tar):
+                    if incremental:
+                        incr_manifest, changed = add_changed(tar, filename, arcname, previous_manifest)
+                    else:
+                        tar.add(filename, arcname=arcname)
+            else:
+                with open(filename, "rb") as infile:
+                    copy_stream(infile, out)
+
+            log.info("Uploading...")
+            # Flush each stage, from the compression to the upload
+            for stage in reversed(stages):
+                stage.close()
+        except:
+            for stage in reversed(stages):
+                stage.abort()
+            if upload_state and not cache:
+                log.info("Upload interrupted, run the same backup again to resume it.")
+            raise
+
+        backup_data["size"] = upload.size
+
+        # Handling tags metadata
+        if isinstance(tags, list):
+            tags = " ".join(tags)
+
+        backup_data["tags"] = tags
+
+        backup_data["metadata"] = dict(is_enc=bakthat_encryption,
+                                       compression=codec.name)
+        if bakthat_encryption and not dedup:
+            backup_data["metadata"]["encryption_version"] = CHUNKED_VERSION
+        if cache:
+            backup_data["metadata"]["pending_upload"] = True
+        if bakthat_compression and seekable:
+            backup_data["metadata"]["seekable"] = True
+        if bakthat_compression and not dedup:
+            # Bytes saved by the compression, bytes stored uncompressed (incompressible) and CPU time
+            backup_data["metadata"]["compression_stats"] = out.stats
+        if dedup:
+            backup_data["metadata"]["dedup"] = True
+            backup_data["metadata"]["logical_size"] = upload.logical_size
+        else:
+            backup_data["metadata"]["checksums"] = dict(upload.checksums, sha256=checksum.hexdigest())
+        if incremental and bakthat_compression:
+            backup_data["metadata"]["incremental"] = True
+            backup_data["metadata"]["parent"] = parent.stored_filename if parent else None
+            backup_data["metadata"]["changed_files"] = changed
+        backup_data["stored_filename"] = stored_filename
+
+        log.debug(backup_data)
+
+        # Insert backup metadata in SQLite, the cached backup is registered
+        # with it, so the uploader never finds a backup missing from the catalog
+        with database.transaction():
+            Backups.create(**backup_data)
+            if cache:
+                upload.register()
+    finally:
+        # From now on, the name is taken by the catalog (or the upload state)
+        _release_stored_filename(reserved_filename)
+
+    if incremental and bakthat_compression:
+        Manifest.store(stored_filename, incr_manifest)
+    if bakthat_compression and seekable:
+        Members.store(stored_filename, tar.members_index)
+        Frames.store(stored_filename, out.frames)
+
+    if kwargs.get("sync", True):
+        BakSyncer(conf).sync_auto()
+
+    if cache:
+        log.info("Backup cached, uploading in the background...")
+        start_uploader(storage_backend, lambda uploaded: BakSyncer(conf).sync_auto())
 
     return backup_data
 
@@ -328,9 +720,8 @@ def backup(filename=os.getcwd(), destination=None, prompt="yes", tags=[], profil
 @app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
 def info(filename=os.getcwd(), destination=None, profile="default", **kwargs):
     conf = kwargs.get("conf", None)
-    storage_backend = _get_store_backend(conf, destination, profile)
     filename = filename.split("/")[-1]
-    keys = match_filename(filename, destination if destination else DEFAULT_DESTINATION, profile)
+    keys = match_filename(filename, destination if destination else DEFAULT_DESTINATION, conf, profile)
     if not keys:
         log.info("No matching backup found for " + str(filename))
         key = None
@@ -426,14 +817,18 @@ def configure_backups_rotation(profile="default"):
 
 
 @app.cmd(help="Restore backup in the current directory.")
-@app.cmd_arg('filename', type=str)
+@app.cmd_arg('filename', type=str, nargs="+")
 @app.cmd_arg('-d', '--destination', type=str, help="s3|glacier", default=DEFAULT_DESTINATION)
 @app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
+@app.cmd_arg('--path', type=str, help="only restore this file/directory (path inside the archive, S3 only)")
+@app.cmd_arg('--wait', action="store_true", help="wait for the Glacier retrieval jobs and restore the backups as soon as they are ready")
+@app.cmd_arg('--max-jobs', type=int, default=DEFAULT_MAX_JOBS, help="number of Glacier retrieval jobs in progress (10 by default)")
+@app.cmd_arg('-w', '--workers', type=int, default=DEFAULT_RETRIEVAL_WORKERS, help="number of Glacier archives downloaded concurrently (4 by default)")
 def restore(filename, destination=DEFAULT_DESTINATION, profile="default", **kwargs):
     """Restore backup in the current working directory.
 
-    :type filename: str
-    :param filename: File/directory to backup.
+    :type filename: str or list
+    :param filename: File/directory to restore, or a list of them.
 
     :type destination: str
     :param destination: s3|glacier
@@ -444,6 +839,20 @@ def restore(filename, destination=DEFAULT_DESTINATION, profile="default", **kwar
     :type conf: dict
     :keyword conf: Override/set AWS configuration.
 
+    :type path: str
+    :keyword path: Only restore this file/directory (path inside the archive, like ls_contents shows),
+        only the needed parts of the archive are downloaded (S3 only).
+
+    :type wait: bool
+    :keyword wait: Glacier only, wait for the retrieval jobs instead of returning
+        when they are initiated, the backups are downloaded and restored as soon as they are ready.
+
+    :type max_jobs: int
+    :keyword max_jobs: Number of Glacier retrieval jobs in progress (10 by default).
+
+    :type workers: int
+    :keyword workers: Number of Glacier archives downloaded concurrently (4 by default).
+
     :rtype: bool
     :return: True if successful.
     """
@@ -454,6 +863,13 @@ def restore(filename, destination=DEFAULT_DESTINATION, profile="default", **kwar
         log.error("No file to restore, use -f to specify one.")
         return
 
+    filenames = [filename] if isinstance(filename, basestring) else filename
+    if kwargs.get("wait") and isinstance(storage_backend, GlacierBackend) and not kwargs.get("job_check"):
+        return _restore_wait(storage_backend, filenames, destination, profile, **kwargs)
+    if len(filenames) > 1:
+        return all([restore(name, destination, profile, **kwargs) for name in filenames])
+    filename = filenames[0]
+
     backup = Backups.match_filename(filename, destination, profile=profile)
 
     if not backup:
@@ -463,46 +879,316 @@ def restore(filename, destination=DEFAULT_DESTINATION, profile="default", **kwar
     key_name = backup.stored_filename
     log.info("Restoring " + key_name)
 
+    chain = backup.get_chain()
+    if len(chain) > 1:
+        log.info("Incremental backup, restoring {0} backups".format(len(chain)))
+
     # Asking password before actually download to avoid waiting
-    if key_name and backup.is_encrypted():
+    password = ""
+    if key_name and any(chain_backup.is_encrypted() for chain_backup in chain):
         password = kwargs.get("password")
         if not password:
             password = getpass()
 
+    path = kwargs.get("path")
+    if path:
+        if not isinstance(storage_backend, S3Backend):
+            raise Exception("Restoring a single path is only available for S3 backups.")
+        restored = 0
+        for chain_backup in chain:
+            if not chain_backup.metadata.get("seekable"):
+                raise Exception("{0} has no member index.".format(chain_backup.stored_filename))
+            restored += restore_path(storage_backend, chain_backup, path,
+                                     password if chain_backup.is_encrypted() else "")
+        if not restored:
+            log.error("{0} not found in {1}.".format(path, key_name))
+            return
+        return True
+
+    for chain_backup in chain:
+        result = _restore_backup(storage_backend, chain_backup, password, kwargs.get("job_check"))
+        if not result or kwargs.get("job_check"):
+            return result
+
+    _prune_chain(backup, chain)
+
+    return True
+
+
+def _prune_chain(backup, chain):
+    """Remove the files deleted since the base backup of an incremental backup
+    to get a point-in-time view."""
+    if len(chain) > 1:
+        manifest = Manifest.load(backup.stored_filename)
+        removed = set()
+        for chain_backup in chain[:-1]:
+            removed.update(path for path in Manifest.load(chain_backup.stored_filename) if not path in manifest)
+        prune(removed)
+
+
+def _restore_wait(storage_backend, filenames, destination, profile, **kwargs):
+    """Restore Glacier backups (and their incremental chains) in one go.
+
+    The archives are retrieved by a RetrievalScheduler, each archive is downloaded
+    to a temporary file as soon as its job is completed (several at a time),
+    and the backups are extracted in order as soon as they are downloaded.
+
+    :rtype: bool
+    :return: True if every backup is restored.
+
+    """
+    chains = []
+    for filename in filenames:
+        backup = Backups.match_filename(filename, destination, profile=profile)
+        if not backup:
+            log.error("No file matched for {0}.".format(filename))
+            return
+        chains.append((backup, backup.get_chain()))
+
+    password = ""
+    if any(chain_backup.is_encrypted() for backup, chain in chains for chain_backup in chain):
+        password = kwargs.get("password")
+        if not password:
+            password = getpass()
+
+    # Number of chains restoring each archive, archives in the cache aren't retrieved
+    uses = {}
+    for backup, chain in chains:
+        for chain_backup in chain:
+            uses[chain_backup.stored_filename] = uses.get(chain_backup.stored_filename, 0) + 1
+    keynames = [keyname for keyname in uses
+                if not (storage_backend.cache and storage_backend.cache.contains(storage_backend, keyname))]
+    keynames.sort()
+    retrieved = set(keynames)
+    log.info("Retrieving {0} archives for {1} backups".format(len(keynames), len(chains)))
+
+    def download(keyname, reader):
+        out = tempfile.TemporaryFile()
+        try:
+            copy_stream(reader, out, reader.chunk_size)
+        except:
+            out.close()
+            raise
+        finally:
+            reader.close()
+        return out
+
+    downloaded = {}
+    failed = set()
+    progress = [0] * len(chains)
+
+    def restore_ready():
+        for i, (backup, chain) in enumerate(chains):
+            while progress[i] < len(chain):
+                keyname = chain[progress[i]].stored_filename
+                if keyname in failed:
+                    log.error("Can't restore {0}, {1} is missing.".format(backup.stored_filename, keyname))
+                    progress[i] = len(chain) + 1
+                    break
+                if keyname in retrieved and keyname not in downloaded:
+                    break
+                log.info("Restoring " + keyname)
+                out = downloaded.get(keyname)
+                if out:
+                    out.seek(0)
+                try:
+                    _restore_backup(storage_backend, chain[progress[i]], password, download=out)
+                except Exception, exc:
+                    log.exception("Restoring {0} failed: {1}".format(keyname, exc))
+                    progress[i] = len(chain) + 1
+                    break
+                finally:
+                    uses[keyname] -= 1
+                    if out and not uses[keyname]:
+                        out.close()
+                progress[i] += 1
+                if progress[i] == len(chain):
+                    _prune_chain(backup, chain)
+
+    scheduler = RetrievalScheduler(storage_backend,
+                                   kwargs.get("max_jobs") or DEFAULT_MAX_JOBS,
+                                   kwargs.get("workers") or DEFAULT_RETRIEVAL_WORKERS)
+    restore_ready()
+    for keyname, out, exc in scheduler.run(keynames, download):
+        if exc:
+            log.error("Retrieval of {0} failed: {1}".format(keyname, exc))
+            failed.add(keyname)
+        else:
+            downloaded[keyname] = out
+        restore_ready()
+
+    return all(progress[i] == len(chain) for i, (backup, chain) in enumerate(chains))
+
+
+def _restore_backup(storage_backend, backup, password, job_check=False, download=None):
+    """Download, decrypt, uncompress and extract a single backup in the current working directory.
+
+    :type download: file
+    :param download: The backup, already downloaded (it's not closed).
+
+    """
+    key_name = backup.stored_filename
+
+    if backup.metadata.get("dedup"):
+        log.info("Downloading chunks...")
+        out = DedupReader(storage_backend, key_name,
+                          password if backup.is_encrypted() else "",
+                          get_codec(backup.get_compression()))
+        tar = tarfile.open(fileobj=out, mode="r|")
+        tar.extractall()
+        tar.close()
+        out.close()
+        return True
+
     log.info("Downloading...")
 
     download_kwargs = {}
-    if kwargs.get("job_check"):
+    if job_check:
         download_kwargs["job_check"] = True
         log.info("Job Check: " + repr(download_kwargs))
 
-    out = storage_backend.download(key_name, **download_kwargs)
-    if kwargs.get("job_check"):
+    # The archive is downloaded, decrypted, uncompressed and extracted
+    # on the fly, without temporary files.
+    downloaded = download
+    if downloaded is None:
+        download = storage_backend.open_download(key_name, **download_kwargs)
+    if job_check:
         log.info("Job Check Request")
         # If it's a job_check call, we return Glacier job data
-        return out
-
-    if out and backup.is_encrypted():
-        log.info("Decrypting...")
-        decrypted_out = tempfile.TemporaryFile()
-        decrypt(out, decrypted_out, password)
-        out = decrypted_out
+        return download
+
+    if download:
+        out = download
+        checksums = backup.metadata.get("checksums", {})
+        if checksums.get("sha256"):
+            out = checksum = HashReader(out)
+        if backup.is_encrypted():
+            log.info("Decrypting...")
+            if backup.get_encryption_version() == CHUNKED_VERSION:
+                out = ChunkDecryptReader(out, password, pool=storage_backend.worker_pool())
+            else:
+                out = DecryptReader(out, password)
 
-    if out:
         log.info("Uncompressing...")
-        out.seek(0)
-        if not backup.metadata.get("KeyValue"):
-            tar = tarfile.open(fileobj=out)
-            tar.extractall()
-            tar.close()
-        else:
-            with closing(GzipFile(fileobj=out, mode="r")) as f:
-                with open(backup.stored_filename, "w") as out:
-                    out.write(f.read())
+        compression = backup.get_compression()
+        if compression:
+            out = get_codec(compression).reader(out)
+        try:
+            if not backup.metadata.get("KeyValue"):
+                tar = tarfile.open(fileobj=out, mode="r|*")
+                tar.extractall()
+                tar.close()
+            else:
+                with open(backup.stored_filename, "w") as restored:
+                    copy_stream(out, restored)
+            if checksums.get("sha256"):
+                checksum.verify(checksums["sha256"], key_name)
+        finally:
+            # Closing the readers closes the download, a given download is left open
+            # (the decryption runs in the backend worker pool, nothing else to release)
+            if downloaded is None:
+                out.close()
 
         return True
 
 
+@app.cmd(help="List the content of a backup (without downloading it).")
+@app.cmd_arg('filename', type=str)
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier", default=DEFAULT_DESTINATION)
+@app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
+def ls_contents(filename, destination=DEFAULT_DESTINATION, profile="default", **kwargs):
+    """List the members of a backup from its member index.
+
+    :type filename: str
+    :param filename: Stored filename.
+
+    :type destination: str
+    :param destination: s3|glacier
+
+    :type profile: str
+    :param profile: Profile name (default by default).
+
+    :rtype: list
+    :return: A list of dict with path and size.
+
+    """
+    backup = Backups.match_filename(filename, destination, profile=profile)
+
+    if not backup:
+        log.error("No file matched.")
+        return
+
+    if not backup.metadata.get("seekable"):
+        log.error("{0} has no member index.".format(backup.stored_filename))
+        return
+
+    bytefmt = ByteFormatter()
+    members = []
+    for member in Members.search(backup.stored_filename):
+        log.info("{0:8}\t{1}".format(bytefmt(member.size), member.path))
+        members.append(dict(path=member.path, size=member.size))
+    return members
+
+
+@app.cmd(help="Check stored backups against the catalog (size/ETag, or checksum with --deep), output a JSON report.")
+@app.cmd_arg('query', type=str, default="", nargs="?")
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier", default=DEFAULT_DESTINATION)
+@app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
+@app.cmd_arg('--deep', action="store_true", help="download the backups to check their SHA-256")
+@app.cmd_arg('-w', '--workers', type=int, default=DEFAULT_VERIFY_WORKERS, help="number of backups checked concurrently (4 by default)")
+@app.cmd_arg('-o', '--output', type=str, default="-", help="report file (- for stdout)")
+def verify(query="", destination=DEFAULT_DESTINATION, profile="default", **kwargs):
+    """Check that stored backups match the catalog.
+
+    :type query: str
+    :param query: Only check the backups whose filename/stored filename contains query.
+
+    :type destination: str
+    :param destination: s3|glacier
+
+    :type profile: str
+    :param profile: Profile name (default by default).
+
+    :type conf: dict
+    :keyword conf: Override/set AWS configuration.
+
+    :type deep: bool
+    :keyword deep: Download the backups (S3 only) to check their SHA-256,
+        only the size and the ETag are checked (HEAD request) by default.
+
+    :type workers: int
+    :keyword workers: Number of backups checked concurrently.
+
+    :type output: str
+    :keyword output: Write the JSON report to this file (- for stdout).
+
+    :rtype: list
+    :return: A list of dict with the following keys: stored_filename,
+        status (ok|missing|truncated|corrupt|unverified|pending|error), size, expected_size and message.
+
+    """
+    conf = kwargs.get("conf", None)
+    storage_backend = _get_store_backend(conf, destination, profile)
+    backups = list(Backups.search(query, destination, profile=profile))
+
+    report = verify_backups(storage_backend, backups, kwargs.get("deep", False),
+                            kwargs.get("workers") or DEFAULT_VERIFY_WORKERS)
+
+    failed = [item for item in report if item["status"] not in ["ok", "unverified", "pending"]]
+    log.info("{0} backups checked, {1} failed".format(len(report), len(failed)))
+
+    output = kwargs.get("output")
+    if output:
+        report_json = json.dumps(report, sort_keys=True, indent=4, separators=(',', ': '))
+        if output == "-":
+            sys.stdout.write(report_json + "\n")
+        else:
+            with open(output, "w") as f:
+                f.write(report_json)
+
+    return report
+
+
 @app.cmd(help="Delete a backup.")
 @app.cmd_arg('filename', type=str)
 @app.cmd_arg('-d', '--destination', type=str, help="s3|glacier", default=DEFAULT_DESTINATION)
@@ -543,18 +1229,60 @@ def delete(filename, destination=DEFAULT_DESTINATION, profile="default", **kwarg
 
     key_name = backup.stored_filename
 
+    if backup.has_dependents():
+        log.error("{0} is needed by incremental backups.".format(key_name))
+        return
+
     storage_backend = _get_store_backend(conf, destination, profile)
 
     log.info("Deleting {0}".format(key_name))
 
     storage_backend.delete(key_name)
     backup.set_deleted()
+    if storage_backend.cache:
+        storage_backend.cache.remove(storage_backend, [key_name])
+
+    if backup.metadata.get("dedup"):
+        collect_chunks(storage_backend)
 
     BakSyncer(conf).sync_auto()
 
     return True
 
 
+@app.cmd(help="Upload the backups waiting in the local cache.")
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier", default=DEFAULT_DESTINATION)
+@app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
+def drain(destination=DEFAULT_DESTINATION, profile="default", **kwargs):
+    """Upload the backups waiting in the local cache.
+
+    :type destination: str
+    :param destination: s3|glacier
+
+    :type profile: str
+    :param profile: Profile name (default by default).
+
+    :type conf: dict
+    :keyword conf: Override/set AWS configuration.
+
+    :rtype: list
+    :return: The uploaded stored filenames.
+
+    """
+    conf = kwargs.get("conf", None)
+    storage_backend = _get_store_backend(conf, destination, profile)
+    if not storage_backend.cache:
+        log.error("No cache configured for the {0} profile.".format(profile))
+        return []
+
+    uploaded = storage_backend.cache.drain(storage_backend)
+    log.info("{0} backups uploaded".format(len(uploaded)))
+    if uploaded:
+        BakSyncer(conf).sync_auto()
+
+    return uploaded
+
+
 @app.cmd(help="Trigger synchronization")
 def sync(**kwargs):
     """Trigger synchronization."""
@@ -570,54 +1298,74 @@ def reset_sync(**kwargs):
 
 
 @app.cmd(help="List stored backups.")
+@app.cmd_arg('prefix', type=str, nargs="*", help="only list the keys starting with these prefixes")
 @app.cmd_arg('-d', '--destination', type=str, help="s3|glacier")
 @app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
-def ls(destination=None, profile="default", **kwargs):
+def ls(prefix="", destination=None, profile="default", **kwargs):
+    """List stored keys, the listing is streamed page by page.
+
+    :type prefix: str or list
+    :param prefix: Only list the keys starting with this prefix
+        (or one of these prefixes, listed concurrently).
+
+    :rtype: list
+    :return: The key names.
+
+    """
     conf = kwargs.get("conf", None)
     storage_backend = _get_store_backend(conf, destination, profile)
 
     log.info(storage_backend.container)
 
-    ls_result = storage_backend.ls()
-
-    for filename in ls_result:
+    ls_result = []
+    for filename in storage_backend.ls(prefix or ""):
         log.info(filename)
+        ls_result.append(filename)
 
     return ls_result
 
 
 @app.cmd(help="Show Glacier inventory from S3")
 def show_glacier_inventory(**kwargs):
-    if config.get("aws", "s3_bucket"):
-        conf = kwargs.get("conf", None)
-        glacier_backend = GlacierBackend(conf)
-        loaded_archives = glacier_backend.load_archives_from_s3()
-        log.info(json.dumps(loaded_archives, sort_keys=True, indent=4, separators=(',', ': ')))
-    else:
+    conf = kwargs.get("conf", None)
+    glacier_backend = _get_store_backend(conf, "glacier")
+    if not glacier_backend.conf.get("s3_bucket"):
         log.error("No S3 bucket defined.")
+        return
+    loaded_archives = glacier_backend.load_archives_from_s3()
+    log.info(json.dumps(loaded_archives, sort_keys=True, indent=4, separators=(',', ': ')))
     return loaded_archives
 
 
 @app.cmd(help="Show local Glacier inventory (from shelve file)")
 def show_local_glacier_inventory(**kwargs):
     conf = kwargs.get("conf", None)
-    glacier_backend = GlacierBackend(conf)
+    glacier_backend = _get_store_backend(conf, "glacier")
     archives = glacier_backend.load_archives()
     log.info(json.dumps(archives, sort_keys=True, indent=4, separators=(',', ': ')))
     return archives
 
 
 @app.cmd(help="Backup Glacier inventory to S3")
-def backup_glacier_inventory(**kwargs):
-    """Backup Glacier inventory to S3.
+@app.cmd_arg('--snapshot', action="store_true", help="push a full snapshot instead of the changes")
+def backup_glacier_inventory(snapshot=False, **kwargs):
+    """Backup Glacier inventory changes to the S3 inventory log.
+
+    :type snapshot: bool
+    :param snapshot: Push a full snapshot of the inventory.
 
     :type conf: dict
     :keyword conf: Override/set AWS configuration.
 
+    :rtype: str
+    :return: The key of the new log segment, None if there was nothing to push.
+
     """
     conf = kwargs.get("conf", None)
-    glacier_backend = GlacierBackend(conf)
-    glacier_backend.backup_inventory()
+    glacier_backend = _get_store_backend(conf, "glacier")
+    key_name = glacier_backend.inventory_log().push(snapshot)
+    log.info("Inventory pushed to {0}".format(key_name) if key_name else "Nothing to push.")
+    return key_name
 
 
 @app.cmd(help="Restore Glacier inventory from S3")
@@ -629,8 +1377,61 @@ def restore_glacier_inventory(**kwargs):
 
     """
     conf = kwargs.get("conf", None)
-    glacier_backend = GlacierBackend(conf)
-    glacier_backend.restore_inventory()
+    glacier_backend = _get_store_backend(conf, "glacier")
+    count = glacier_backend.restore_inventory()
+    log.info("{0} archives restored in the local inventory".format(count))
+    return count
+
+
+@app.cmd(help="Sync the local Glacier inventory with the vault inventory.")
+@app.cmd_arg('-f', '--file', type=str, default=None, help="vault inventory JSON file (from a Glacier inventory job by default)")
+@app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
+def sync_glacier_inventory(profile="default", **kwargs):
+    """Reconcile the local Glacier inventory and backups with the vault inventory.
+
+    The first call initiates an inventory job (it takes around 4h to complete),
+    the inventory is synced when the command is called after the job is completed.
+
+    :type profile: str
+    :param profile: Profile name (default by default).
+
+    :type file: str
+    :keyword file: Vault inventory JSON file, instead of the output of an inventory job.
+
+    :type conf: dict
+    :keyword conf: Override/set AWS configuration.
+
+    :rtype: dict
+    :return: The sync stats (see bakthat.inventory.sync_inventory), None if the job is not completed.
+
+    """
+    conf = kwargs.get("conf", None)
+    glacier_backend = _get_store_backend(conf, "glacier", profile)
+
+    if kwargs.get("file"):
+        with open(kwargs["file"], "rb") as inventory:
+            stats = sync_inventory(glacier_backend, inventory)
+        glacier_backend.backup_inventory()
+        return stats
+
+    job = glacier_backend.inventory_job()
+    log.info("Job {action}: {status_code} ({creation_date}/{completion_date})".format(**job.__dict__))
+    if job.status_code == "Failed":
+        glacier_backend.delete_job(glacier_backend.backup_key)
+        log.error("Inventory job failed: {0}".format(job.status_message))
+        return
+    if not job.completed:
+        log.info("Not completed yet, run the command again later.")
+        return
+
+    inventory = glacier_backend.open_inventory(job)
+    try:
+        stats = sync_inventory(glacier_backend, inventory)
+    finally:
+        inventory.close()
+    glacier_backend.delete_job(glacier_backend.backup_key)
+    glacier_backend.backup_inventory()
+    return stats
 
 
 @app.cmd()
@@ -661,11 +1462,9 @@ def upgrade_from_shelve():
                     is_enc = False
                     backup_date = 0
                 if backend == "s3":
-                    backend_hash = hashlib.sha512(s3_backend.conf.get("access_key") + \
-                                        s3_backend.conf.get(s3_backend.container_key)).hexdigest()
+                    backend_hash = s3_backend.get_backend_hash()
                 elif backend == "glacier":
-                    backend_hash = hashlib.sha512(glacier_backend.conf.get("access_key") + \
-                                        glacier_backend.conf.get(glacier_backend.container_key)).hexdigest()
+                    backend_hash = glacier_backend.get_backend_hash()
                 new_backup = dict(backend=backend,
                                   is_deleted=0,
                                   backup_date=backup_date,
@@ -685,6 +1484,8 @@ def upgrade_from_shelve():
 
 def main():
     app.run()
+    # Backups written in the local cache are uploaded before exiting
+    wait_uploaders()
 
 
 if __name__ == '__main__':
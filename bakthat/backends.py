@@ -6,17 +6,61 @@ import shelve
 import json
 import socket
 import httplib
+import threading
+import hashlib
+import time
 import boto
+from boto.connection import AWSAuthConnection
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
 import math
-from boto.glacier.exceptions import UnexpectedHTTPResponseError
+from StringIO import StringIO
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from boto.glacier.exceptions import UnexpectedHTTPResponseError, TreeHashDoesNotMatchError
+from boto.glacier.vault import Vault
+from boto.glacier.utils import chunk_hashes, tree_hash, bytes_to_hex, tree_hash_from_str
 from boto.exception import S3ResponseError
 
 from bakthat.conf import config, DEFAULT_LOCATION, CONFIG_FILE
-from bakthat.models import Inventory, Jobs
+from bakthat.models import database, Inventory, InventoryChanges, Jobs, Uploads
+from bakthat.stream import copy_stream
+from bakthat.cache import BackupCache
+from bakthat.inventory import InventoryLog
+from bakthat.utils import _interval_string_to_seconds
 
 log = logging.getLogger(__name__)
 
+# Backends shared by every command of the process, see get_backend
+_backends = {}
+_backends_lock = threading.Lock()
+
+# Default part size for streaming (multipart) uploads,
+# 64MB parts allow to upload up to 640GB (10000 parts).
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+
+# S3 limits
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+# Number of parts uploaded concurrently.
+DEFAULT_CONCURRENCY = 4
+
+# Interrupted uploads older than this are aborted.
+DEFAULT_UPLOAD_EXPIRATION = "7D"
+
+# Size of the ranges downloaded concurrently.
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Number of attempts to download a range.
+DOWNLOAD_RETRIES = 3
+
+# Maximum number of keys deleted by a single S3 multi-object delete request.
+MAX_DELETE_KEYS = 1000
+
+# Maximum number of keys returned by a single S3 list request.
+LIST_PAGE_SIZE = 1000
+
 
 class glacier_shelve(object):
     """Context manager for shelve.
@@ -55,6 +99,24 @@ class BakthatBackend:
             if not "access_key" in self.conf or not "secret_key" in self.conf:
                 log.error("Missing access_key/secret_key in {0} profile ({1}).".format(profile, CONFIG_FILE))
 
+    def get_backend_hash(self):
+        """Return the hash identifying the bucket/vault of the backups in the catalog
+        (SHA-512 of the access key and the container name)."""
+        return hashlib.sha512(self.conf.get("access_key") + self.conf.get(self.container_key)).hexdigest()
+
+    def worker_pool(self):
+        """Return the thread pool sending the requests of the transfers (parts, ranges...),
+        s3_concurrency/glacier_concurrency threads (4 by default).
+
+        The pool lives as long as the backend (shared by the whole process, see get_backend),
+        so each thread keeps its connection (see thread_bucket/thread_vault) from a transfer
+        to the next, transfers running at the same time share the threads.
+        """
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPool(int(self.conf.get(self.concurrency_key, DEFAULT_CONCURRENCY)))
+            return self.pool
+
 
 class RotationConfig(BakthatBackend):
     """Hold backups rotation configuration."""
@@ -63,44 +125,127 @@ class RotationConfig(BakthatBackend):
         self.conf = self.conf.get("rotation", {})
 
 
+class CompressionConfig(BakthatBackend):
+    """Hold compression configuration (level, block_size and workers)."""
+    def __init__(self, conf={}, profile="default"):
+        BakthatBackend.__init__(self, conf, profile)
+        self.conf = self.conf.get("compression", {})
+
+
 class S3Backend(BakthatBackend):
     """Backend to handle S3 upload/download."""
+    name = "s3"
+
     def __init__(self, conf={}, profile="default"):
         BakthatBackend.__init__(self, conf, profile)
 
-        con = boto.connect_s3(self.conf["access_key"], self.conf["secret_key"])
-
+        self.container = self.conf["s3_bucket"]
+        self.container_key = "s3_bucket"
+        self.concurrency_key = "s3_concurrency"
+        self.local = threading.local()
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.validated = False
+        self.validate_lock = threading.Lock()
+        self.cache = BackupCache.from_conf(self.conf.get("cache"))
+
+    @property
+    def bucket(self):
+        """The bucket through the connection of the current thread,
+        checked (and created if needed) on first use."""
+        if not self.validated:
+            with self.validate_lock:
+                if not self.validated:
+                    self.validate_bucket()
+                    self.validated = True
+        return self.thread_bucket()
+
+    def validate_bucket(self):
+        """Check that the bucket exists, create it if needed."""
         region_name = self.conf["region_name"]
         if region_name == DEFAULT_LOCATION:
             region_name = ""
 
+        con = self.thread_bucket().connection
         try:
-            self.bucket = con.get_bucket(self.conf["s3_bucket"])
+            con.get_bucket(self.container)
         except S3ResponseError, e:
             if e.code == "NoSuchBucket":
-                self.bucket = con.create_bucket(self.conf["s3_bucket"], location=region_name)
+                con.create_bucket(self.container, location=region_name)
             else:
                 raise e
 
-        self.container = self.conf["s3_bucket"]
-        self.container_key = "s3_bucket"
+    def thread_bucket(self):
+        """Return the bucket through a connection dedicated to the current thread,
+        boto connections can't be shared between threads, they are kept alive
+        and reused by the following requests of the thread."""
+        if not hasattr(self.local, "bucket"):
+            con = boto.connect_s3(self.conf["access_key"], self.conf["secret_key"])
+            self.local.bucket = con.get_bucket(self.container, validate=False)
+        return self.local.bucket
 
     def download(self, keyname):
-        k = Key(self.bucket)
-        k.key = keyname
-
         encrypted_out = tempfile.TemporaryFile()
-        k.get_contents_to_file(encrypted_out)
+        download = self.open_download(keyname)
+        copy_stream(download, encrypted_out, download.chunk_size)
+        download.close()
         encrypted_out.seek(0)
 
         return encrypted_out
 
+    def open_download(self, keyname, start=0, end=None, use_cache=True):
+        """Return a file-like object reading keyname.
+
+        The key is downloaded by ranges of s3_download_chunk_size (16MB by default),
+        s3_concurrency ranges (4 by default) are downloaded in parallel,
+        it's read from the local cache if it's cached (unless use_cache is False).
+
+        :type keyname: str
+        :param keyname: Key name
+
+        :type start: int
+        :param start: Offset of the first byte to read.
+
+        :type end: int
+        :param end: Offset following the last byte to read, the key size if None.
+
+        :type use_cache: bool
+        :param use_cache: False to always read the stored object.
+
+        :rtype: S3DownloadReader
+        :return: A reader, call close to stop the downloads in progress.
+
+        """
+        if self.cache and use_cache:
+            cached = self.cache.open_read(self, keyname, start, end)
+            if cached:
+                return cached
+        return S3DownloadReader(self, keyname,
+                                int(self.conf.get("s3_download_chunk_size", DEFAULT_DOWNLOAD_CHUNK_SIZE)),
+                                int(self.conf.get("s3_concurrency", DEFAULT_CONCURRENCY)),
+                                start, end)
+
     def cb(self, complete, total):
         """Upload callback to log upload percentage."""
         percent = int(complete * 100.0 / total)
         log.info("Upload completion: {0}%".format(percent))
 
     def upload(self, keyname, filename, cb=True):
+        """Upload filename as keyname, files bigger than a part
+        are sent as a parallel multipart upload."""
+        size = os.path.getsize(filename)
+        part_size = max(self.part_size(), int(math.ceil(size / float(MAX_PARTS))))
+        if size > part_size:
+            upload = self.open_upload(keyname, part_size=part_size, total=size, cb=self.cb if cb else None)
+            try:
+                with open(filename, "rb") as infile:
+                    copy_stream(infile, upload)
+                upload.close()
+            except:
+                upload.abort()
+                raise
+            return
+
         k = Key(self.bucket)
         k.key = keyname
         upload_kwargs = {}
@@ -109,83 +254,369 @@ class S3Backend(BakthatBackend):
         k.set_contents_from_filename(filename, **upload_kwargs)
         k.set_acl("private")
 
-    def ls(self):
-        return [key.name for key in self.bucket.get_all_keys()]
+    def part_size(self):
+        """Return the multipart upload part size (s3_part_size, 64MB by default)."""
+        return max(int(self.conf.get("s3_part_size", DEFAULT_PART_SIZE)), MIN_PART_SIZE)
+
+    def upload_string(self, keyname, data):
+        """Upload a string as keyname.
+
+        :type keyname: str
+        :param keyname: Key name
+
+        :type data: str
+        :param data: Content
+
+        """
+        k = Key(self.bucket)
+        k.key = keyname
+        k.set_contents_from_string(data, policy="private")
+
+    def download_string(self, keyname):
+        """Return the content of keyname as a string."""
+        k = Key(self.bucket)
+        k.key = keyname
+        return k.get_contents_as_string()
+
+    def open_upload(self, keyname, part_size=None, total=None, cb=None, state=None):
+        """Return a file-like object uploading everything written to it as keyname.
+
+        Parts are uploaded by s3_concurrency threads (4 by default).
+
+        :type keyname: str
+        :param keyname: Key name
+
+        :type part_size: int
+        :param part_size: Part size, s3_part_size if None.
+
+        :type total: int
+        :param total: Total size if known, passed to cb.
+
+        :type cb: callable
+        :param cb: Called with (uploaded bytes, total) after each part.
+
+        :type state: Uploads
+        :param state: Persisted upload state, to resume an interrupted upload
+            (the upload is kept on abort).
+
+        :rtype: S3UploadWriter
+        :return: A writer, call close to complete the upload or abort to cancel it.
+
+        """
+        if state:
+            part_size = state.part_size
+        return S3UploadWriter(self, keyname,
+                              part_size or self.part_size(),
+                              int(self.conf.get("s3_concurrency", DEFAULT_CONCURRENCY)),
+                              total, cb, state)
+
+    def resume_upload(self, resume_key):
+        """Return the state of an interrupted upload, None if there is none
+        or if the multipart upload doesn't exist anymore.
+
+        :type resume_key: str
+        :param resume_key: Hash identifying the source and the backup options.
+
+        :rtype: Uploads
+        :return: The upload state.
+
+        """
+        state = Uploads.get_upload(resume_key, self.name, self.get_backend_hash())
+        if state and state.upload_id:
+            mp = MultiPartUpload(self.bucket)
+            mp.key_name = state.stored_filename
+            mp.id = state.upload_id
+            try:
+                mp.get_all_parts(max_parts=1)
+            except S3ResponseError, exc:
+                log.info("Can't resume upload of {0}: {1}".format(state.stored_filename, exc.error_code))
+                state.delete_instance()
+                return
+        return state
+
+    def abort_stale_uploads(self):
+        """Abort the interrupted uploads older than upload_expiration (7D by default)."""
+        expiration = _interval_string_to_seconds(self.conf.get("upload_expiration", DEFAULT_UPLOAD_EXPIRATION))
+        for state in Uploads.stale(self.name, self.get_backend_hash(), int(time.time()) - expiration):
+            log.info("Aborting stale upload of {0}".format(state.stored_filename))
+            self.abort_upload(state)
+
+    def abort_upload(self, state):
+        """Abort an interrupted upload and forget its state.
+
+        :type state: Uploads
+        :param state: The upload state.
+
+        """
+        if state.upload_id:
+            try:
+                self.bucket.cancel_multipart_upload(state.stored_filename, state.upload_id)
+            except S3ResponseError, exc:
+                log.debug(exc)
+        state.delete_instance()
+
+    def ls(self, prefix=""):
+        """Yield the names of the keys starting with prefix, through every page
+        of the listing (LIST_PAGE_SIZE keys per request, filtered by S3).
+
+        With several prefixes, the next page of each prefix is requested
+        concurrently (s3_concurrency requests at a time, 4 by default),
+        so names are not sorted across prefixes.
+
+        :type prefix: str or list
+        :param prefix: Key prefix, or a list of prefixes.
+
+        :rtype: generator
+        :return: The key names.
+
+        """
+        if isinstance(prefix, basestring):
+            prefixes = [prefix]
+        else:
+            # A prefix starting with another one would list keys twice
+            prefixes = []
+            for name in sorted(set(prefix)):
+                if not prefixes or not name.startswith(prefixes[-1]):
+                    prefixes.append(name)
+
+        listings = [(name, "") for name in prefixes]
+        while listings:
+            if len(listings) > 1:
+                pages = self.worker_pool().map(self._list_page, listings)
+            else:
+                pages = [self._list_page(listings[0])]
+            next_listings = []
+            for (name, marker), page in zip(listings, pages):
+                for key in page:
+                    yield key.name
+                if page.is_truncated and len(page):
+                    next_listings.append((name, page[-1].name))
+            listings = next_listings
+
+    def _list_page(self, listing):
+        prefix, marker = listing
+        return self.thread_bucket().get_all_keys(prefix=prefix, marker=marker, max_keys=LIST_PAGE_SIZE)
 
     def delete(self, keyname):
         k = Key(self.bucket)
         k.key = keyname
         self.bucket.delete_key(k)
 
+    def delete_many(self, keynames):
+        """Delete keys with multi-object delete requests (1000 keys per request).
+
+        :type keynames: list
+        :param keynames: Keys to delete.
+
+        :rtype: list
+        :return: The deleted keys (keys that failed to delete are logged and omitted).
+
+        """
+        deleted = []
+        for i in range(0, len(keynames), MAX_DELETE_KEYS):
+            batch = keynames[i:i + MAX_DELETE_KEYS]
+            result = self.bucket.delete_keys(batch, quiet=True)
+            errors = set()
+            for error in result.errors:
+                log.error("Failed to delete {0}: {1}".format(error.key, error.message))
+                errors.add(error.key)
+            deleted.extend(keyname for keyname in batch if keyname not in errors)
+        return deleted
+
 
 class GlacierBackend(BakthatBackend):
     """Backend to handle Glacier upload/download."""
+    name = "glacier"
+
     def __init__(self, conf={}, profile="default"):
         BakthatBackend.__init__(self, conf, profile)
 
-        con = boto.connect_glacier(aws_access_key_id=self.conf["access_key"], aws_secret_access_key=self.conf["secret_key"], region_name=self.conf["region_name"])
-
-        self.vault = con.create_vault(self.conf["glacier_vault"])
         self.backup_key = "bakthat_glacier_inventory"
         self.container = self.conf["glacier_vault"]
         self.container_key = "glacier_vault"
+        self.concurrency_key = "glacier_concurrency"
+        self.local = threading.local()
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.validated = False
+        self.validate_lock = threading.Lock()
+        self.cache = BackupCache.from_conf(self.conf.get("cache"))
+
+    @property
+    def vault(self):
+        """The vault through the connection of the current thread,
+        created if needed on first use."""
+        if not self.validated:
+            with self.validate_lock:
+                if not self.validated:
+                    # Creating an existing vault does nothing
+                    self.thread_vault().layer1.create_vault(self.container)
+                    self.validated = True
+        return self.thread_vault()
 
     def load_archives(self):
-        return []
+        """Return the local inventory as a list of dict with filename and archive_id."""
+        return [dict(filename=ivt.filename, archive_id=ivt.archive_id) for ivt in Inventory.select()]
+
+    def inventory_log(self):
+        """Return the S3 inventory log (under the backup_key/ prefix of the S3 bucket)."""
+        if not self.conf.get("s3_bucket"):
+            raise Exception("You must set s3_bucket in order to backup/restore inventory to/from S3.")
+        return InventoryLog(get_backend(S3Backend, self.conf).bucket, self.backup_key)
 
     def backup_inventory(self):
-        """Backup the local inventory from shelve as a json string to S3."""
-        if config.get("aws", "s3_bucket"):
-            archives = self.load_archives()
+        """Push the local inventory changes to the S3 inventory log
+        (as a delta segment, or a full snapshot, see InventoryLog.push),
+        does nothing if s3_bucket isn't set.
 
-            s3_bucket = S3Backend(self.conf).bucket
-            k = Key(s3_bucket)
-            k.key = self.backup_key
+        :rtype: str
+        :return: The key of the new segment, None if there was nothing to push.
 
-            k.set_contents_from_string(json.dumps(archives))
+        """
+        if self.conf.get("s3_bucket"):
+            return self.inventory_log().push()
 
-            k.set_acl("private")
+    def _backup_inventory(self):
+        """Backup the inventory after a change, a failed push is only logged
+        (the changes are pushed with the next ones)."""
+        try:
+            self.backup_inventory()
+        except Exception, exc:
+            log.error("Failed to backup the Glacier inventory to S3: {0}".format(exc))
 
     def load_archives_from_s3(self):
-        """Fetch latest inventory backup from S3."""
-        s3_bucket = S3Backend(self.conf).bucket
+        """Fetch latest inventory backup from S3 (the inventory log,
+        or the single JSON key written by older versions).
+
+        :rtype: list
+        :return: A list of dict with filename and archive_id.
+
+        """
+        inventory_log = self.inventory_log()
+        archives = inventory_log.load()
+        if archives is not None:
+            return archives
         try:
-            k = Key(s3_bucket)
+            k = Key(inventory_log.bucket)
             k.key = self.backup_key
 
             return json.loads(k.get_contents_as_string())
         except S3ResponseError, exc:
             log.error(exc)
-            return {}
+            return []
+
+    def restore_inventory(self):
+        """Restore the local inventory from S3 (the latest snapshot
+        of the inventory log and the deltas after it).
 
-#    def restore_inventory(self):
-#        """Restore inventory from S3 to DumpTruck."""
-#        if config.get("aws", "s3_bucket"):
-#            loaded_archives = self.load_archives_from_s3()
+        :rtype: int
+        :return: The number of archives in the inventory.
 
-#            # TODO faire le restore
-#        else:
-#            raise Exception("You must set s3_bucket in order to backup/restore inventory to/from S3.")
+        """
+        inventory_log = self.inventory_log()
+        count = inventory_log.restore()
+        if count is None:
+            # Inventory backup from older versions
+            archives = self.load_archives_from_s3()
+            count = inventory_log.replace((a["filename"], a["archive_id"]) for a in archives)
+        return count
 
-    def restore_inventory(self):
-        """Restore inventory from S3 to local shelve."""
-        if config.get("aws", "s3_bucket"):
-            loaded_archives = self.load_archives_from_s3()
+    def upload(self, keyname, filename):
+        """Upload filename as a new archive, through a parallel multipart upload
+        (the file is read once, tree hashes are computed as parts are sent).
 
-            with glacier_shelve() as d:
-                archives = {}
-                for a in loaded_archives:
-                    print a
-                    archives[a["filename"]] = a["archive_id"]
-                d["archives"] = archives
+        An interrupted upload of the same (unchanged) file is resumed.
+        """
+        stat = os.stat(filename)
+        resume_key = hashlib.sha1(json.dumps([keyname, os.path.abspath(filename),
+                                              stat.st_size, stat.st_mtime])).hexdigest()
+        state = self.resume_upload(resume_key)
+        if state is None:
+            state = Uploads.create(resume_key=resume_key,
+                                   backend=self.name,
+                                   backend_hash=self.get_backend_hash(),
+                                   stored_filename=keyname,
+                                   part_size=self.part_size(),
+                                   created=int(time.time()),
+                                   metadata={},
+                                   parts={})
+        upload = self.open_upload(keyname, state=state)
+        try:
+            with open(filename, "rb") as infile:
+                copy_stream(infile, upload)
+            upload.close()
+        except:
+            upload.abort()
+            raise
+
+    def open_upload(self, keyname, state=None):
+        """Return a file-like object uploading everything written to it as a new archive.
+
+        Parts are uploaded by glacier_concurrency threads (4 by default).
+
+        :type keyname: str
+        :param keyname: Stored filename, used as archive description.
+
+        :type state: Uploads
+        :param state: Persisted upload state, to resume an interrupted upload
+            (the upload is kept on abort).
+
+        :rtype: GlacierUploadWriter
+        :return: A writer, call close to complete the upload or abort to cancel it.
+
+        """
+        if state:
+            part_size = state.part_size
         else:
-            raise Exception("You must set s3_bucket in order to backup/restore inventory to/from S3.")
+            part_size = int(self.conf.get("glacier_part_size", DEFAULT_PART_SIZE))
+        return GlacierUploadWriter(self, keyname, part_size, state,
+                                   int(self.conf.get("glacier_concurrency", DEFAULT_CONCURRENCY)))
 
-    def upload(self, keyname, filename):
-        archive_id = self.vault.concurrent_create_archive_from_file(filename, keyname)
-        Inventory.create(filename=keyname, archive_id=archive_id)
+    def part_size(self):
+        """Return the multipart upload part size (glacier_part_size, 64MB by default)."""
+        return int(self.conf.get("glacier_part_size", DEFAULT_PART_SIZE))
 
-        #self.backup_inventory()
+    def resume_upload(self, resume_key):
+        """Return the state of an interrupted upload, None if there is none
+        or if the multipart upload doesn't exist anymore.
+
+        :type resume_key: str
+        :param resume_key: Hash identifying the source and the backup options.
+
+        :rtype: Uploads
+        :return: The upload state.
+
+        """
+        state = Uploads.get_upload(resume_key, self.name, self.get_backend_hash())
+        if state and state.upload_id:
+            try:
+                self.vault.layer1.list_parts(self.vault.name, state.upload_id, limit=1)
+            except UnexpectedHTTPResponseError, exc:
+                log.info("Can't resume upload of {0}: {1}".format(state.stored_filename, exc))
+                state.delete_instance()
+                return
+        return state
+
+    def abort_stale_uploads(self):
+        """Abort the interrupted uploads older than upload_expiration (7D by default)."""
+        expiration = _interval_string_to_seconds(self.conf.get("upload_expiration", DEFAULT_UPLOAD_EXPIRATION))
+        for state in Uploads.stale(self.name, self.get_backend_hash(), int(time.time()) - expiration):
+            log.info("Aborting stale upload of {0}".format(state.stored_filename))
+            self.abort_upload(state)
+
+    def abort_upload(self, state):
+        """Abort an interrupted upload and forget its state.
+
+        :type state: Uploads
+        :param state: The upload state.
+
+        """
+        if state.upload_id:
+            try:
+                self.vault.layer1.abort_multipart_upload(self.vault.name, state.upload_id)
+            except UnexpectedHTTPResponseError, exc:
+                log.debug(exc)
+        state.delete_instance()
 
     def get_job_id(self, filename):
         """Get the job_id corresponding to the filename.
@@ -208,9 +639,63 @@ class GlacierBackend(BakthatBackend):
 
     def download(self, keyname, job_check=False):
         """Initiate a Job, check its status, and download the archive if it's completed."""
+        download = self.open_download(keyname, job_check)
+        if not isinstance(download, GlacierDownloadReader):
+            return download
+
+        encrypted_out = tempfile.TemporaryFile()
+        copy_stream(download, encrypted_out, download.chunk_size)
+        download.close()
+        encrypted_out.seek(0)
+        return encrypted_out
+
+    def open_download(self, keyname, job_check=False):
+        """Initiate a Job, check its status, and return a file-like object
+        reading the archive if it's completed (or if it's in the local cache).
+
+        :type keyname: str
+        :param keyname: Stored filename.
+
+        :type job_check: bool
+        :param job_check: Return the job if it's not completed.
+
+        :rtype: GlacierDownloadReader
+        :return: A reader, None (or the job if job_check) if the job is not completed.
+
+        """
+        if self.cache and not job_check:
+            cached = self.cache.open_read(self, keyname)
+            if cached:
+                return cached
+
+        job = self.retrieval_job(keyname)
+        if not job:
+            return
+
+        log.info("Job {action}: {status_code} ({creation_date}/{completion_date})".format(**job.__dict__))
+
+        if job.completed:
+            return self.job_reader(job, keyname)
+        else:
+            log.info("Not completed yet")
+            if job_check:
+                return job
+            return
+
+    def retrieval_job(self, keyname):
+        """Return the retrieval job of an archive (tracked in the Jobs table),
+        a new job is initiated if there is none or if it expired.
+
+        :type keyname: str
+        :param keyname: Stored filename.
+
+        :rtype: boto.glacier.job.Job
+        :return: The job, None if the archive is not in the inventory.
+
+        """
         archive_id = Inventory.get_archive_id(keyname)
         if not archive_id:
-            log.error("{0} not found !")
+            log.error("{0} not found !".format(keyname))
             # check if the file exist on S3 ?
             return
 
@@ -230,24 +715,15 @@ class GlacierBackend(BakthatBackend):
             job_id = job.id
             Jobs.update_job_id(keyname, job_id)
 
-        log.info("Job {action}: {status_code} ({creation_date}/{completion_date})".format(**job.__dict__))
-
-        if job.completed:
-            log.info("Downloading...")
-            encrypted_out = tempfile.TemporaryFile()
-
-            # Boto related, download the file in chunk
-            chunk_size = 4 * 1024 * 1024
-            num_chunks = int(math.ceil(job.archive_size / float(chunk_size)))
-            job._download_to_fileob(encrypted_out, num_chunks, chunk_size, True, (socket.error, httplib.IncompleteRead))
+        return job
 
-            encrypted_out.seek(0)
-            return encrypted_out
-        else:
-            log.info("Not completed yet")
-            if job_check:
-                return job
-            return
+    def job_reader(self, job, keyname):
+        """Return a file-like object reading the output of a completed job,
+        by ranges of glacier_download_chunk_size (16MB by default),
+        glacier_concurrency ranges (4 by default) are downloaded in parallel."""
+        return GlacierDownloadReader(self, job, keyname,
+                                     int(self.conf.get("glacier_download_chunk_size", DEFAULT_DOWNLOAD_CHUNK_SIZE)),
+                                     int(self.conf.get("glacier_concurrency", DEFAULT_CONCURRENCY)))
 
     def retrieve_inventory(self, jobid):
         """Initiate a job to retrieve Galcier inventory or output inventory."""
@@ -256,6 +732,42 @@ class GlacierBackend(BakthatBackend):
         else:
             return self.vault.get_job(jobid)
 
+    def inventory_job(self):
+        """Return the vault inventory job (tracked in the Jobs table),
+        a new job is initiated if there is none or if it expired.
+
+        :rtype: boto.glacier.job.Job
+        :return: The job.
+
+        """
+        job = None
+        job_id = Jobs.get_job_id(self.backup_key)
+        if job_id:
+            try:
+                job = self.vault.get_job(job_id)
+            except UnexpectedHTTPResponseError:  # Return a 404 if the job is no more available
+                self.delete_job(self.backup_key)
+
+        if not job:
+            job = self.vault.get_job(self.retrieve_inventory(None))
+            Jobs.update_job_id(self.backup_key, job.id)
+
+        return job
+
+    def open_inventory(self, job):
+        """Return a file-like object streaming the output of a completed inventory job.
+
+        The HTTP response is returned as is, boto would load
+        the whole JSON document in memory.
+        """
+        layer1 = self.thread_vault().layer1
+        response = AWSAuthConnection.make_request(layer1, "GET", "/{0}/vaults/{1}/jobs/{2}/output".format(
+                                                  layer1.account_id, self.container, job.id),
+                                                  headers={"x-amz-glacier-version": layer1.Version})
+        if response.status != 200:
+            raise UnexpectedHTTPResponseError((200,), response)
+        return response
+
     def retrieve_archive(self, archive_id, jobid):
         """Initiate a job to retrieve Galcier archive or download archive."""
         if jobid is None:
@@ -263,17 +775,69 @@ class GlacierBackend(BakthatBackend):
         else:
             return self.vault.get_job(jobid)
 
-    def ls(self):
-        return [ivt.filename for ivt in Inventory.select()]
+    def ls(self, prefix=""):
+        """Yield the archived filenames starting with prefix (or one of the prefixes)."""
+        prefixes = (prefix,) if isinstance(prefix, basestring) else tuple(prefix)
+        for ivt in Inventory.select():
+            if ivt.filename.startswith(prefixes):
+                yield ivt.filename
 
     def delete(self, keyname):
         archive_id = Inventory.get_archive_id(keyname)
         if archive_id:
             self.vault.delete_archive(archive_id)
             archive_data = Inventory.get(Inventory.filename == keyname)
-            archive_data.delete_instance()
+            with database.transaction():
+                archive_data.delete_instance()
+                InventoryChanges.record([(keyname, archive_id)], is_deleted=True)
+
+            self._backup_inventory()
+
+    def thread_vault(self):
+        """Return the vault through a connection dedicated to the current thread
+        (without a describe request)."""
+        if not hasattr(self.local, "vault"):
+            con = boto.connect_glacier(aws_access_key_id=self.conf["access_key"],
+                                       aws_secret_access_key=self.conf["secret_key"],
+                                       region_name=self.conf["region_name"])
+            self.local.vault = Vault(con.layer1)
+            self.local.vault.name = self.container
+        return self.local.vault
+
+    def delete_many(self, keynames):
+        """Delete archives, glacier_concurrency archives (4 by default) are deleted concurrently.
+
+        :type keynames: list
+        :param keynames: Stored filenames of the archives to delete.
 
-            #self.backup_inventory()
+        :rtype: list
+        :return: The deleted stored filenames (archives that failed to delete are logged and omitted,
+            stored filenames without archive are considered deleted).
+
+        """
+        archives = {}
+        for i in range(0, len(keynames), 500):
+            query = Inventory.select().where(Inventory.filename << keynames[i:i + 500])
+            archives.update((archive.filename, archive.archive_id) for archive in query)
+
+        def delete_archive(keyname):
+            try:
+                self.thread_vault().delete_archive(archives[keyname])
+                return keyname
+            except Exception, exc:
+                log.error("Failed to delete {0}: {1}".format(keyname, exc))
+
+        results = self.worker_pool().map(delete_archive, [keyname for keyname in keynames if keyname in archives])
+
+        deleted_archives = [keyname for keyname in results if keyname]
+        with database.transaction():
+            for i in range(0, len(deleted_archives), 500):
+                Inventory.delete().where(Inventory.filename << deleted_archives[i:i + 500]).execute()
+            InventoryChanges.record([(keyname, archives[keyname]) for keyname in deleted_archives], is_deleted=True)
+        if deleted_archives:
+            self._backup_inventory()
+
+        return deleted_archives + [keyname for keyname in keynames if keyname not in archives]
 
     def upgrade_from_shelve(self):
         try:
@@ -283,7 +847,549 @@ class GlacierBackend(BakthatBackend):
                     for key, archive_id in archives.items():
                         #print {"filename": key, "archive_id": archive_id}
                         Inventory.create(**{"filename": key, "archive_id": archive_id})
+                        InventoryChanges.record([(key, archive_id)])
                         del archives[key]
                 d["archives"] = archives
         except Exception, exc:
             log.exception(exc)
+
+
+def get_backend(backend_class, conf=None, profile="default"):
+    """Return the backend for the given configuration, shared by the whole process.
+
+    A backend is created once for each (backend, profile, configuration),
+    so the connections (kept alive, one per thread) and the bucket/vault check
+    are reused by the following commands.
+
+    :type backend_class: class
+    :param backend_class: S3Backend or GlacierBackend
+
+    :type conf: dict
+    :param conf: Custom configuration, the profile configuration if None.
+
+    :type profile: str
+    :param profile: Profile name
+
+    :rtype: S3Backend or GlacierBackend
+    :return: The backend.
+
+    """
+    key = (backend_class.name, profile, json.dumps(conf or config.get(profile), sort_keys=True, default=str))
+    with _backends_lock:
+        if key not in _backends:
+            _backends[key] = backend_class(conf, profile)
+        return _backends[key]
+
+
+class S3UploadWriter(object):
+    """File-like object uploading everything written to it to S3.
+
+    Data is buffered in memory and sent as a multipart upload part
+    as soon as part_size bytes are available, parts are uploaded
+    in parallel by the backend worker pool (each thread with its own connection),
+    objects smaller than a single part are uploaded with a single request.
+
+    At most concurrency parts are in flight, so memory usage stays
+    around (concurrency + 1) * part_size.
+
+    With a state, uploaded parts are recorded as they complete, parts whose
+    MD5 matches an already uploaded part are skipped, and the multipart
+    upload is kept on abort so the backup can be resumed (an encrypted
+    stream whose uploaded part changed is aborted, see Uploads.can_replace_part).
+
+    :type backend: S3Backend
+    :param backend: Backend holding the bucket.
+
+    :type keyname: str
+    :param keyname: Key name
+
+    :type part_size: int
+    :param part_size: Multipart upload part size (5MB minimum).
+
+    :type concurrency: int
+    :param concurrency: Number of parts uploaded concurrently.
+
+    :type total: int
+    :param total: Total size if known, passed to cb.
+
+    :type cb: callable
+    :param cb: Called with (uploaded bytes, total) after each part.
+
+    :type state: Uploads
+    :param state: Persisted upload state.
+
+    """
+    def __init__(self, backend, keyname, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY,
+                 total=None, cb=None, state=None):
+        self.backend = backend
+        self.keyname = keyname
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.total = total
+        self.cb = cb
+        self.state = state
+        self.buffer = []
+        self.buffered = 0
+        self.size = 0
+        self.uploaded = 0
+        self.mp = None
+        self.part_num = 0
+        self.offset = 0
+        self.etags = []
+        self.pool = backend.worker_pool()
+        self.pending = deque()
+        self.checksums = {}
+        self.aborted = False
+
+        if state and state.upload_id:
+            log.info("Resuming upload {0} ({1} parts uploaded)".format(state.upload_id, len(state.parts)))
+            self.mp = MultiPartUpload(backend.bucket)
+            self.mp.key_name = keyname
+            self.mp.id = state.upload_id
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.size += len(data)
+        if self.buffered >= self.part_size:
+            data = "".join(self.buffer)
+            offset = 0
+            while len(data) - offset >= self.part_size:
+                self._upload_part(data[offset:offset + self.part_size])
+                offset += self.part_size
+            self.buffer = [data[offset:]]
+            self.buffered = len(data) - offset
+
+    def _send_part(self, part_num, data, md5):
+        if self.aborted:
+            return 0
+        mp = MultiPartUpload(self.backend.thread_bucket())
+        mp.key_name = self.keyname
+        mp.id = self.mp.id
+        mp.upload_part_from_file(StringIO(data), part_num, md5=md5)
+        return len(data)
+
+    def _upload_part(self, data):
+        if self.mp is None:
+            self.mp = self.backend.bucket.initiate_multipart_upload(self.keyname)
+            if self.state:
+                self.state.upload_id = self.mp.id
+                self.state.save()
+        self.part_num += 1
+        offset = self.offset
+        self.offset += len(data)
+        digest = hashlib.md5(data)
+        etag = digest.hexdigest()
+        self.etags.append(etag)
+
+        if self.state and self.state.get_part(self.part_num) == [offset, len(data), etag]:
+            log.info("Part {0} already uploaded".format(self.part_num))
+            self.uploaded += len(data)
+            return
+
+        if self.state and not self.state.can_replace_part(self.part_num):
+            # The source changed, the upload must be started again with a new salt
+            self.state.delete_instance()
+            self.state = None
+            raise Exception("The source changed since the interrupted upload of {0}, "
+                            "the upload is aborted, please retry.".format(self.keyname))
+
+        md5 = (etag, digest.digest().encode("base64").strip())
+        result = self.pool.apply_async(self._send_part, (self.part_num, data, md5))
+        self.pending.append((self.part_num, offset, etag, result))
+        while len(self.pending) >= self.concurrency:
+            self._wait()
+
+    def _wait(self):
+        """Wait for the oldest part in flight."""
+        part_num, offset, etag, result = self.pending.popleft()
+        size = result.get()
+        self.uploaded += size
+        if self.state:
+            self.state.set_part(part_num, offset, size, etag)
+        if self.cb and self.total:
+            self.cb(self.uploaded, self.total)
+        else:
+            log.info("Uploaded {0} bytes".format(self.uploaded))
+
+    def close(self):
+        """Upload the remaining data and complete the upload."""
+        k = Key(self.backend.bucket)
+        k.key = self.keyname
+        if self.mp is None:
+            data = "".join(self.buffer)
+            digest = hashlib.md5(data)
+            k.set_contents_from_string(data, md5=(digest.hexdigest(), digest.digest().encode("base64").strip()))
+            self.checksums = dict(etag=digest.hexdigest())
+        else:
+            if self.buffered:
+                self._upload_part("".join(self.buffer))
+                self.buffer = []
+                self.buffered = 0
+            while self.pending:
+                self._wait()
+
+            # List the parts explicitly, a resumed upload may hold parts
+            # of the interrupted stream beyond the end of this one.
+            parts = ["<Part><PartNumber>{0}</PartNumber><ETag>\"{1}\"</ETag></Part>".format(i + 1, etag)
+                     for i, etag in enumerate(self.etags)]
+            xml = "<CompleteMultipartUpload>{0}</CompleteMultipartUpload>".format("".join(parts))
+            self.backend.bucket.complete_multipart_upload(self.keyname, self.mp.id, xml)
+            # ETag of a multipart object: MD5 of the parts MD5, followed by the number of parts
+            etag = hashlib.md5("".join(etag.decode("hex") for etag in self.etags)).hexdigest()
+            self.checksums = dict(etag="{0}-{1}".format(etag, len(self.etags)),
+                                  part_size=self.part_size,
+                                  parts_md5=self.etags)
+        k.set_acl("private")
+        if self.state:
+            self.state.delete_instance()
+
+    def abort(self):
+        """Cancel the upload, already uploaded parts are discarded
+        (unless the upload state is persisted), parts waiting for a thread aren't sent."""
+        self.aborted = True
+        if self.mp is not None and not self.state:
+            self.mp.cancel_upload()
+
+
+class RangeReader(object):
+    """File-like object reading a remote object by ranges.
+
+    Ranges are downloaded concurrency at a time, a few ranges ahead
+    of the reader, and returned in order, so the memory used stays
+    around 2 * concurrency * chunk_size.
+
+    Subclasses implement _fetch(start, end).
+
+    :type keyname: str
+    :param keyname: Stored filename (for logging).
+
+    :type total: int
+    :param total: Offset following the last byte to read (the object size to read it all).
+
+    :type pool: multiprocessing.pool.ThreadPool
+    :param pool: Thread pool downloading the ranges (the backend worker pool).
+
+    :type chunk_size: int
+    :param chunk_size: Range size.
+
+    :type concurrency: int
+    :param concurrency: Number of ranges downloaded concurrently.
+
+    :type start: int
+    :param start: Offset of the first byte to read.
+
+    """
+    def __init__(self, keyname, total, pool, chunk_size=DEFAULT_DOWNLOAD_CHUNK_SIZE, concurrency=DEFAULT_CONCURRENCY,
+                 start=0):
+        self.keyname = keyname
+        self.total = total
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.start = start
+        self.offset = start
+        self.downloaded = 0
+        self.logged_percent = 0
+        self.pool = pool
+        self.pending = deque()
+        self.buffer = ""
+        self.closed = False
+
+    # Errors of a range download that are worth retrying
+    retry_errors = (socket.error, httplib.IncompleteRead)
+
+    def _fetch(self, start, end):
+        raise NotImplementedError
+
+    def _get_range(self, start, end):
+        if self.closed:
+            return ""
+        for attempt in range(DOWNLOAD_RETRIES):
+            try:
+                data = self._fetch(start, end)
+                if len(data) == end - start + 1:
+                    return data
+                log.info("Incomplete range {0}-{1}, retrying".format(start, end))
+            except self.retry_errors, exc:
+                log.info("Range {0}-{1} failed ({2}), retrying".format(start, end, exc))
+        raise Exception("Failed to download range {0}-{1} of {2}.".format(start, end, self.keyname))
+
+    def _next_chunk(self):
+        while self.offset < self.total and len(self.pending) < 2 * self.concurrency:
+            end = min(self.offset + self.chunk_size, self.total) - 1
+            self.pending.append(self.pool.apply_async(self._get_range, (self.offset, end)))
+            self.offset = end + 1
+        if self.pending:
+            data = self.pending.popleft().get()
+            self.downloaded += len(data)
+            # Progress is logged every 10%, like the upload callback
+            percent = int(self.downloaded * 100.0 / (self.total - self.start))
+            if percent / 10 > self.logged_percent / 10:
+                log.info("Download completion: {0}%".format(percent))
+                self.logged_percent = percent
+            else:
+                log.debug("Download completion: {0}%".format(percent))
+            return data
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            chunks.append(chunk)
+            length += len(chunk)
+
+        data = "".join(chunks)
+        if size < 0:
+            self.buffer = ""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        """Stop reading, the ranges waiting for a thread aren't downloaded."""
+        self.closed = True
+        self.pending.clear()
+
+
+class S3DownloadReader(RangeReader):
+    """File-like object reading a S3 key with parallel ranged GET requests.
+
+    :type backend: S3Backend
+    :param backend: Backend holding the bucket.
+
+    :type keyname: str
+    :param keyname: Key name
+
+    :type chunk_size: int
+    :param chunk_size: Range size.
+
+    :type concurrency: int
+    :param concurrency: Number of ranges downloaded concurrently.
+
+    :type start: int
+    :param start: Offset of the first byte to read.
+
+    :type end: int
+    :param end: Offset following the last byte to read, the key size if None.
+
+    """
+    def __init__(self, backend, keyname, chunk_size=DEFAULT_DOWNLOAD_CHUNK_SIZE, concurrency=DEFAULT_CONCURRENCY,
+                 start=0, end=None):
+        self.backend = backend
+        if end is None:
+            key = backend.thread_bucket().get_key(keyname)
+            if key is None:
+                raise Exception("{0} not found.".format(keyname))
+            end = key.size
+        RangeReader.__init__(self, keyname, end, backend.worker_pool(), chunk_size, concurrency, start)
+
+    def _fetch(self, start, end):
+        k = Key(self.backend.thread_bucket())
+        k.key = self.keyname
+        return k.get_contents_as_string(headers={"Range": "bytes={0}-{1}".format(start, end)})
+
+
+class GlacierDownloadReader(RangeReader):
+    """File-like object reading the output of a completed archive retrieval job
+    with parallel ranged requests.
+
+    Ranges are tree hash aligned (a megabyte multiplied by a power of two),
+    so Glacier returns the tree hash of each range: it's checked as the range
+    arrives, and a range that doesn't match is downloaded again.
+
+    :type backend: GlacierBackend
+    :param backend: Backend holding the vault.
+
+    :type job: boto.glacier.job.Job
+    :param job: Completed archive retrieval job.
+
+    :type keyname: str
+    :param keyname: Stored filename.
+
+    :type chunk_size: int
+    :param chunk_size: Range size, rounded down to a megabyte multiplied by a power of two.
+
+    :type concurrency: int
+    :param concurrency: Number of ranges downloaded concurrently.
+
+    """
+    retry_errors = RangeReader.retry_errors + (TreeHashDoesNotMatchError,)
+
+    def __init__(self, backend, job, keyname, chunk_size=DEFAULT_DOWNLOAD_CHUNK_SIZE, concurrency=DEFAULT_CONCURRENCY):
+        self.backend = backend
+        self.job = job
+        megabytes = max(1, chunk_size / (1024 * 1024))
+        chunk_size = 1024 * 1024 * 2 ** (megabytes.bit_length() - 1)
+        RangeReader.__init__(self, keyname, job.archive_size, backend.worker_pool(), chunk_size, concurrency)
+
+    def _fetch(self, start, end):
+        vault = self.backend.thread_vault()
+        response = vault.layer1.get_job_output(vault.name, self.job.id, (start, end))
+        data = response.read()
+        if "TreeHash" in response and response["TreeHash"] != tree_hash_from_str(data):
+            log.info("Tree hash mismatch for range {0}-{1} of {2}".format(start, end, self.keyname))
+            raise TreeHashDoesNotMatchError("Tree hash mismatch for range {0}-{1}".format(start, end))
+        return data
+
+
+class GlacierUploadWriter(object):
+    """File-like object uploading everything written to it as a Glacier archive.
+
+    Tree hashes are computed as data flows, each part is uploaded
+    as soon as part_size bytes are available, parts are uploaded
+    in parallel by the backend worker pool (each thread with its own connection).
+
+    At most concurrency parts are in flight, so memory usage stays
+    around (concurrency + 1) * part_size.
+
+    With a state, uploaded parts are recorded as they complete, parts whose
+    tree hash matches an already uploaded part are skipped, and the multipart
+    upload is kept on abort so the backup can be resumed (an encrypted
+    stream whose uploaded part changed is aborted, see Uploads.can_replace_part).
+
+    The archive is only registered in the inventory once the upload is completed.
+
+    :type backend: GlacierBackend
+    :param backend: Backend holding the vault.
+
+    :type keyname: str
+    :param keyname: Stored filename, used as archive description.
+
+    :type part_size: int
+    :param part_size: Part size, a megabyte multiplied by a power of two.
+
+    :type state: Uploads
+    :param state: Persisted upload state.
+
+    :type concurrency: int
+    :param concurrency: Number of parts uploaded concurrently.
+
+    """
+    def __init__(self, backend, keyname, part_size=DEFAULT_PART_SIZE, state=None, concurrency=DEFAULT_CONCURRENCY):
+        self.backend = backend
+        self.vault = backend.vault
+        self.keyname = keyname
+        self.part_size = part_size
+        self.state = state
+        self.concurrency = concurrency
+        self.buffer = []
+        self.buffered = 0
+        self.size = 0
+        self.uploaded = 0
+        self.part_num = 0
+        self.offset = 0
+        self.tree_hashes = []
+        self.upload_id = None
+        self.pool = backend.worker_pool()
+        self.pending = deque()
+        self.checksums = {}
+        self.aborted = False
+
+        if state and state.upload_id:
+            log.info("Resuming upload {0} ({1} parts uploaded)".format(state.upload_id, len(state.parts)))
+            self.upload_id = state.upload_id
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.size += len(data)
+        if self.buffered >= self.part_size:
+            data = "".join(self.buffer)
+            offset = 0
+            while len(data) - offset >= self.part_size:
+                self._upload_part(data[offset:offset + self.part_size])
+                offset += self.part_size
+            self.buffer = [data[offset:]]
+            self.buffered = len(data) - offset
+
+    def _send_part(self, data, etag, byte_range):
+        if self.aborted:
+            return 0
+        vault = self.backend.thread_vault()
+        response = vault.layer1.upload_part(vault.name, self.upload_id,
+                                            hashlib.sha256(data).hexdigest(), etag,
+                                            byte_range, data)
+        response.read()
+        return len(data)
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            response = self.vault.layer1.initiate_multipart_upload(self.vault.name, self.part_size, self.keyname)
+            self.upload_id = response["UploadId"]
+            if self.state:
+                self.state.upload_id = self.upload_id
+                self.state.save()
+        self.part_num += 1
+        offset = self.offset
+        self.offset += len(data)
+        part_tree_hash = tree_hash(chunk_hashes(data))
+        self.tree_hashes.append(part_tree_hash)
+        etag = bytes_to_hex(part_tree_hash)
+
+        if self.state and self.state.get_part(self.part_num) == [offset, len(data), etag]:
+            log.info("Part {0} already uploaded".format(self.part_num))
+            self.uploaded += len(data)
+            return
+
+        if self.state and not self.state.can_replace_part(self.part_num):
+            # The source changed, the upload must be started again with a new salt
+            self.state.delete_instance()
+            self.state = None
+            raise Exception("The source changed since the interrupted upload of {0}, "
+                            "the upload is aborted, please retry.".format(self.keyname))
+
+        byte_range = (offset, offset + len(data) - 1)
+        result = self.pool.apply_async(self._send_part, (data, etag, byte_range))
+        self.pending.append((self.part_num, offset, etag, result))
+        while len(self.pending) >= self.concurrency:
+            self._wait()
+
+    def _wait(self):
+        """Wait for the oldest part in flight."""
+        part_num, offset, etag, result = self.pending.popleft()
+        size = result.get()
+        self.uploaded += size
+        if self.state:
+            self.state.set_part(part_num, offset, size, etag)
+        log.info("Uploaded part {0} ({1} bytes so far)".format(part_num, self.uploaded))
+
+    def close(self):
+        """Complete the upload and register the archive in the inventory."""
+        if not self.size:
+            # Glacier rejects empty parts and archives
+            raise Exception("{0} is empty, Glacier can't store empty archives.".format(self.keyname))
+        if self.buffered:
+            self._upload_part("".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        while self.pending:
+            self._wait()
+
+        if self.state and any(int(part_num) > self.part_num for part_num in self.state.parts):
+            # Glacier assembles every uploaded part, parts of the interrupted
+            # stream beyond the end of this one can't be discarded.
+            self.state.delete_instance()
+            self.state = None
+            raise Exception("The source changed since the interrupted upload of {0}, "
+                            "the upload is aborted, please retry.".format(self.keyname))
+
+        self.checksums = dict(tree_hash=bytes_to_hex(tree_hash(self.tree_hashes)))
+        response = self.vault.layer1.complete_multipart_upload(self.vault.name, self.upload_id,
+                                                               self.checksums["tree_hash"],
+                                                               self.size)
+        with database.transaction():
+            Inventory.create(filename=self.keyname, archive_id=response["ArchiveId"])
+            InventoryChanges.record([(self.keyname, response["ArchiveId"])])
+        if self.state:
+            self.state.delete_instance()
+        self.backend._backup_inventory()
+
+    def abort(self):
+        """Abort the multipart upload (unless the upload state is persisted),
+        parts waiting for a thread aren't sent."""
+        self.aborted = True
+        if self.upload_id is not None and not self.state:
+            self.vault.layer1.abort_multipart_upload(self.vault.name, self.upload_id)
@@ -0,0 +1,293 @@
+# -*- encoding: utf-8 -*-
+import os
+import time
+import logging
+import threading
+
+from bakthat.models import Backups, CacheEntries, Uploads
+from bakthat.stream import copy_stream
+from bakthat.utils import _size_string_to_bytes
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = "10G"
+
+# An upload claimed before this delay is considered interrupted (in seconds).
+CLAIM_EXPIRATION = 86400
+
+_uploaders = {}
+_uploaders_lock = threading.Lock()
+
+
+class CacheWriter(object):
+    """File-like object writing a backup in the cache,
+    the cache entry is registered (waiting for upload) by register,
+    once the backup is in the catalog, so the uploader never uploads
+    a backup before its catalog entry exists.
+
+    The size and checksums attributes mimic the upload writers,
+    checksums are computed by the upload writer when the cache is drained.
+    """
+    def __init__(self, cache, storage_backend, keyname):
+        self.cache = cache
+        self.storage_backend = storage_backend
+        self.keyname = keyname
+        self.path = cache.entry_path(storage_backend, keyname)
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self.fileobj = open(self.path + ".part", "wb")
+        self.size = 0
+        self.checksums = {}
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.fileobj.close()
+        os.rename(self.path + ".part", self.path)
+
+    def register(self):
+        """Register the cached backup, waiting for upload."""
+        CacheEntries.create(stored_filename=self.keyname,
+                            backend=self.storage_backend.name,
+                            backend_hash=self.storage_backend.get_backend_hash(),
+                            path=self.path,
+                            size=self.size,
+                            last_access=int(time.time()))
+        self.cache.evict()
+
+    def abort(self):
+        self.fileobj.close()
+        os.remove(self.path + ".part")
+
+
+class CacheReader(object):
+    """File-like object reading a cached backup from start to end."""
+    def __init__(self, path, start=0, end=None):
+        self.fileobj = open(path, "rb")
+        self.fileobj.seek(start)
+        self.remaining = (os.path.getsize(path) if end is None else end) - start
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+class BackupCache(object):
+    """Local cache directory in front of a storage backend.
+
+    Backups are written in the cache and uploaded later by drain
+    (in a background thread with start_uploader), cached backups are read
+    from the cache, and the least recently used backups already uploaded
+    are evicted when the cache is bigger than max_size.
+
+    :type path: str
+    :param path: Cache directory.
+
+    :type max_size: int
+    :param max_size: Cache size limit in bytes.
+
+    """
+    def __init__(self, path, max_size):
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Return the cache configured with the cache key of a profile
+        (a dict with path and max_size like 10G), None if there is none."""
+        if not conf or not conf.get("path"):
+            return
+        return cls(conf["path"], _size_string_to_bytes(conf.get("max_size", DEFAULT_CACHE_SIZE)))
+
+    def entry_path(self, storage_backend, keyname):
+        return os.path.join(self.path, storage_backend.name, storage_backend.get_backend_hash()[:16], keyname)
+
+    def open_write(self, storage_backend, keyname):
+        """Return a file-like object writing a backup in the cache."""
+        return CacheWriter(self, storage_backend, keyname)
+
+    def contains(self, storage_backend, keyname):
+        """Return True if the backup is in the cache."""
+        entry = CacheEntries.get_entry(keyname, storage_backend.name, storage_backend.get_backend_hash())
+        return entry is not None and os.path.isfile(entry.path)
+
+    def open_read(self, storage_backend, keyname, start=0, end=None):
+        """Return a file-like object reading a cached backup from start to end,
+        None if the backup is not cached."""
+        entry = CacheEntries.get_entry(keyname, storage_backend.name, storage_backend.get_backend_hash())
+        if entry is None:
+            return
+        if not os.path.isfile(entry.path):
+            log.warning("{0} is missing from the cache".format(keyname))
+            entry.delete_instance()
+            return
+        entry.last_access = int(time.time())
+        entry.save()
+        log.info("Reading {0} from the cache".format(keyname))
+        return CacheReader(entry.path, start, end)
+
+    def evict(self):
+        """Remove the least recently used backups (only the uploaded ones)
+        until the cache size is below max_size."""
+        total = sum(entry.size for entry in CacheEntries.select())
+        if total <= self.max_size:
+            return
+        query = CacheEntries.select().where(CacheEntries.uploaded == True).order_by(CacheEntries.last_access)
+        for entry in query:
+            if total <= self.max_size:
+                break
+            log.info("Evicting {0} from the cache".format(entry.stored_filename))
+            self._remove_entry(entry)
+            total -= entry.size
+        if total > self.max_size:
+            log.warning("The cache is full of backups waiting for upload ({0} bytes)".format(total))
+
+    def _remove_entry(self, entry):
+        if os.path.isfile(entry.path):
+            os.remove(entry.path)
+        entry.delete_instance()
+
+    def remove(self, storage_backend, keynames):
+        """Remove deleted backups from the cache."""
+        query = CacheEntries.select().where(CacheEntries.backend == storage_backend.name,
+                                            CacheEntries.backend_hash == storage_backend.get_backend_hash())
+        keynames = set(keynames)
+        for entry in query:
+            if entry.stored_filename in keynames:
+                self._remove_entry(entry)
+
+    def pending(self, storage_backend):
+        """Return the cached backups waiting for upload."""
+        return CacheEntries.select().where(CacheEntries.backend == storage_backend.name,
+                                           CacheEntries.backend_hash == storage_backend.get_backend_hash(),
+                                           CacheEntries.uploaded == False).order_by(CacheEntries.id)
+
+    def drain(self, storage_backend):
+        """Upload the cached backups waiting for upload.
+
+        Each upload is resumable, and claimed in the database so
+        concurrent uploaders don't upload the same backup.
+
+        :rtype: list
+        :return: The uploaded stored filenames.
+
+        """
+        uploaded = []
+        for entry in self.pending(storage_backend):
+            if not entry.claim(int(time.time()) - CLAIM_EXPIRATION):
+                continue
+            try:
+                self._upload_entry(storage_backend, entry)
+            except Exception, exc:
+                log.exception("Upload of {0} failed: {1}".format(entry.stored_filename, exc))
+                CacheEntries.update(upload_started=0).where(CacheEntries.id == entry.id).execute()
+                continue
+            uploaded.append(entry.stored_filename)
+        if uploaded:
+            self.evict()
+        return uploaded
+
+    def _upload_entry(self, storage_backend, entry):
+        log.info("Uploading {0} from the cache".format(entry.stored_filename))
+        resume_key = "cache:" + entry.stored_filename
+        state = storage_backend.resume_upload(resume_key)
+        if state is None:
+            state = Uploads.create(resume_key=resume_key,
+                                   backend=storage_backend.name,
+                                   backend_hash=entry.backend_hash,
+                                   stored_filename=entry.stored_filename,
+                                   part_size=storage_backend.part_size(),
+                                   created=int(time.time()),
+                                   metadata={},
+                                   parts={})
+        upload = storage_backend.open_upload(entry.stored_filename, state=state)
+        try:
+            with open(entry.path, "rb") as f:
+                copy_stream(f, upload)
+            upload.close()
+        except:
+            upload.abort()
+            raise
+
+        entry.uploaded = True
+        entry.save()
+
+        try:
+            backup = Backups.get(Backups.stored_filename == entry.stored_filename)
+        except Backups.DoesNotExist:
+            return
+        metadata = backup.metadata
+        metadata.pop("pending_upload", None)
+        metadata["checksums"] = dict(metadata.get("checksums", {}), **upload.checksums)
+        backup.metadata = metadata
+        backup.last_updated = int(time.time())
+        backup.save()
+
+
+class Uploader(threading.Thread):
+    """Drain the cache in the background, until nothing is left to upload.
+
+    The thread isn't a daemon, the process doesn't exit before
+    the uploads are completed (see wait_uploaders).
+
+    :type callback: callable
+    :param callback: Called with the uploaded stored filenames after each pass.
+
+    """
+    def __init__(self, cache, storage_backend, key, callback=None):
+        threading.Thread.__init__(self)
+        self.cache = cache
+        self.storage_backend = storage_backend
+        self.key = key
+        self.callback = callback
+        self.again = False
+
+    def run(self):
+        while 1:
+            uploaded = self.cache.drain(self.storage_backend)
+            if uploaded and self.callback:
+                self.callback(uploaded)
+            with _uploaders_lock:
+                if not uploaded and not self.again:
+                    del _uploaders[self.key]
+                    return
+                self.again = False
+
+
+def start_uploader(storage_backend, callback=None):
+    """Drain the cache of storage_backend in a background thread,
+    a single thread per backend is running.
+
+    :rtype: Uploader
+    :return: The uploader thread.
+
+    """
+    key = (storage_backend.name, storage_backend.get_backend_hash())
+    with _uploaders_lock:
+        uploader = _uploaders.get(key)
+        if uploader is not None:
+            uploader.again = True
+        else:
+            uploader = _uploaders[key] = Uploader(storage_backend.cache, storage_backend, key, callback)
+            uploader.start()
+    return uploader
+
+
+def wait_uploaders():
+    """Wait for the running uploaders, logging that the process is waiting."""
+    with _uploaders_lock:
+        uploaders = _uploaders.values()
+    if uploaders:
+        log.info("Waiting for the background uploads to complete...")
+    for uploader in uploaders:
+        # join with a timeout to stay interruptible (KeyboardInterrupt)
+        while uploader.is_alive():
+            uploader.join(1)
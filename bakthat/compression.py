@@ -0,0 +1,611 @@
+# -*- encoding: utf-8 -*-
+import logging
+import math
+import struct
+import time
+import zlib
+from StringIO import StringIO
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from bakthat.stream import CHUNK_SIZE
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CODEC = "gzip"
+DEFAULT_LEVEL = 9
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# Uncompressed size between two indexed frames, a single file restore
+# downloads up to a frame before and after the file.
+DEFAULT_FRAME_SIZE = 16 * 1024 * 1024
+
+# Blocks whose sampled entropy (in bits per byte) is above this are stored uncompressed.
+ENTROPY_THRESHOLD = 7.9
+SAMPLE_SIZE = 4096
+
+# Magic numbers of already compressed (or encrypted) formats: (offset, magic)
+MAGIC_NUMBERS = [(0, "\x1f\x8b"),            # gzip
+                 (0, "\x28\xb5\x2f\xfd"),    # zstd
+                 (0, "\x04\x22\x4d\x18"),    # lz4
+                 (0, "\xfd7zXZ\x00"),         # xz
+                 (0, "BZh"),                 # bzip2
+                 (0, "7z\xbc\xaf\x27\x1c"),   # 7z
+                 (0, "PK\x03\x04"),          # zip (docx, jar...)
+                 (0, "Rar!\x1a\x07"),         # rar
+                 (0, "\xff\xd8\xff"),         # jpeg
+                 (0, "\x89PNG"),              # png
+                 (0, "GIF8"),                # gif
+                 (0, "ID3"),                 # mp3
+                 (0, "OggS"),                # ogg
+                 (0, "\x1a\x45\xdf\xa3"),    # mkv/webm
+                 (4, "ftyp"),                # mp4/mov
+                 (0, "Salted__")]            # openssl enc
+
+MAGIC_SIZE = 16
+
+
+def is_compressed(header):
+    """Return True if header (the first MAGIC_SIZE bytes of a file)
+    starts with the magic number of a compressed format."""
+    return any(header[offset:offset + len(magic)] == magic for offset, magic in MAGIC_NUMBERS)
+
+
+def entropy(data):
+    """Return the Shannon entropy of data in bits per byte."""
+    if not data:
+        return 0.0
+    length = float(len(data))
+    counts = (data.count(chr(i)) for i in range(256))
+    return -sum(count / length * math.log(count / length, 2) for count in counts if count)
+
+
+def is_incompressible(block):
+    """Return True if a sample of block (beginning, middle and end)
+    looks like random data, compressed or encrypted."""
+    if len(block) > 3 * SAMPLE_SIZE:
+        middle = (len(block) - SAMPLE_SIZE) // 2
+        block = block[:SAMPLE_SIZE] + block[middle:middle + SAMPLE_SIZE] + block[-SAMPLE_SIZE:]
+    return entropy(block) >= ENTROPY_THRESHOLD
+
+
+def _deflate_block(block, level, detect=False, stored=False):
+    """Compress a block as a raw deflate stream ending on a byte boundary,
+    so compressed blocks can be concatenated.
+
+    The block is stored (level 0) if stored is set or, if detect is set, if it's incompressible.
+
+    :rtype: tuple
+    :return: The compressed block, True if stored and the time spent.
+
+    """
+    start = time.time()
+    stored = stored or (detect and is_incompressible(block))
+    compressor = zlib.compressobj(0 if stored else level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data, stored, time.time() - start
+
+
+class ParallelGzipWriter(object):
+    """File-like object writing a gzip stream into fileobj, pigz style.
+
+    Data is split in blocks of block_size bytes, blocks are compressed
+    independently in a thread pool (zlib releases the GIL), and written
+    in order as a single gzip member, readable by any gzip decoder.
+
+    Each block can also be inflated on its own (raw deflate), frames holds
+    the (uncompressed offset, compressed offset) of a block every frame_size bytes,
+    plus the end of the deflate blocks, for random access.
+
+    Incompressible blocks (high entropy, or inside a range marked
+    with incompressible) are stored without compression, stats holds
+    the uncompressed/compressed/stored sizes and the compression time.
+
+    :type fileobj: file
+    :param fileobj: Writable file-like object receiving the gzip stream.
+
+    :type level: int
+    :param level: Compression level (1-9).
+
+    :type block_size: int
+    :param block_size: Uncompressed block size.
+
+    :type workers: int
+    :param workers: Number of compression threads, number of CPUs by default.
+
+    :type mtime: int
+    :param mtime: Modification time stored in the gzip header, now if None.
+
+    :type detect: bool
+    :param detect: Store incompressible blocks without compression.
+
+    :type frame_size: int
+    :param frame_size: Uncompressed size between two frames (rounded up to a multiple of block_size).
+
+    """
+    def __init__(self, fileobj, level=DEFAULT_LEVEL, block_size=DEFAULT_BLOCK_SIZE, workers=None, mtime=None,
+                 detect=True, frame_size=DEFAULT_FRAME_SIZE):
+        self.fileobj = fileobj
+        self.level = int(level)
+        self.block_size = int(block_size)
+        self.workers = int(workers or cpu_count())
+        self.pool = ThreadPool(self.workers)
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        self.crc = zlib.crc32("")
+        self.size = 0
+        self.frames = []
+        self.frame_size = int(frame_size)
+        self.detect = detect
+        self.ranges = deque()
+        self.stats = dict(size=0, compressed_size=0, stored_size=0, compression_time=0.0)
+
+        # gzip header: magic, deflate, no flags, mtime, no extra flags, unknown OS
+        if mtime is None:
+            mtime = time.time()
+        self.fileobj.write("\037\213\010\000" + struct.pack("<I", int(mtime)) + "\000\377")
+        self.compressed = 10
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            data = "".join(self.buffer)
+            offset = 0
+            while len(data) - offset >= self.block_size:
+                self._submit(data[offset:offset + self.block_size])
+                offset += self.block_size
+            self.buffer = [data[offset:]]
+            self.buffered = len(data) - offset
+
+    def incompressible(self, start, end):
+        """Mark the uncompressed range start-end as incompressible,
+        the blocks within it are stored without compression."""
+        self.ranges.append((start, end))
+
+    def _in_range(self, start, end):
+        while self.ranges and self.ranges[0][1] < end:
+            self.ranges.popleft()
+        return bool(self.ranges) and self.ranges[0][0] <= start
+
+    def _submit(self, block):
+        stored = self._in_range(self.size, self.size + len(block))
+        self.pending.append((self.size, self.pool.apply_async(_deflate_block,
+                                                              (block, self.level, self.detect, stored))))
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+
+        # Keep at most two blocks per worker in memory
+        while len(self.pending) > 2 * self.workers:
+            self._write_block()
+
+    def _write_block(self):
+        offset, result = self.pending.popleft()
+        data, stored, elapsed = result.get()
+        size = (self.pending[0][0] if self.pending else self.size) - offset
+        self.stats["size"] += size
+        self.stats["compressed_size"] += len(data)
+        self.stats["compression_time"] += elapsed
+        if stored:
+            self.stats["stored_size"] += size
+        if not self.frames or offset - self.frames[-1][0] >= self.frame_size:
+            self.frames.append((offset, self.compressed))
+        self.compressed += len(data)
+        self.fileobj.write(data)
+
+    def close(self):
+        """Compress the remaining data and write the gzip trailer."""
+        if self.buffered:
+            self._submit("".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        while self.pending:
+            self._write_block()
+        self.pool.close()
+        self.pool.join()
+        self.frames.append((self.size, self.compressed))
+
+        # An empty final block terminates the deflate stream
+        self.fileobj.write(zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+        self.fileobj.write(struct.pack("<II", self.crc & 0xffffffffL, self.size & 0xffffffffL))
+
+    def abort(self):
+        self.pool.terminate()
+
+
+class CompressorWriter(object):
+    """File-like object compressing everything written to it into fileobj.
+
+    Data is compressed by blocks of block_size bytes. Incompressible blocks
+    (high entropy, or inside a range marked with incompressible) are compressed
+    at store_level (the fastest level of the codec) instead: the current stream
+    is ended and a new one is started each time the level changes, concatenated
+    streams are decompressed by DecompressorReader. stats holds the
+    uncompressed/compressed/stored sizes and the compression time.
+
+    :type fileobj: file
+    :param fileobj: Writable file-like object receiving compressed data.
+
+    :type compressobj: callable
+    :param compressobj: Return a new zlib-like compression object (with compress and flush)
+        for the given level.
+
+    :type level: int
+    :param level: Compression level.
+
+    :type store_level: int
+    :param store_level: Compression level of the incompressible blocks, None to disable the detection.
+
+    :type block_size: int
+    :param block_size: Uncompressed block size.
+
+    :type detect: bool
+    :param detect: Compress incompressible blocks at store_level.
+
+    """
+    def __init__(self, fileobj, compressobj, level=None, store_level=None, block_size=DEFAULT_BLOCK_SIZE,
+                 detect=True):
+        self.fileobj = fileobj
+        self.compressobj = compressobj
+        self.level = level
+        self.store_level = store_level
+        self.block_size = int(block_size)
+        self.detect = detect and store_level is not None
+        self.stored = False
+        self.compressor = compressobj(level)
+        self.buffer = []
+        self.buffered = 0
+        self.size = 0
+        self.ranges = deque()
+        self.stats = dict(size=0, compressed_size=0, stored_size=0, compression_time=0.0)
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            data = "".join(self.buffer)
+            offset = 0
+            while len(data) - offset >= self.block_size:
+                self._compress_block(data[offset:offset + self.block_size])
+                offset += self.block_size
+            self.buffer = [data[offset:]]
+            self.buffered = len(data) - offset
+
+    def incompressible(self, start, end):
+        """Mark the uncompressed range start-end as incompressible,
+        the blocks within it are compressed at store_level."""
+        self.ranges.append((start, end))
+
+    def _in_range(self, start, end):
+        while self.ranges and self.ranges[0][1] < end:
+            self.ranges.popleft()
+        return bool(self.ranges) and self.ranges[0][0] <= start
+
+    def _write(self, data):
+        if data:
+            self.stats["compressed_size"] += len(data)
+            self.fileobj.write(data)
+
+    def _compress_block(self, block):
+        start = time.time()
+        if self.detect:
+            stored = self._in_range(self.size, self.size + len(block)) or is_incompressible(block)
+            if stored != self.stored:
+                self._write(self.compressor.flush())
+                self.compressor = self.compressobj(self.store_level if stored else self.level)
+                self.stored = stored
+        self._write(self.compressor.compress(block))
+        self.size += len(block)
+        self.stats["size"] += len(block)
+        if self.stored:
+            self.stats["stored_size"] += len(block)
+        self.stats["compression_time"] += time.time() - start
+
+    def close(self):
+        if self.buffered:
+            self._compress_block("".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        self._write(self.compressor.flush())
+
+    def abort(self):
+        pass
+
+
+class DecompressorReader(object):
+    """File-like object returning the decompressed content of fileobj.
+
+    Concatenated streams (multiple gzip members or zstd frames...) are
+    decompressed one after the other.
+
+    :type fileobj: file
+    :param fileobj: Readable file-like object containing compressed data.
+
+    :type decompressobj: callable
+    :param decompressobj: Return a new zlib-like decompression object.
+
+    """
+    def __init__(self, fileobj, decompressobj):
+        self.fileobj = fileobj
+        self.decompressobj = decompressobj
+        self.decompressor = decompressobj()
+        self.buffer = ""
+        self.eof = False
+
+    def _decompress(self, data):
+        out = []
+        while data:
+            if getattr(self.decompressor, "eof", False):
+                # The stream ended exactly at the end of the previous data
+                self.decompressor = self.decompressobj()
+            out.append(self.decompressor.decompress(data))
+            data = getattr(self.decompressor, "unused_data", "")
+            if data:
+                # End of a stream, the next one starts right after
+                self.decompressor = self.decompressobj()
+        return "".join(out)
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while (size < 0 or length < size) and not self.eof:
+            data = self.fileobj.read(CHUNK_SIZE)
+            if not data:
+                self.eof = True
+                if hasattr(self.decompressor, "flush"):
+                    data = self.decompressor.flush() or ""
+                    chunks.append(data)
+                    length += len(data)
+                break
+            data = self._decompress(data)
+            chunks.append(data)
+            length += len(data)
+
+        data = "".join(chunks)
+        if size < 0:
+            self.buffer = ""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        if hasattr(self.fileobj, "close"):
+            self.fileobj.close()
+
+
+class StreamReader(object):
+    """File-like object returning exactly size bytes (unless the end
+    of the stream is reached) from a reader returning fewer bytes."""
+    def __init__(self, reader):
+        self.reader = reader
+
+    def read(self, size=-1):
+        chunks = []
+        length = 0
+        while size < 0 or length < size:
+            data = self.reader.read(CHUNK_SIZE if size < 0 else size - length)
+            if not data:
+                break
+            chunks.append(data)
+            length += len(data)
+        return "".join(chunks)
+
+
+class Codec(object):
+    """Base class for compression codecs.
+
+    A codec provides zlib-like compression/decompression objects,
+    and streaming writer/reader built on top of them.
+    """
+    name = None
+    extension = None
+    default_level = None
+    # Fastest level, used for the incompressible blocks
+    store_level = None
+    module = None
+
+    def check(self):
+        """Raise an exception if the codec module is not installed."""
+        if not self.available():
+            raise Exception("You must install {0} module in order to use {1} compression.".format(self.module,
+                                                                                                 self.name))
+
+    def available(self):
+        return True
+
+    def compressobj(self, level):
+        raise NotImplementedError
+
+    def decompressobj(self):
+        raise NotImplementedError
+
+    def writer(self, fileobj, level=None, **options):
+        """Return a file-like object compressing everything written to it into fileobj.
+
+        :type fileobj: file
+        :param fileobj: Writable file-like object.
+
+        :type level: int
+        :param level: Compression level, codec default level if None.
+
+        :type block_size: int
+        :keyword block_size: Size of the blocks checked for incompressible data.
+
+        :type detect_incompressible: bool
+        :keyword detect_incompressible: Compress incompressible blocks at store_level (True by default).
+
+        """
+        self.check()
+        return CompressorWriter(fileobj, self.compressobj, self._level(level), self.store_level,
+                                block_size=options.get("block_size") or DEFAULT_BLOCK_SIZE,
+                                detect=options.get("detect_incompressible", True) is not False)
+
+    def reader(self, fileobj):
+        """Return a file-like object decompressing fileobj."""
+        self.check()
+        return DecompressorReader(fileobj, self.decompressobj)
+
+    def compress(self, data, level=None):
+        self.check()
+        compressor = self.compressobj(self._level(level))
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        return self.reader(StringIO(data)).read()
+
+    def _level(self, level):
+        if level is None:
+            return self.default_level
+        return int(level)
+
+
+class GzipCodec(Codec):
+    name = "gzip"
+    extension = "tgz"
+    default_level = DEFAULT_LEVEL
+
+    def compressobj(self, level):
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def decompressobj(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def writer(self, fileobj, level=None, **options):
+        return ParallelGzipWriter(fileobj,
+                                  level=self._level(level),
+                                  block_size=options.get("block_size") or DEFAULT_BLOCK_SIZE,
+                                  workers=options.get("workers"),
+                                  mtime=options.get("mtime"),
+                                  detect=options.get("detect_incompressible", True) is not False)
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    extension = "tar.zst"
+    default_level = 3
+    store_level = 1
+    module = "zstandard"
+
+    def available(self):
+        return zstandard is not None
+
+    def compressobj(self, level, workers=0):
+        return zstandard.ZstdCompressor(level=level, threads=workers).compressobj()
+
+    def decompressobj(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def reader(self, fileobj):
+        # zstandard decompression objects stop at the end of the first frame
+        self.check()
+        return StreamReader(zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True))
+
+    def writer(self, fileobj, level=None, **options):
+        # zstd multithreaded mode, one thread per CPU by default
+        self.check()
+        workers = int(options.get("workers") or -1)
+        return CompressorWriter(fileobj, lambda level: self.compressobj(level, workers),
+                                self._level(level), self.store_level,
+                                block_size=options.get("block_size") or DEFAULT_BLOCK_SIZE,
+                                detect=options.get("detect_incompressible", True) is not False)
+
+
+class _LZ4Compressor(object):
+    """zlib-like wrapper around LZ4FrameCompressor."""
+    def __init__(self, level):
+        self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.header = self.compressor.begin()
+
+    def _header(self):
+        header, self.header = self.header, ""
+        return header
+
+    def compress(self, data):
+        return self._header() + self.compressor.compress(data)
+
+    def flush(self):
+        return self._header() + self.compressor.flush()
+
+
+class LZ4Codec(Codec):
+    name = "lz4"
+    extension = "tar.lz4"
+    default_level = 0
+    # Already as fast on incompressible data
+    store_level = None
+    module = "lz4"
+
+    def available(self):
+        return lz4 is not None
+
+    def compressobj(self, level):
+        return _LZ4Compressor(level)
+
+    def decompressobj(self):
+        return lz4.frame.LZ4FrameDecompressor()
+
+
+class XzCodec(Codec):
+    name = "xz"
+    extension = "txz"
+    default_level = 6
+    store_level = 0
+    module = "lzma (backports.lzma)"
+
+    def available(self):
+        return lzma is not None
+
+    def compressobj(self, level):
+        return lzma.LZMACompressor(preset=level)
+
+    def decompressobj(self):
+        return lzma.LZMADecompressor()
+
+
+CODECS = dict((codec.name, codec) for codec in [GzipCodec(), ZstdCodec(), LZ4Codec(), XzCodec()])
+
+
+def get_codec(name):
+    """Return the codec registered under the given name.
+
+    :type name: str
+    :param name: Codec name (gzip|zstd|lz4|xz).
+
+    :rtype: Codec
+    :return: The codec instance.
+
+    """
+    if not name in CODECS:
+        raise Exception("Unknown compression codec {0}, choose from {1}.".format(name, "|".join(sorted(CODECS))))
+    return CODECS[name]
+
+
+def parse_compression(compression):
+    """Parse a compression string like zstd or zstd:3 into (codec name, level).
+
+    :rtype: tuple
+    :return: The codec name and the level (None for the codec default level).
+
+    """
+    name, _, level = compression.partition(":")
+    return name, int(level) if level else None
@@ -0,0 +1,401 @@
+# -*- encoding: utf-8 -*-
+import logging
+import errno
+import fcntl
+import hashlib
+import hmac
+import json
+import math
+import struct
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+from beefish import encrypt, decrypt
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from bakthat.compression import get_codec
+from bakthat.conf import DATABASE
+from bakthat.models import database, Backups, Chunks, BackupChunks
+
+log = logging.getLogger(__name__)
+
+CHUNKS_PREFIX = "bakthat_chunks/"
+
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Number of chunks uploaded/downloaded concurrently.
+DEFAULT_WORKERS = 4
+
+# Held (shared) by the dedup backups in progress, and (exclusive) by the chunks collection.
+CHUNKS_LOCK = DATABASE + ".chunks.lock"
+
+# Random 32 bits value for each byte value, used by the gear rolling hash.
+GEAR = [struct.unpack("<I", hashlib.sha256("bakthat-gear-{0}".format(i)).digest()[:4])[0] for i in range(256)]
+
+GEAR_VALUES = numpy.array(GEAR, dtype=numpy.uint32) if numpy is not None else None
+
+# Number of bytes hashed at once by the numpy boundary search.
+SCAN_SIZE = 1024 * 1024
+
+
+class Chunker(object):
+    """Split a stream in content-defined chunks.
+
+    Boundaries are found with a gear rolling hash (each byte shifts the hash
+    and adds a random value, so the hash only depends on the last 32 bytes),
+    a boundary is set when the highest bits of the hash are zero,
+    so an insertion in the stream only changes the surrounding chunks.
+
+    With numpy installed, the hash of every position of a 1MB block
+    is computed at once, as a sum of the shifted gear values of the last
+    32 bytes (around 80MB/s), the same boundaries are found
+    byte by byte in pure Python otherwise (around 6MB/s, too slow
+    to deduplicate large backups).
+
+    :type min_size: int
+    :param min_size: Minimum chunk size.
+
+    :type avg_size: int
+    :param avg_size: Average chunk size, must be a power of two.
+
+    :type max_size: int
+    :param max_size: Maximum chunk size.
+
+    """
+    def __init__(self, min_size=MIN_CHUNK_SIZE, avg_size=AVG_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+        self.min_size = min_size
+        self.max_size = max_size
+        bits = int(math.log(avg_size, 2))
+        self.mask = ((1 << bits) - 1) << (32 - bits)
+        self.buffer = bytearray()
+        self.pos = 0
+        self.hash = 0
+
+    def feed(self, data):
+        """Add data to the stream.
+
+        :rtype: list
+        :return: The chunks completed by data.
+
+        """
+        self.buffer.extend(data)
+        chunks = []
+        while 1:
+            boundary = self._find_boundary()
+            if boundary is None:
+                break
+            chunks.append(str(self.buffer[:boundary]))
+            del self.buffer[:boundary]
+            self.pos = 0
+            self.hash = 0
+        return chunks
+
+    def flush(self):
+        """Return the last chunk (empty string if the stream is empty)."""
+        chunk = str(self.buffer)
+        self.buffer = bytearray()
+        self.pos = 0
+        self.hash = 0
+        return chunk
+
+    def _find_boundary(self):
+        if numpy is not None:
+            return self._find_boundary_numpy()
+
+        buf = self.buffer
+        end = min(len(buf), self.max_size)
+        # The hash only depends on the last 32 bytes, no need to hash before that
+        i = max(self.pos, self.min_size - 32)
+        h = self.hash
+        mask = self.mask
+        gear = GEAR
+        while i < end:
+            h = ((h << 1) + gear[buf[i]]) & 0xffffffff
+            i += 1
+            if not h & mask and i >= self.min_size:
+                return i
+        self.pos = i
+        self.hash = h
+        if len(buf) >= self.max_size:
+            return self.max_size
+
+    def _find_boundary_numpy(self):
+        end = min(len(self.buffer), self.max_size)
+        # First candidate boundary (a boundary follows the hashed byte)
+        first = max(self.pos + 1, self.min_size)
+        while first <= end:
+            last = min(first + SCAN_SIZE, end + 1)
+            # The 31 bytes before the first candidate are needed by its hash
+            data = numpy.frombuffer(self.buffer, dtype=numpy.uint8, count=last - first + 31, offset=first - 32)
+            hashes = GEAR_VALUES[data]
+            del data
+            # hashes[i] = sum(gear[byte[i - k]] << k for k in 0..31), modulo 2 ** 32
+            width = 1
+            while width < 32:
+                hashes[width:] += hashes[:-width] << width
+                width *= 2
+            matches = numpy.flatnonzero(hashes[31:] & self.mask == 0)
+            if len(matches):
+                return first + int(matches[0])
+            first = last
+        self.pos = end
+        if len(self.buffer) >= self.max_size:
+            return self.max_size
+
+
+def _lock_chunks(exclusive=False):
+    """Lock the chunks index of this host, return the lock file (close it to release the lock).
+
+    Dedup backups hold a shared lock while they run, so the chunks they reuse
+    or upload before their references are stored are not collected.
+    The exclusive lock of the collection isn't waited for, None is returned if it's not available.
+
+    """
+    lock = open(CHUNKS_LOCK, "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB if exclusive else fcntl.LOCK_SH)
+    except IOError, exc:
+        lock.close()
+        if exclusive and exc.errno in (errno.EAGAIN, errno.EACCES):
+            return
+        raise
+    return lock
+
+
+def _pack(data, codec, level, password):
+    """Compress and encrypt a chunk/recipe."""
+    data = codec.compress(data, level)
+    if password:
+        out = StringIO()
+        encrypt(StringIO(data), out, password)
+        data = out.getvalue()
+    return data
+
+
+def _unpack(data, codec, password):
+    """Decrypt and decompress a chunk/recipe."""
+    if password:
+        out = StringIO()
+        decrypt(StringIO(data), out, password)
+        data = out.getvalue()
+    return codec.decompress(data)
+
+
+class DedupUpload(object):
+    """File-like object storing everything written to it as deduplicated chunks.
+
+    The stream is split in content-defined chunks, chunks already
+    stored in the bucket (according to the Chunks table) are skipped,
+    new chunks are compressed, encrypted and uploaded under the
+    bakthat_chunks/ prefix, and the list of chunks (the recipe)
+    is uploaded as keyname on close.
+
+    :type storage_backend: S3Backend
+    :param storage_backend: Storage backend.
+
+    :type keyname: str
+    :param keyname: Recipe key name (stored filename).
+
+    :type password: str
+    :param password: Password, empty string to disable encryption.
+
+    :type codec: Codec
+    :param codec: Chunks compression codec.
+
+    :type level: int
+    :param level: Compression level.
+
+    """
+    def __init__(self, storage_backend, keyname, password="", codec=None, level=None, workers=DEFAULT_WORKERS):
+        self.storage_backend = storage_backend
+        self.keyname = keyname
+        self.password = password
+        self.codec = codec or get_codec("gzip")
+        self.level = level
+        self.backend_hash = storage_backend.get_backend_hash()
+        self.chunker = Chunker()
+        self.pool = ThreadPool(workers)
+        self.workers = workers
+        self.pending = deque()
+        self.recipe = []
+        self.uploading = set()
+        self.size = 0
+        self.logical_size = 0
+        self.new_chunks = 0
+        self.lock = _lock_chunks()
+
+    def chunk_id(self, chunk):
+        """Return the chunk id, keyed by the password for encrypted chunks,
+        so chunks encrypted with different passwords never collide."""
+        if self.password:
+            return hmac.new(self.password, chunk, hashlib.sha256).hexdigest()
+        return hashlib.sha256(chunk).hexdigest()
+
+    def write(self, data):
+        self.logical_size += len(data)
+        for chunk in self.chunker.feed(data):
+            self._add_chunk(chunk)
+
+    def _upload_chunk(self, chunk_id, chunk):
+        data = _pack(chunk, self.codec, self.level, self.password)
+        self.storage_backend.upload_string(CHUNKS_PREFIX + chunk_id, data)
+        return chunk_id, len(data)
+
+    def _add_chunk(self, chunk):
+        chunk_id = self.chunk_id(chunk)
+        self.recipe.append(chunk_id)
+        if chunk_id in self.uploading or Chunks.exists(chunk_id, self.backend_hash):
+            return
+
+        self.uploading.add(chunk_id)
+        self.pending.append(self.pool.apply_async(self._upload_chunk, (chunk_id, chunk)))
+        while len(self.pending) > 2 * self.workers:
+            self._register(self.pending.popleft().get())
+
+    def _register(self, result):
+        chunk_id, size = result
+        Chunks.create(chunk_id=chunk_id, backend_hash=self.backend_hash, size=size)
+        self.size += size
+        self.new_chunks += 1
+
+    def close(self):
+        """Upload the remaining chunks and the recipe."""
+        chunk = self.chunker.flush()
+        if chunk:
+            self._add_chunk(chunk)
+        while self.pending:
+            self._register(self.pending.popleft().get())
+        self.pool.close()
+        self.pool.join()
+
+        recipe = json.dumps(dict(chunks=self.recipe, compression=self.codec.name))
+        data = _pack(recipe, self.codec, self.level, self.password)
+        self.storage_backend.upload_string(self.keyname, data)
+        self.size += len(data)
+
+        with database.transaction():
+            for chunk_id in set(self.recipe):
+                BackupChunks.create(stored_filename=self.keyname, chunk_id=chunk_id)
+        self.lock.close()
+
+        log.info("{0} chunks, {1} new".format(len(self.recipe), self.new_chunks))
+
+    def abort(self):
+        self.pool.terminate()
+        self.lock.close()
+
+
+class DedupReader(object):
+    """File-like object rebuilding a deduplicated stream from its recipe.
+
+    Chunks are downloaded concurrently, a few chunks ahead.
+
+    :type storage_backend: S3Backend
+    :param storage_backend: Storage backend.
+
+    :type keyname: str
+    :param keyname: Recipe key name (stored filename).
+
+    :type password: str
+    :param password: Password, empty string if the backup is not encrypted.
+
+    """
+    def __init__(self, storage_backend, keyname, password="", codec=None, workers=DEFAULT_WORKERS):
+        self.storage_backend = storage_backend
+        self.password = password
+        codec = codec or get_codec("gzip")
+        recipe = json.loads(_unpack(storage_backend.download_string(keyname), codec, password))
+        self.codec = get_codec(recipe.get("compression", codec.name))
+        self.chunk_ids = deque(recipe["chunks"])
+        self.pool = ThreadPool(workers)
+        self.workers = workers
+        self.pending = deque()
+        self.buffer = ""
+
+    def _download_chunk(self, chunk_id):
+        data = self.storage_backend.download_string(CHUNKS_PREFIX + chunk_id)
+        return _unpack(data, self.codec, self.password)
+
+    def _next_chunk(self):
+        while self.chunk_ids and len(self.pending) < 2 * self.workers:
+            self.pending.append(self.pool.apply_async(self._download_chunk, (self.chunk_ids.popleft(),)))
+        if self.pending:
+            return self.pending.popleft().get()
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            chunks.append(chunk)
+            length += len(chunk)
+
+        data = "".join(chunks)
+        if size < 0:
+            self.buffer = ""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        self.pool.terminate()
+
+
+def collect_chunks(storage_backend):
+    """Delete chunks no longer referenced by any backup.
+
+    References from deleted backups are removed first, then every chunk
+    of the bucket without a reference is deleted (remotely and from the index).
+
+    Chunks are only collected if dedup_gc is set to true in the profile:
+    the chunks index is local, chunks referenced by the backups of another
+    host sharing the bucket would be deleted. Nothing is collected while
+    a dedup backup is running on this host (the chunks are collected by the next call).
+
+    :type storage_backend: S3Backend
+    :param storage_backend: Storage backend.
+
+    :rtype: list
+    :return: The deleted chunk ids.
+
+    """
+    if not storage_backend.conf.get("dedup_gc", False):
+        return []
+    lock = _lock_chunks(exclusive=True)
+    if lock is None:
+        log.info("Dedup backups in progress, unused chunks will be deleted next time")
+        return []
+    try:
+        return _collect_chunks(storage_backend)
+    finally:
+        lock.close()
+
+
+def _collect_chunks(storage_backend):
+    backend_hash = storage_backend.get_backend_hash()
+
+    deleted_backups = Backups.select(Backups.stored_filename).where(Backups.is_deleted == True)
+    BackupChunks.delete().where(BackupChunks.stored_filename << deleted_backups).execute()
+
+    referenced = BackupChunks.select(BackupChunks.chunk_id)
+    orphans = [chunk.chunk_id for chunk in Chunks.select().where(Chunks.backend_hash == backend_hash,
+                                                                  ~(Chunks.chunk_id << referenced))]
+    if orphans:
+        log.info("Deleting {0} chunks".format(len(orphans)))
+    deleted = [keyname[len(CHUNKS_PREFIX):] for keyname in
+               storage_backend.delete_many([CHUNKS_PREFIX + chunk_id for chunk_id in orphans])]
+
+    with database.transaction():
+        for chunk_id in deleted:
+            Chunks.delete().where(Chunks.chunk_id == chunk_id, Chunks.backend_hash == backend_hash).execute()
+
+    return deleted
@@ -0,0 +1,286 @@
+# -*- encoding: utf-8 -*-
+import hashlib
+import hmac
+import logging
+import os
+import struct
+import threading
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+log = logging.getLogger(__name__)
+
+# Encryption format versions recorded in the backup metadata,
+# backups without version are beefish (Blowfish-CBC) encrypted.
+BEEFISH_VERSION = 1
+CHUNKED_VERSION = 2
+
+MAGIC = "BAKTHAT"
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_ITERATIONS = 100000
+SALT_SIZE = 16
+TAG_SIZE = 32
+
+# magic, version, KDF iterations, salt, chunk size
+HEADER_FORMAT = ">7sBI16sI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+_keys = {}
+_keys_lock = threading.Lock()
+
+
+def derive_keys(password, salt, iterations):
+    """Derive the AES-256 key and the HMAC-SHA256 key from the password with PBKDF2-HMAC-SHA256.
+
+    Keys are cached, a backup opened several times (random access) is only derived once.
+
+    :rtype: tuple
+    :return: The encryption key and the authentication key.
+
+    """
+    with _keys_lock:
+        cache_key = (hashlib.sha256(password).digest(), salt, iterations)
+        if cache_key not in _keys:
+            derived = hashlib.pbkdf2_hmac("sha256", password, salt, iterations, 64)
+            _keys[cache_key] = (derived[:32], derived[32:])
+        return _keys[cache_key]
+
+
+class Header(object):
+    """Encrypted container header, holds the KDF parameters and the chunk size.
+
+    The container is the header followed by the chunks, each chunk is
+    encrypted with AES-256-CTR (the counter starts with the chunk index)
+    and followed by an HMAC-SHA256 of the header, the chunk index,
+    a last chunk flag and the encrypted chunk (encrypt-then-MAC).
+
+    """
+    def __init__(self, salt=None, iterations=DEFAULT_ITERATIONS, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.salt = salt or os.urandom(SALT_SIZE)
+        self.iterations = iterations
+        self.chunk_size = chunk_size
+
+    def pack(self):
+        return struct.pack(HEADER_FORMAT, MAGIC, CHUNKED_VERSION, self.iterations, self.salt, self.chunk_size)
+
+    @classmethod
+    def unpack(cls, data):
+        if len(data) < HEADER_SIZE:
+            raise Exception("Truncated encryption header.")
+        magic, version, iterations, salt, chunk_size = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+        if magic != MAGIC or version != CHUNKED_VERSION:
+            raise Exception("Unknown encryption format.")
+        return cls(salt, iterations, chunk_size)
+
+    def record_offset(self, index):
+        """Return the offset of the given chunk in the container."""
+        return HEADER_SIZE + index * (self.chunk_size + TAG_SIZE)
+
+
+def _cipher(key, index):
+    return AES.new(key, AES.MODE_CTR, counter=Counter.new(64, prefix=struct.pack(">Q", index)))
+
+
+def _tag(key, header, index, last, data):
+    return hmac.new(key, header + struct.pack(">Q?", index, last) + data, hashlib.sha256).digest()
+
+
+def encrypt_chunk(keys, header, index, last, data):
+    """Return the encrypted chunk followed by its tag."""
+    encrypted = _cipher(keys[0], index).encrypt(data)
+    return encrypted + _tag(keys[1], header, index, last, encrypted)
+
+
+def decrypt_chunk(keys, header, index, last, record):
+    """Check the tag of an encrypted chunk and return the decrypted chunk.
+
+    :type last: bool
+    :param last: True if the chunk is the last one, None if unknown (both are accepted).
+
+    """
+    encrypted, tag = record[:-TAG_SIZE], record[-TAG_SIZE:]
+    flags = [False, True] if last is None else [last]
+    if len(record) < TAG_SIZE or not any(hmac.compare_digest(_tag(keys[1], header, index, flag, encrypted), tag)
+                                         for flag in flags):
+        raise Exception("Authentication failed for chunk {0}, wrong password or corrupted data.".format(index))
+    return _cipher(keys[0], index).decrypt(encrypted)
+
+
+class ChunkEncryptWriter(object):
+    """File-like object encrypting everything written to it into fileobj,
+    chunks are encrypted and authenticated independently in a thread pool.
+
+    The last chunk is held back until close, so it can be flagged as the last one
+    (a truncated container is detected).
+
+    :type fileobj: file
+    :param fileobj: Writable file-like object receiving the container.
+
+    :type password: str
+    :param password: Password.
+
+    :type salt: str
+    :param salt: KDF salt, random if None (the same salt and password give the same output).
+
+    :type workers: int
+    :param workers: Number of chunks encrypted concurrently, number of CPUs by default.
+
+    :type pool: ThreadPool
+    :param pool: Thread pool encrypting the chunks (the backend worker pool),
+        a pool of workers threads is created (and terminated on close) if None.
+
+    """
+    def __init__(self, fileobj, password, salt=None, iterations=DEFAULT_ITERATIONS,
+                 chunk_size=DEFAULT_CHUNK_SIZE, workers=None, pool=None):
+        self.fileobj = fileobj
+        self.header = Header(salt, iterations, chunk_size)
+        self.packed_header = self.header.pack()
+        self.keys = derive_keys(password, self.header.salt, iterations)
+        self.chunk_size = chunk_size
+        self.workers = int(workers or cpu_count())
+        self.own_pool = pool is None
+        self.pool = ThreadPool(self.workers) if self.own_pool else pool
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        self.index = 0
+        self.fileobj.write(self.packed_header)
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered > self.chunk_size:
+            data = "".join(self.buffer)
+            offset = 0
+            while len(data) - offset > self.chunk_size:
+                self._submit(data[offset:offset + self.chunk_size], False)
+                offset += self.chunk_size
+            self.buffer = [data[offset:]]
+            self.buffered = len(data) - offset
+
+    def _submit(self, data, last):
+        self.pending.append(self.pool.apply_async(encrypt_chunk,
+                                                  (self.keys, self.packed_header, self.index, last, data)))
+        self.index += 1
+        while len(self.pending) > 2 * self.workers:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        self._submit("".join(self.buffer), True)
+        self.buffer = []
+        self.buffered = 0
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().get())
+        if self.own_pool:
+            self.pool.close()
+            self.pool.join()
+
+    def abort(self):
+        self.pending.clear()
+        if self.own_pool:
+            self.pool.terminate()
+
+
+class ChunkDecryptReader(object):
+    """File-like object decrypting a container on the fly,
+    chunks are authenticated and decrypted in a thread pool, a few chunks ahead.
+
+    To read from the middle of the container, give the header and the index
+    of the first chunk, fileobj starting at this chunk.
+
+    :type fileobj: file
+    :param fileobj: Readable file-like object.
+
+    :type password: str
+    :param password: Password.
+
+    :type header: Header
+    :param header: Container header, read from fileobj if None.
+
+    :type first_chunk: int
+    :param first_chunk: Index of the first chunk of fileobj.
+
+    :type partial: bool
+    :param partial: fileobj may stop before the end of the container,
+        the last chunk read isn't required to be the last one.
+
+    :type workers: int
+    :param workers: Number of chunks decrypted ahead, number of CPUs by default.
+
+    :type pool: ThreadPool
+    :param pool: Thread pool decrypting the chunks (the backend worker pool),
+        a pool of workers threads is created (and terminated on close) if None.
+
+    """
+    def __init__(self, fileobj, password, header=None, first_chunk=0, partial=False, workers=None, pool=None):
+        self.fileobj = fileobj
+        if header is None:
+            header = Header.unpack(fileobj.read(HEADER_SIZE))
+        self.header = header
+        self.packed_header = header.pack()
+        self.keys = derive_keys(password, header.salt, header.iterations)
+        self.record_size = header.chunk_size + TAG_SIZE
+        self.index = first_chunk
+        self.partial = partial
+        self.workers = int(workers or cpu_count())
+        self.next_record = self._read_record()
+        if not self.next_record and not partial:
+            raise Exception("Truncated encrypted data.")
+        self.own_pool = pool is None
+        self.pool = ThreadPool(self.workers) if self.own_pool else pool
+        self.pending = deque()
+        self.buffer = ""
+        self.eof = False
+
+    def _read_record(self):
+        chunks = []
+        length = 0
+        while length < self.record_size:
+            data = self.fileobj.read(self.record_size - length)
+            if not data:
+                break
+            chunks.append(data)
+            length += len(data)
+        return "".join(chunks)
+
+    def _fill(self):
+        while self.next_record and len(self.pending) < 2 * self.workers:
+            record = self.next_record
+            self.next_record = self._read_record()
+            last = not self.next_record
+            if last and self.partial:
+                last = None
+            self.pending.append(self.pool.apply_async(decrypt_chunk,
+                                                      (self.keys, self.packed_header, self.index, last, record)))
+            self.index += 1
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while (size < 0 or length < size) and not self.eof:
+            self._fill()
+            if not self.pending:
+                self.eof = True
+                break
+            data = self.pending.popleft().get()
+            chunks.append(data)
+            length += len(data)
+
+        data = "".join(chunks)
+        if size < 0:
+            self.buffer = ""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        """Drop the chunks decrypted ahead and close fileobj."""
+        self.pending.clear()
+        if self.own_pool:
+            self.pool.terminate()
+        if hasattr(self.fileobj, "close"):
+            self.fileobj.close()
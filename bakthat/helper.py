@@ -5,10 +5,8 @@ import sh
 import os
 import shutil
 import time
-import hashlib
 import json
 from StringIO import StringIO
-from gzip import GzipFile
 
 from beefish import encrypt, decrypt
 from boto.s3.key import Key
@@ -17,6 +15,7 @@ import bakthat
 from bakthat.conf import DEFAULT_DESTINATION
 from bakthat.backends import S3Backend
 from bakthat.models import Backups
+from bakthat.compression import get_codec, parse_compression
 
 log = logging.getLogger(__name__)
 
@@ -41,8 +40,12 @@ class KeyValue(S3Backend):
         :param value: Value to save, will be json encoded.
 
         :type value: bool
-        :keyword compress: Compress content with gzip,
+        :keyword compress: Compress content,
             True by default
+
+        :type compression: str
+        :keyword compression: Compression codec (gzip|zstd|lz4|xz) with an optional level (like zstd:3),
+            gzip by default
         """
         k = Key(self.bucket)
         k.key = keyname
@@ -57,17 +60,17 @@ class KeyValue(S3Backend):
                       tags="",
                       metadata={"KeyValue": True,
                                 "is_enc": False,
-                                "is_gzipped": False})
+                                "is_gzipped": False,
+                                "compression": None})
 
         fileobj = StringIO(json.dumps(value))
 
         if kwargs.get("compress", True):
-            backup["metadata"]["is_gzipped"] = True
-            out = StringIO()
-            f = GzipFile(fileobj=out, mode="w")
-            f.write(fileobj.getvalue())
-            f.close()
-            fileobj = StringIO(out.getvalue())
+            codec_name, level = parse_compression(kwargs.get("compression", "gzip"))
+            codec = get_codec(codec_name)
+            backup["metadata"]["is_gzipped"] = codec.name == "gzip"
+            backup["metadata"]["compression"] = codec.name
+            fileobj = StringIO(codec.compress(fileobj.getvalue(), level))
 
         password = kwargs.get("password")
         if password:
@@ -80,9 +83,7 @@ class KeyValue(S3Backend):
         k.set_acl("private")
         backup["size"] = k.size
 
-        access_key = self.conf.get("access_key")
-        container_key = self.conf.get(self.container_key)
-        backup["backend_hash"] = hashlib.sha512(access_key + container_key).hexdigest()
+        backup["backend_hash"] = self.get_backend_hash()
         Backups.upsert(**backup)
 
     def get_key(self, keyname, **kwargs):
@@ -109,11 +110,9 @@ class KeyValue(S3Backend):
                 fileobj = out
                 fileobj.seek(0)
 
-            if backup.is_gzipped():
-                f = GzipFile(fileobj=fileobj, mode="r")
-                out = f.read()
-                f.close()
-                fileobj = StringIO(out)
+            compression = backup.get_compression()
+            if compression:
+                fileobj = StringIO(get_codec(compression).decompress(fileobj.getvalue()))
             return json.loads(fileobj.getvalue())
         return kwargs.get("default")
 
@@ -0,0 +1,82 @@
+# -*- encoding: utf-8 -*-
+import os
+import stat
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def scan(filename, arcname):
+    """Walk filename, yield (path, archive name, lstat result) for each entry.
+
+    Symbolic links are not followed.
+
+    :type filename: str
+    :param filename: File/directory to walk.
+
+    :type arcname: str
+    :param arcname: Archive name of filename.
+
+    """
+    yield filename, arcname, os.lstat(filename)
+    if not os.path.isdir(filename) or os.path.islink(filename):
+        return
+
+    for root, dirs, files in os.walk(filename):
+        relroot = os.path.relpath(root, filename)
+        archive_root = arcname if relroot == "." else os.path.join(arcname, relroot)
+        for name in sorted(dirs) + sorted(files):
+            path = os.path.join(root, name)
+            yield path, os.path.join(archive_root, name), os.lstat(path)
+
+
+def add_changed(tar, filename, arcname, previous):
+    """Add to tar the files changed since the previous manifest.
+
+    A file is changed if its size, mtime or inode differ, or if it's not
+    in the previous manifest, directories are always added (without their content).
+
+    :type tar: tarfile.TarFile
+    :param tar: Archive opened for writing.
+
+    :type filename: str
+    :param filename: File/directory to backup.
+
+    :type arcname: str
+    :param arcname: Archive name of filename.
+
+    :type previous: dict
+    :param previous: Previous manifest, archive name => (size, mtime, inode).
+
+    :rtype: tuple
+    :return: The new manifest (for every file, changed or not) and the number of changed files.
+
+    """
+    manifest = {}
+    changed = 0
+    for path, name, st in scan(filename, arcname):
+        entry = (st.st_size, int(st.st_mtime), st.st_ino)
+        manifest[name] = entry
+        if stat.S_ISDIR(st.st_mode):
+            tar.add(path, arcname=name, recursive=False)
+        elif tuple(previous.get(name, ())) != entry:
+            tar.add(path, arcname=name, recursive=False)
+            changed += 1
+    return manifest, changed
+
+
+def prune(removed):
+    """Remove the files deleted between the base backup and the restored backup.
+
+    :type removed: iterable
+    :param removed: Archive names (relative to the current working directory).
+
+    """
+    # Deepest paths first, so directories are empty when removed
+    for name in sorted(removed, reverse=True):
+        if os.path.islink(name) or os.path.isfile(name):
+            log.debug("Removing {0}".format(name))
+            os.remove(name)
+        elif os.path.isdir(name) and not os.listdir(name):
+            log.debug("Removing {0}".format(name))
+            os.rmdir(name)
@@ -0,0 +1,128 @@
+# -*- encoding: utf-8 -*-
+import logging
+import tarfile
+import zlib
+
+from Crypto.Cipher import Blowfish
+
+from bakthat.compression import DecompressorReader, is_compressed, MAGIC_SIZE
+from bakthat.encryption import ChunkDecryptReader, Header, HEADER_SIZE, CHUNKED_VERSION
+from bakthat.models import Members, Frames
+from bakthat.stream import DecryptReader, SliceReader
+
+log = logging.getLogger(__name__)
+
+
+class IndexedTarFile(tarfile.TarFile):
+    """TarFile recording the offset and length of each member
+    (including extended headers and padding) as they are added.
+
+    members_index is a list of (path, offset, length, size).
+
+    With a compressor (a ParallelGzipWriter or a CompressorWriter), members already compressed
+    (detected with their magic number) are marked as incompressible.
+    """
+    def __init__(self, *args, **kwargs):
+        self.members_index = []
+        self.compressor = kwargs.pop("compressor", None)
+        tarfile.TarFile.__init__(self, *args, **kwargs)
+
+    def addfile(self, tarinfo, fileobj=None):
+        offset = self.offset
+        if self.compressor is not None and fileobj is not None and tarinfo.isreg():
+            position = fileobj.tell()
+            header = fileobj.read(MAGIC_SIZE)
+            fileobj.seek(position)
+            if is_compressed(header):
+                length = len(tarinfo.tobuf(self.format, self.encoding, self.errors)) + tarinfo.size
+                self.compressor.incompressible(offset, offset + length)
+        tarfile.TarFile.addfile(self, tarinfo, fileobj)
+        self.members_index.append((tarinfo.name, offset, self.offset - offset, tarinfo.size))
+
+
+def member_spans(members):
+    """Merge adjacent members in (start, end) spans of the uncompressed tar stream."""
+    spans = []
+    for member in members:
+        if spans and spans[-1][1] == member.offset:
+            spans[-1][1] = member.offset + member.length
+        else:
+            spans.append([member.offset, member.offset + member.length])
+    return spans
+
+
+def open_span(storage_backend, backup, start, end, password=""):
+    """Return a file-like object reading the uncompressed tar stream
+    of a seekable backup from start to end, only the needed frames are downloaded
+    (closing it closes the download).
+
+    :type storage_backend: S3Backend
+    :param storage_backend: Storage backend.
+
+    :type backup: Backups
+    :param backup: Backup with a member index.
+
+    :type start: int
+    :param start: Offset in the uncompressed tar stream.
+
+    :type end: int
+    :param end: Offset following the last byte to read.
+
+    :type password: str
+    :param password: Password if the backup is encrypted.
+
+    """
+    first, following = Frames.locate(backup.stored_filename, start, end)
+    cstart, cend = first.compressed_offset, following.compressed_offset
+
+    if backup.is_encrypted() and backup.get_encryption_version() == CHUNKED_VERSION:
+        # Only the header and the chunks holding the needed frames are downloaded
+        header_download = storage_backend.open_download(backup.stored_filename, 0, HEADER_SIZE)
+        try:
+            header = Header.unpack(header_download.read(HEADER_SIZE))
+        finally:
+            header_download.close()
+        first_chunk = cstart // header.chunk_size
+        last_chunk = (cend - 1) // header.chunk_size
+        download = storage_backend.open_download(backup.stored_filename,
+                                                 header.record_offset(first_chunk),
+                                                 min(header.record_offset(last_chunk + 1), backup.size))
+        out = ChunkDecryptReader(download, password, header, first_chunk, partial=True,
+                                 pool=storage_backend.worker_pool())
+        out = SliceReader(out, cstart - first_chunk * header.chunk_size, cend - cstart)
+    elif backup.is_encrypted():
+        # The encrypted data starts with the IV, block n is preceded by the block n - 1
+        block_size = Blowfish.block_size
+        first_block = cstart // block_size
+        last_block = (cend - 1) // block_size
+        download = storage_backend.open_download(backup.stored_filename,
+                                                 first_block * block_size,
+                                                 (last_block + 2) * block_size)
+        out = DecryptReader(download, password, padding=False)
+        out = SliceReader(out, cstart - first_block * block_size, cend - cstart)
+    else:
+        out = storage_backend.open_download(backup.stored_filename, cstart, cend)
+
+    out = DecompressorReader(out, lambda: zlib.decompressobj(-zlib.MAX_WBITS))
+    return SliceReader(out, start - first.offset, end - start)
+
+
+def restore_path(storage_backend, backup, path, password=""):
+    """Extract the given path (file or directory) of a seekable backup
+    in the current working directory.
+
+    :rtype: int
+    :return: The number of extracted members.
+
+    """
+    members = list(Members.search(backup.stored_filename, path))
+    for start, end in member_spans(members):
+        log.info("Downloading {0} bytes of {1}...".format(end - start, backup.stored_filename))
+        out = open_span(storage_backend, backup, start, end, password)
+        try:
+            tar = tarfile.open(fileobj=out, mode="r|")
+            tar.extractall()
+            tar.close()
+        finally:
+            out.close()
+    return len(members)
@@ -0,0 +1,484 @@
+# -*- encoding: utf-8 -*-
+import calendar
+import gzip
+import itertools
+import json
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import peewee
+
+from bakthat.models import database, Backups, Config, Inventory, InventoryChanges
+
+log = logging.getLogger(__name__)
+
+# Size of the blocks read from the inventory JSON document.
+CHUNK_SIZE = 1024 * 1024
+
+# Number of rows inserted/deleted per statement.
+BATCH_SIZE = 500
+
+# Archives missing from the inventory but uploaded less than a day before
+# the inventory date are kept (the vault inventory is updated once a day).
+INVENTORY_GRACE = 86400
+
+STORED_FILENAME_REGEX = re.compile(r"(?P<backup_name>.+?)\.?\d{14}(\.\d+)?\.")
+
+# A full snapshot of the inventory is pushed to the S3 inventory log every
+# SNAPSHOT_INTERVAL deltas (or once the deltas hold more rows than the snapshot).
+SNAPSHOT_INTERVAL = 100
+
+SEGMENT_REGEX = re.compile(r"/(?P<kind>snapshot|delta)\.(?P<seq>\d+)\.jsonl\.gz$")
+
+
+class InventoryParser(object):
+    """Parse a Glacier vault inventory JSON document incrementally,
+    the ArchiveList items are decoded one by one, without loading
+    the whole document in memory.
+
+    The other keys (VaultARN, InventoryDate) are available in header
+    once the document is parsed.
+
+    :type fileobj: file
+    :param fileobj: Readable file-like object.
+
+    """
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.header = {}
+
+    def _fill(self):
+        data = self.fileobj.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Skip whitespaces and return the next character."""
+        while 1:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of the inventory.")
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError("Invalid inventory, expected {0} got {1}.".format(chars, char))
+        self.pos += 1
+        return char
+
+    def _decode(self):
+        """Decode the next value, reading more data until it's complete."""
+        self._peek()
+        while 1:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer may continue in the next block
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def __iter__(self):
+        """Yield the archives (dicts with ArchiveId, ArchiveDescription,
+        CreationDate, Size and SHA256TreeHash)."""
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while 1:
+            key = self._decode()
+            self._expect(":")
+            if key == "ArchiveList":
+                self._expect("[")
+                if self._peek() == "]":
+                    self.pos += 1
+                else:
+                    while 1:
+                        yield self._decode()
+                        if self._expect(",]") == "]":
+                            break
+            else:
+                self.header[key] = self._decode()
+            if self._expect(",}") == "}":
+                return
+
+
+def _parse_date(date_string):
+    """Convert an ISO 8601 UTC date (like 2013-03-20T17:03:43Z) to a timestamp."""
+    return calendar.timegm(datetime.strptime(date_string[:19], "%Y-%m-%dT%H:%M:%S").timetuple())
+
+
+def _merge(left, right):
+    """Sorted merge of two iterators of tuples sorted by their first item,
+    yield (left item, right item) pairs, None on the side missing the key."""
+    left, right = iter(left), iter(right)
+    l, r = next(left, None), next(right, None)
+    while l is not None or r is not None:
+        if r is None or (l is not None and l[0] < r[0]):
+            yield l, None
+            l = next(left, None)
+        elif l is None or r[0] < l[0]:
+            yield None, r
+            r = next(right, None)
+        else:
+            yield l, r
+            l, r = next(left, None), next(right, None)
+
+
+class _Batch(object):
+    """Accumulate rows and flush them batch_size at a time."""
+    def __init__(self, flush, batch_size=BATCH_SIZE):
+        self.flush_rows = flush
+        self.batch_size = batch_size
+        self.rows = []
+        self.count = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            with database.transaction():
+                self.flush_rows(self.rows)
+            self.count += len(self.rows)
+            self.rows = []
+
+
+def sync_inventory(storage_backend, fileobj, batch_size=BATCH_SIZE):
+    """Reconcile the local Inventory and Backups tables with a vault inventory.
+
+    The inventory is parsed incrementally and staged in a temporary SQLite
+    database along with the local catalog, both sides are then compared
+    with a sorted merge, and the changes are applied in batched transactions:
+    archives missing locally are added to the Inventory (and a backup is created
+    if there is none), archives missing from the vault are removed from the
+    Inventory and their backups are marked as deleted (unless they were uploaded
+    less than INVENTORY_GRACE seconds before the inventory date).
+
+    :type storage_backend: GlacierBackend
+    :param storage_backend: Glacier backend.
+
+    :type fileobj: file
+    :param fileobj: Readable file-like object (the inventory job output).
+
+    :rtype: dict
+    :return: The number of archives in the vault, and of inventory entries/backups
+        added (inserted, backups_created) and removed (deleted, backups_deleted).
+
+    """
+    fd, staging_path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    staging = sqlite3.connect(staging_path)
+    try:
+        staging.execute("CREATE TABLE vault (filename TEXT, archive_id TEXT, size INTEGER, "
+                        "creation_date INTEGER, tree_hash TEXT)")
+        staging.execute("CREATE TABLE inventory (filename TEXT, archive_id TEXT)")
+        staging.execute("CREATE TABLE backups (stored_filename TEXT, backup_date INTEGER, is_deleted INTEGER)")
+
+        parser = InventoryParser(fileobj)
+        rows = []
+        archives = 0
+        for archive in parser:
+            rows.append((archive.get("ArchiveDescription") or "", archive["ArchiveId"], archive.get("Size", 0),
+                         _parse_date(archive["CreationDate"]), archive.get("SHA256TreeHash")))
+            archives += 1
+            if len(rows) >= batch_size:
+                staging.executemany("INSERT INTO vault VALUES (?, ?, ?, ?, ?)", rows)
+                rows = []
+        staging.executemany("INSERT INTO vault VALUES (?, ?, ?, ?, ?)", rows)
+        log.info("{0} archives in the vault inventory".format(archives))
+
+        inventory_date = _parse_date(parser.header["InventoryDate"]) if "InventoryDate" in parser.header \
+            else int(time.time())
+        keep_after = inventory_date - INVENTORY_GRACE
+
+        # Local catalog snapshot, the merges read the staging database only
+        # while the changes are written to the catalog.
+        query = Inventory.select(Inventory.filename, Inventory.archive_id).tuples()
+        staging.executemany("INSERT INTO inventory VALUES (?, ?)", query.iterator())
+        query = Backups.select(Backups.stored_filename, Backups.backup_date, Backups.is_deleted).where(
+            Backups.backend == storage_backend.name,
+            Backups.backend_hash == storage_backend.get_backend_hash()).tuples()
+        staging.executemany("INSERT INTO backups VALUES (?, ?, ?)", query.iterator())
+        staging.execute("CREATE INDEX backups_stored_filename ON backups (stored_filename)")
+        staging.commit()
+
+        def insert_archives(rows):
+            Inventory.delete().where(Inventory.archive_id << [row["archive_id"] for row in rows]).execute()
+            Inventory.insert_many(rows).execute()
+            InventoryChanges.record([(row["filename"], row["archive_id"]) for row in rows])
+
+        def delete_archives(rows):
+            Inventory.delete().where(Inventory.archive_id << [archive_id for filename, archive_id in rows]).execute()
+            InventoryChanges.record(rows, is_deleted=True)
+
+        inserted = _Batch(insert_archives, batch_size)
+        deleted = _Batch(delete_archives, batch_size)
+        vault = staging.execute("SELECT filename || '/' || archive_id, filename, archive_id FROM vault "
+                                "ORDER BY filename || '/' || archive_id")
+        local = staging.cursor().execute(
+            "SELECT i.filename || '/' || i.archive_id, i.archive_id, b.backup_date, i.filename FROM inventory i "
+            "LEFT JOIN backups b ON b.stored_filename = i.filename ORDER BY i.filename || '/' || i.archive_id")
+        for vault_archive, local_archive in _merge(vault, local):
+            if local_archive is None:
+                inserted.add(dict(filename=vault_archive[1], archive_id=vault_archive[2]))
+            elif vault_archive is None and (local_archive[2] is None or local_archive[2] < keep_after):
+                deleted.add((local_archive[3], local_archive[1]))
+        deleted.flush()
+        inserted.flush()
+
+        now = int(time.time())
+        backend_hash = storage_backend.get_backend_hash()
+
+        def create_backups(rows):
+            Backups.insert_many(rows).execute()
+
+        backups_created = _Batch(create_backups, batch_size)
+        backups_deleted = _Batch(Backups.set_deleted_many, batch_size)
+        # The latest archive of each stored filename
+        vault = staging.execute("SELECT filename, MAX(creation_date), size, tree_hash FROM vault "
+                                "WHERE filename != '' GROUP BY filename ORDER BY filename")
+        local = staging.cursor().execute("SELECT stored_filename, backup_date, is_deleted FROM backups "
+                                         "ORDER BY stored_filename")
+        for vault_backup, local_backup in _merge(vault, local):
+            if local_backup is None:
+                stored_filename, creation_date, size, tree_hash = vault_backup
+                match = STORED_FILENAME_REGEX.match(stored_filename)
+                backups_created.add(dict(backend=storage_backend.name,
+                                         backend_hash=backend_hash,
+                                         backup_date=creation_date,
+                                         filename=match.group("backup_name") if match else stored_filename,
+                                         is_deleted=False,
+                                         last_updated=now,
+                                         metadata=dict(checksums=dict(tree_hash=tree_hash), inventory=True),
+                                         size=size,
+                                         stored_filename=stored_filename,
+                                         tags=""))
+            elif vault_backup is None and not local_backup[2] and local_backup[1] < keep_after:
+                backups_deleted.add(local_backup[0])
+        backups_deleted.flush()
+        backups_created.flush()
+    finally:
+        staging.close()
+        os.remove(staging_path)
+
+    stats = dict(archives=archives, inserted=inserted.count, deleted=deleted.count,
+                 backups_created=backups_created.count, backups_deleted=backups_deleted.count)
+    log.info("Inventory synced: {inserted} archives added, {deleted} removed, "
+             "{backups_created} backups created, {backups_deleted} marked as deleted".format(**stats))
+    return stats
+
+
+class InventoryLog(object):
+    """Compressed, append-only log of the Inventory on S3.
+
+    The log is made of full snapshots and of delta segments holding the rows
+    added/removed (recorded in InventoryChanges) since the previous segment,
+    stored as gzipped JSON lines under the prefix/ keys:
+    [filename, archive_id] lines in snapshots, ["+" or "-", filename, archive_id] in deltas.
+    Segments are ordered by their sequence number (a timestamp in ms), the inventory
+    is the latest snapshot with the deltas after it applied.
+
+    :type bucket: boto.s3.bucket.Bucket
+    :param bucket: S3 bucket.
+
+    :type prefix: str
+    :param prefix: Prefix of the segments keys.
+
+    """
+    push_lock = threading.Lock()
+
+    def __init__(self, bucket, prefix, snapshot_interval=SNAPSHOT_INTERVAL, batch_size=BATCH_SIZE):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.snapshot_interval = snapshot_interval
+        self.batch_size = batch_size
+        # State of the log as of the last push/restore (snapshot key, number of rows and deltas)
+        self.state_key = "inventory_log:{0}/{1}".format(bucket.name, prefix)
+
+    def _list(self):
+        for key in self.bucket.list(prefix=self.prefix + "/"):
+            match = SEGMENT_REGEX.search(key.name)
+            if match:
+                yield int(match.group("seq")), match.group("kind"), key.name
+
+    def segments(self):
+        """Return the segments to read, the latest snapshot followed by the deltas after it.
+
+        :rtype: list
+        :return: (seq, kind, key name) tuples, empty if there is no snapshot.
+
+        """
+        segments = sorted(self._list())
+        snapshots = [i for i, segment in enumerate(segments) if segment[1] == "snapshot"]
+        if not snapshots:
+            return []
+        return segments[snapshots[-1]:]
+
+    def _write(self, kind, seq, lines):
+        key_name = "{0}/{1}.{2:013d}.jsonl.gz".format(self.prefix, kind, seq)
+        count = 0
+        with tempfile.TemporaryFile() as tmp:
+            gz = gzip.GzipFile(fileobj=tmp, mode="wb")
+            for line in lines:
+                gz.write(json.dumps(line) + "\n")
+                count += 1
+            gz.close()
+            tmp.seek(0)
+            self.bucket.new_key(key_name).set_contents_from_file(tmp, policy="private")
+        log.info("{0} rows pushed to {1}".format(count, key_name))
+        return key_name, count
+
+    def _read(self, key_name):
+        with tempfile.TemporaryFile() as tmp:
+            self.bucket.new_key(key_name).get_contents_to_file(tmp)
+            tmp.seek(0)
+            for line in gzip.GzipFile(fileobj=tmp, mode="rb"):
+                yield json.loads(line)
+
+    def push(self, snapshot=False):
+        """Push the changes recorded since the last push as a delta segment,
+        or a full snapshot (for the first push, every snapshot_interval deltas,
+        or once the deltas hold more rows than the snapshot), the segments
+        older than a new snapshot are removed.
+
+        :type snapshot: bool
+        :param snapshot: Push a full snapshot.
+
+        :rtype: str
+        :return: The key of the new segment, None if there was nothing to push.
+
+        """
+        with self.push_lock:
+            state = Config.get_key(self.state_key) or {}
+            last_change = InventoryChanges.select(peewee.fn.Max(InventoryChanges.id)).scalar()
+            snapshot = snapshot or not state.get("snapshot") or state["deltas"] >= self.snapshot_interval \
+                or state["delta_rows"] > state["snapshot_rows"]
+            if last_change is None and not snapshot:
+                return
+
+            seq = max(int(time.time() * 1000), state.get("seq", 0) + 1)
+            if snapshot:
+                rows = Inventory.select(Inventory.filename, Inventory.archive_id).tuples().iterator()
+                key_name, count = self._write("snapshot", seq, rows)
+                state = dict(snapshot=key_name, snapshot_rows=count, deltas=0, delta_rows=0)
+            else:
+                changes = InventoryChanges.select(InventoryChanges.is_deleted, InventoryChanges.filename,
+                                                  InventoryChanges.archive_id).where(
+                    InventoryChanges.id <= last_change).order_by(InventoryChanges.id).tuples()
+                key_name, count = self._write("delta", seq, (["-" if is_deleted else "+", filename, archive_id]
+                                                             for is_deleted, filename, archive_id in changes.iterator()))
+                state.update(deltas=state["deltas"] + 1, delta_rows=state["delta_rows"] + count)
+            state["seq"] = seq
+
+            with database.transaction():
+                if last_change is not None:
+                    InventoryChanges.delete().where(InventoryChanges.id <= last_change).execute()
+                Config.set_key(self.state_key, state)
+
+            if snapshot:
+                outdated = [name for segment_seq, kind, name in self._list() if segment_seq < seq]
+                if outdated:
+                    self.bucket.delete_keys(outdated)
+            return key_name
+
+    def load(self):
+        """Return the inventory stored in the log.
+
+        :rtype: list
+        :return: A list of dict with filename and archive_id, None if the log is empty.
+
+        """
+        segments = self.segments()
+        if not segments:
+            return
+        archives = dict((archive_id, filename) for filename, archive_id in self._read(segments[0][2]))
+        for seq, kind, key_name in segments[1:]:
+            for op, filename, archive_id in self._read(key_name):
+                if op == "+":
+                    archives[archive_id] = filename
+                else:
+                    archives.pop(archive_id, None)
+        return [dict(filename=filename, archive_id=archive_id) for archive_id, filename in archives.items()]
+
+    def replace(self, rows, changes=()):
+        """Replace the Inventory table with rows, then apply changes
+        (in a single transaction, rows are inserted batch_size at a time).
+
+        The local changes not pushed yet (recorded in InventoryChanges,
+        e.g. an upload whose push failed) are applied last, and kept to be pushed.
+
+        :type rows: iterable
+        :param rows: (filename, archive_id) tuples.
+
+        :type changes: iterable
+        :param changes: ("+" or "-", filename, archive_id) tuples.
+
+        :rtype: int
+        :return: The number of rows in the Inventory.
+
+        """
+        with database.transaction():
+            Inventory.delete().execute()
+            batch = []
+            for filename, archive_id in rows:
+                batch.append(dict(filename=filename, archive_id=archive_id))
+                if len(batch) >= self.batch_size:
+                    Inventory.insert_many(batch).execute()
+                    batch = []
+            if batch:
+                Inventory.insert_many(batch).execute()
+            pending = InventoryChanges.select(InventoryChanges.is_deleted, InventoryChanges.filename,
+                                              InventoryChanges.archive_id).order_by(InventoryChanges.id).tuples()
+            pending = [("-" if is_deleted else "+", filename, archive_id)
+                       for is_deleted, filename, archive_id in pending]
+            for op, filename, archive_id in itertools.chain(changes, pending):
+                Inventory.delete().where(Inventory.archive_id == archive_id).execute()
+                if op == "+":
+                    Inventory.create(filename=filename, archive_id=archive_id)
+        return Inventory.select().count()
+
+    def restore(self):
+        """Restore the Inventory table from the latest snapshot and the deltas after it.
+
+        :rtype: int
+        :return: The number of rows in the Inventory, None if the log is empty.
+
+        """
+        with self.push_lock:
+            segments = self.segments()
+            if not segments:
+                return
+
+            def changes():
+                for seq, kind, key_name in segments[1:]:
+                    for change in self._read(key_name):
+                        yield change
+
+            count = self.replace(self._read(segments[0][2]), changes())
+            Config.set_key(self.state_key, dict(snapshot=segments[0][2], snapshot_rows=count,
+                                                deltas=len(segments) - 1, delta_rows=0, seq=segments[-1][0]))
+            log.info("{0} archives restored from {1} segments".format(count, len(segments)))
+            return count
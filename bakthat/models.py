@@ -6,7 +6,7 @@ import json
 import sqlite3
 import os
 
-database = peewee.SqliteDatabase(DATABASE)
+database = peewee.SqliteDatabase(DATABASE, threadlocals=True)
 
 
 class JsonField(peewee.CharField):
@@ -26,6 +26,13 @@ class BaseModel(peewee.Model):
         database = database
 
 
+def _insert_many(model, rows, batch_size=100):
+    """Insert rows (list of dict) by batches in a single transaction."""
+    with database.transaction():
+        for i in range(0, len(rows), batch_size):
+            model.insert_many(rows[i:i + batch_size]).execute()
+
+
 class Backups(BaseModel):
     """Backups Model."""
     backend = peewee.CharField(index=True)
@@ -107,13 +114,119 @@ class Backups(BaseModel):
         self.is_deleted = True
         self.last_updated = int(datetime.utcnow().strftime("%s"))
         self.save()
+        for model in [Manifest, Members, Frames]:
+            model.delete().where(model.stored_filename == self.stored_filename).execute()
+
+    @classmethod
+    def set_deleted_many(cls, stored_filenames, batch_size=500):
+        """Mark backups as deleted (and remove their manifest/index) in a single transaction.
+
+        :type stored_filenames: list
+        :param stored_filenames: Stored filenames of the deleted backups.
+
+        """
+        last_updated = int(datetime.utcnow().strftime("%s"))
+        with database.transaction():
+            for i in range(0, len(stored_filenames), batch_size):
+                batch = stored_filenames[i:i + batch_size]
+                Backups.update(is_deleted=True, last_updated=last_updated).where(Backups.stored_filename << batch).execute()
+                for model in [Manifest, Members, Frames]:
+                    model.delete().where(model.stored_filename << batch).execute()
+
+    @classmethod
+    def without_dependents(cls, backups):
+        """Split backups to delete between the deletable ones and the ones needed
+        by a live incremental backup which is not deleted along with them.
+
+        :type backups: list
+        :param backups: Backups to delete.
+
+        :rtype: tuple
+        :return: The deletable backups and the backups to keep.
+
+        """
+        candidates = dict((backup.stored_filename, backup) for backup in backups)
+        filenames = list(set(backup.filename for backup in backups))
+        needed = set()
+        for i in range(0, len(filenames), 500):
+            for backup in Backups.select().where(Backups.filename << filenames[i:i + 500],
+                                                 Backups.is_deleted == False):
+                parent = backup.metadata.get("parent")
+                if parent and backup.stored_filename not in candidates:
+                    needed.add(parent)
+        # A kept backup needs its own parent
+        keep = set()
+        while needed - keep:
+            name = (needed - keep).pop()
+            keep.add(name)
+            if name in candidates and candidates[name].metadata.get("parent"):
+                needed.add(candidates[name].metadata["parent"])
+        return ([backup for backup in backups if backup.stored_filename not in keep],
+                [backup for backup in backups if backup.stored_filename in keep])
+
+    def get_chain(self):
+        """Return the backups to restore for an incremental backup.
+
+        :rtype: list
+        :return: The base backup first, then each incremental backup up to this one.
+        """
+        chain = [self]
+        while chain[0].metadata.get("parent"):
+            parent = Backups.get(Backups.stored_filename == chain[0].metadata["parent"])
+            if parent.is_deleted:
+                raise Exception("{0} depends on {1} which is deleted.".format(self.stored_filename,
+                                                                             parent.stored_filename))
+            chain.insert(0, parent)
+        return chain
+
+    def has_dependents(self):
+        """Return True if a live incremental backup depends on this backup."""
+        q = Backups.select().where(Backups.filename == self.filename,
+                                   Backups.backend_hash == self.backend_hash,
+                                   Backups.is_deleted == False,
+                                   Backups.backup_date >= self.backup_date)
+        return any(backup.metadata.get("parent") == self.stored_filename for backup in q)
+
+    @classmethod
+    def get_last_incremental(cls, filename, backend_hash):
+        """Return the last backup of filename with a manifest, None if there is none.
+
+        :type filename: str
+        :param filename: Backup filename
+
+        :type backend_hash: str
+        :param backend_hash: Backend hash of the bucket/vault.
+
+        :rtype: Backups
+        :return: The last backup made in incremental mode.
+        """
+        q = Backups.select().where(Backups.filename == filename,
+                                   Backups.backend_hash == backend_hash,
+                                   Backups.is_deleted == False)
+        for backup in q.order_by(Backups.backup_date.desc()):
+            if backup.metadata.get("incremental"):
+                return backup
 
     def is_encrypted(self):
         return self.stored_filename.endswith(".enc") or self.metadata.get("is_enc")
 
+    def get_encryption_version(self):
+        """Return the encryption format version (see bakthat.encryption),
+        backups made before the version was recorded are beefish encrypted (version 1)."""
+        return self.metadata.get("encryption_version", 1)
+
     def is_gzipped(self):
         return self.metadata.get("is_gzipped")
 
+    def get_compression(self):
+        """Return the compression codec name, None if the backup is not compressed.
+
+        Backups made before the codec was recorded are gzipped.
+        """
+        if self.metadata.get("KeyValue"):
+            return self.metadata.get("compression", "gzip" if self.is_gzipped() else None)
+        return self.metadata.get("compression", "gzip")
+
     @classmethod
     def upsert(cls, **backup):
         q = Backups.select()
@@ -128,6 +241,120 @@ class Backups(BaseModel):
         db_table = 'backups'
 
 
+class Manifest(BaseModel):
+    """Files stored by incremental backups, used to find changed files."""
+    stored_filename = peewee.CharField(index=True)
+    path = peewee.TextField()
+    size = peewee.IntegerField()
+    mtime = peewee.IntegerField()
+    inode = peewee.IntegerField()
+
+    @classmethod
+    def load(cls, stored_filename):
+        """Load the manifest of a backup.
+
+        :type stored_filename: str
+        :param stored_filename: Stored filename
+
+        :rtype: dict
+        :return: path => (size, mtime, inode)
+        """
+        q = Manifest.select(Manifest.path, Manifest.size, Manifest.mtime, Manifest.inode)
+        q = q.where(Manifest.stored_filename == stored_filename)
+        return dict((path, (size, mtime, inode)) for path, size, mtime, inode in q.tuples())
+
+    @classmethod
+    def store(cls, stored_filename, manifest, batch_size=100):
+        """Store the manifest of a backup in a single transaction.
+
+        :type stored_filename: str
+        :param stored_filename: Stored filename
+
+        :type manifest: dict
+        :param manifest: path => (size, mtime, inode)
+        """
+        rows = [dict(stored_filename=stored_filename, path=path, size=size, mtime=mtime, inode=inode)
+                for path, (size, mtime, inode) in manifest.iteritems()]
+        _insert_many(Manifest, rows, batch_size)
+
+    class Meta:
+        db_table = 'manifest'
+
+
+class Members(BaseModel):
+    """Archive members of seekable backups, offset and length
+    (header and data) in the uncompressed tar stream."""
+    stored_filename = peewee.CharField(index=True)
+    path = peewee.TextField()
+    offset = peewee.IntegerField()
+    length = peewee.IntegerField()
+    size = peewee.IntegerField()
+
+    @classmethod
+    def store(cls, stored_filename, members, batch_size=100):
+        """Store the member index of a backup in a single transaction.
+
+        :type stored_filename: str
+        :param stored_filename: Stored filename
+
+        :type members: list
+        :param members: List of (path, offset, length, size)
+        """
+        rows = [dict(stored_filename=stored_filename, path=path, offset=offset, length=length, size=size)
+                for path, offset, length, size in members]
+        _insert_many(Members, rows, batch_size)
+
+    @classmethod
+    def search(cls, stored_filename, path=None):
+        """Return the members of a backup, the given path and its content if path is set."""
+        q = Members.select().where(Members.stored_filename == stored_filename)
+        if path:
+            path = path.strip("/")
+            q = q.where((Members.path == path) | (Members.path % "{0}/*".format(path)))
+        return q.order_by(Members.offset)
+
+    class Meta:
+        db_table = 'members'
+
+
+class Frames(BaseModel):
+    """Independently compressed frames of seekable backups, offset in the
+    uncompressed tar stream => offset in the compressed stream."""
+    stored_filename = peewee.CharField(index=True)
+    offset = peewee.IntegerField()
+    compressed_offset = peewee.IntegerField()
+
+    @classmethod
+    def store(cls, stored_filename, frames, batch_size=100):
+        """Store the frame index of a backup in a single transaction.
+
+        :type stored_filename: str
+        :param stored_filename: Stored filename
+
+        :type frames: list
+        :param frames: List of (offset, compressed_offset),
+            the last one marks the end of the compressed data.
+        """
+        rows = [dict(stored_filename=stored_filename, offset=offset, compressed_offset=compressed_offset)
+                for offset, compressed_offset in frames]
+        _insert_many(Frames, rows, batch_size)
+
+    @classmethod
+    def locate(cls, stored_filename, start, end):
+        """Return the frames covering the uncompressed range [start, end).
+
+        :rtype: tuple
+        :return: (first frame, frame following the range).
+        """
+        q = Frames.select().where(Frames.stored_filename == stored_filename)
+        first = q.where(Frames.offset <= start).order_by(Frames.offset.desc()).get()
+        following = q.where(Frames.offset >= end).order_by(Frames.offset).get()
+        return first, following
+
+    class Meta:
+        db_table = 'frames'
+
+
 class Config(BaseModel):
     """key => value config store."""
     key = peewee.CharField(index=True, unique=True)
@@ -165,6 +392,31 @@ class Inventory(BaseModel):
         db_table = 'inventory'
 
 
+class InventoryChanges(BaseModel):
+    """Inventory rows added/removed since the last push to the S3 inventory log."""
+    filename = peewee.CharField()
+    archive_id = peewee.CharField()
+    is_deleted = peewee.BooleanField(default=False)
+
+    @classmethod
+    def record(cls, rows, is_deleted=False):
+        """Record added (or removed) inventory rows.
+
+        :type rows: list
+        :param rows: (filename, archive_id) tuples.
+
+        :type is_deleted: bool
+        :param is_deleted: True if the rows were removed from the inventory.
+
+        """
+        for i in range(0, len(rows), 500):
+            InventoryChanges.insert_many([dict(filename=filename, archive_id=archive_id, is_deleted=is_deleted)
+                                          for filename, archive_id in rows[i:i + 500]]).execute()
+
+    class Meta:
+        db_table = 'inventory_changes'
+
+
 class Jobs(BaseModel):
     """filename => job_id mapping for glacier archives."""
     filename = peewee.CharField(index=True)
@@ -207,9 +459,167 @@ class Jobs(BaseModel):
         db_table = 'jobs'
 
 
-for table in [Backups, Jobs, Inventory, Config]:
-    if not table.table_exists():
-        table.create_table()
+class Uploads(BaseModel):
+    """State of the multipart uploads in progress, to resume interrupted backups.
+
+    parts is a dict part number => [offset, size, etag] (the MD5 for S3,
+    the tree hash for Glacier), metadata holds what is needed
+    to generate the same stream again (backup date used as gzip mtime,
+    hex encoded KDF salt of encrypted streams).
+    """
+    resume_key = peewee.CharField(index=True)
+    backend = peewee.CharField()
+    backend_hash = peewee.CharField(index=True)
+    stored_filename = peewee.TextField()
+    upload_id = peewee.TextField(null=True)
+    part_size = peewee.IntegerField()
+    created = peewee.IntegerField()
+    metadata = JsonField()
+    parts = JsonField()
+
+    @classmethod
+    def get_upload(cls, resume_key, backend, backend_hash):
+        """Try to retrieve an upload in progress.
+
+        :type resume_key: str
+        :param resume_key: Hash identifying the source and the backup options.
+
+        :type backend: str
+        :param backend: s3|glacier
+
+        :type backend_hash: str
+        :param backend_hash: Backend hash of the bucket/vault.
+
+        :rtype: Uploads
+        :return: The upload, None if there is none.
+        """
+        try:
+            return Uploads.get(Uploads.resume_key == resume_key,
+                               Uploads.backend == backend,
+                               Uploads.backend_hash == backend_hash)
+        except Uploads.DoesNotExist:
+            return
+
+    @classmethod
+    def stale(cls, backend, backend_hash, created_before):
+        """Return the uploads started before the given timestamp."""
+        return Uploads.select().where(Uploads.backend == backend,
+                                      Uploads.backend_hash == backend_hash,
+                                      Uploads.created < created_before)
+
+    def get_part(self, part_num):
+        """Return [offset, size, etag] for an uploaded part, None if not uploaded."""
+        return self.parts.get(str(part_num))
+
+    def can_replace_part(self, part_num):
+        """Return False if the part was uploaded and can't be uploaded again with another content:
+        with the same salt, a different content would be encrypted with the same keystream."""
+        return not (self.metadata.get("salt") and self.get_part(part_num))
+
+    def set_part(self, part_num, offset, size, etag):
+        """Record an uploaded part.
+
+        :type part_num: int
+        :param part_num: Part number (starting at 1).
+
+        :type offset: int
+        :param offset: Part offset in the uploaded stream.
+
+        :type size: int
+        :param size: Part size.
+
+        :type etag: str
+        :param etag: Part hash.
+        """
+        self.parts[str(part_num)] = [offset, size, etag]
+        self.save()
+
+    class Meta:
+        db_table = 'uploads'
+
+
+class Chunks(BaseModel):
+    """Index of the chunks stored by deduplicated backups."""
+    chunk_id = peewee.CharField(index=True)
+    backend_hash = peewee.CharField(index=True)
+    size = peewee.IntegerField()
+
+    @classmethod
+    def exists(cls, chunk_id, backend_hash):
+        """Check if a chunk is already stored.
+
+        :type chunk_id: str
+        :param chunk_id: Chunk id
+
+        :type backend_hash: str
+        :param backend_hash: Backend hash of the bucket.
+
+        :rtype: bool
+        :return: True if the chunk is stored in the bucket.
+        """
+        q = Chunks.select().where(Chunks.chunk_id == chunk_id, Chunks.backend_hash == backend_hash)
+        return bool(q.count())
+
+    class Meta:
+        db_table = 'chunks'
+
+
+class BackupChunks(BaseModel):
+    """stored_filename => chunk_id references for deduplicated backups."""
+    stored_filename = peewee.CharField(index=True)
+    chunk_id = peewee.CharField(index=True)
+
+    class Meta:
+        db_table = 'backup_chunks'
+
+
+class CacheEntries(BaseModel):
+    """Backups stored in the local cache, uploaded is False
+    until the background uploader sent it to the backend."""
+    stored_filename = peewee.TextField(index=True)
+    backend = peewee.CharField()
+    backend_hash = peewee.CharField(index=True)
+    path = peewee.TextField()
+    size = peewee.IntegerField()
+    last_access = peewee.IntegerField(index=True)
+    uploaded = peewee.BooleanField(default=False)
+    upload_started = peewee.IntegerField(default=0)
+
+    @classmethod
+    def get_entry(cls, stored_filename, backend, backend_hash):
+        """Return the cache entry of a backup, None if it's not cached."""
+        try:
+            return CacheEntries.get(CacheEntries.stored_filename == stored_filename,
+                                    CacheEntries.backend == backend,
+                                    CacheEntries.backend_hash == backend_hash)
+        except CacheEntries.DoesNotExist:
+            return
+
+    def claim(self, stale_before):
+        """Atomically mark the entry as being uploaded,
+        return False if another uploader (started after stale_before) already did."""
+        now = int(datetime.utcnow().strftime("%s"))
+        claimed = CacheEntries.update(upload_started=now).where(CacheEntries.id == self.id,
+                                                                CacheEntries.uploaded == False,
+                                                                CacheEntries.upload_started < stale_before).execute()
+        return bool(claimed)
+
+    class Meta:
+        db_table = 'cache'
+
+
+TABLES = [Backups, Jobs, Inventory, InventoryChanges, Config, Chunks, BackupChunks, Manifest, Uploads,
+          Members, Frames, CacheEntries]
+
+
+def create_tables():
+    """Create the missing tables in the database."""
+    for table in TABLES:
+        if not table.table_exists():
+            table.create_table()
+
+
+create_tables()
 
 
 def backup_sqlite(filename):
@@ -0,0 +1,136 @@
+# -*- encoding: utf-8 -*-
+import logging
+import time
+from Queue import Queue, Empty
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+# Number of retrieval jobs in progress at the same time.
+DEFAULT_MAX_JOBS = 10
+
+# Number of job outputs downloaded concurrently.
+DEFAULT_RETRIEVAL_WORKERS = 4
+
+# Jobs status polling interval (in seconds), doubled after each
+# unsuccessful poll up to MAX_POLL_INTERVAL.
+MIN_POLL_INTERVAL = 60
+MAX_POLL_INTERVAL = 900
+
+
+class RetrievalScheduler(object):
+    """Retrieve many Glacier archives in one go.
+
+    Retrieval jobs are initiated (or reused, see GlacierBackend.retrieval_job)
+    max_jobs at a time, their status is polled with an exponential backoff,
+    and the output of each job is downloaded as soon as it's completed,
+    by workers threads.
+
+    :type storage_backend: GlacierBackend
+    :param storage_backend: Glacier backend.
+
+    :type max_jobs: int
+    :param max_jobs: Maximum number of jobs in progress.
+
+    :type workers: int
+    :param workers: Number of download threads.
+
+    """
+    def __init__(self, storage_backend, max_jobs=DEFAULT_MAX_JOBS, workers=DEFAULT_RETRIEVAL_WORKERS,
+                 min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+        self.storage_backend = storage_backend
+        self.max_jobs = max(1, int(max_jobs))
+        self.workers = max(1, int(workers))
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def _download(self, keyname, job, download, results):
+        try:
+            result = download(keyname, self.storage_backend.job_reader(job, keyname))
+            results.put((keyname, result, None))
+        except Exception, exc:
+            log.exception("Download of {0} failed: {1}".format(keyname, exc))
+            results.put((keyname, None, exc))
+
+    def run(self, keynames, download):
+        """Retrieve archives, download(keyname, reader) is called in a download thread
+        as soon as the job of keyname is completed.
+
+        :type keynames: list
+        :param keynames: Stored filenames.
+
+        :type download: callable
+        :param download: Called with the stored filename and a reader of the archive.
+
+        :rtype: generator
+        :return: Yield (keyname, download result, exception) tuples as archives are downloaded
+            (the exception is None if the download succeeded).
+
+        """
+        pending = list(keynames)
+        jobs = {}
+        downloading = 0
+        results = Queue()
+        interval = self.min_interval
+        next_poll = time.time() + interval
+        pool = ThreadPool(self.workers)
+        try:
+            while pending or jobs or downloading:
+                while pending and len(jobs) < self.max_jobs:
+                    keyname = pending.pop(0)
+                    try:
+                        job = self.storage_backend.retrieval_job(keyname)
+                    except Exception, exc:
+                        log.exception(exc)
+                        yield keyname, None, exc
+                        continue
+                    if job is None:
+                        yield keyname, None, Exception("{0} is not in the inventory.".format(keyname))
+                        continue
+                    log.info("Job {0} initiated for {1}".format(job.id, keyname))
+                    jobs[keyname] = job
+
+                for keyname, job in jobs.items():
+                    if job.status_code == "Succeeded":
+                        log.info("Job {0} completed, downloading {1}".format(job.id, keyname))
+                        del jobs[keyname]
+                        downloading += 1
+                        pool.apply_async(self._download, (keyname, job, download, results))
+                        interval = self.min_interval
+                    elif job.status_code == "Failed":
+                        del jobs[keyname]
+                        self.storage_backend.delete_job(keyname)
+                        yield keyname, None, Exception("Retrieval job {0} failed: {1}".format(job.id,
+                                                                                               job.status_message))
+
+                if pending and len(jobs) < self.max_jobs:
+                    continue
+                if not jobs and not downloading:
+                    break
+
+                # Wait for a download to finish, or for the next poll
+                timeout = max(0, next_poll - time.time()) if jobs else self.max_interval
+                try:
+                    item = results.get(timeout=timeout)
+                except Empty:
+                    pass
+                else:
+                    downloading -= 1
+                    yield item
+                    while 1:
+                        try:
+                            item = results.get_nowait()
+                        except Empty:
+                            break
+                        downloading -= 1
+                        yield item
+
+                if jobs and time.time() >= next_poll:
+                    log.info("Checking {0} jobs, {1} downloads in progress".format(len(jobs), downloading))
+                    for keyname, job in jobs.items():
+                        jobs[keyname] = self.storage_backend.vault.get_job(job.id)
+                    if all(job.status_code == "InProgress" for job in jobs.values()):
+                        interval = min(interval * 2, self.max_interval)
+                    next_poll = time.time() + interval
+        finally:
+            pool.terminate()
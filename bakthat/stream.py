@@ -0,0 +1,363 @@
+# -*- encoding: utf-8 -*-
+import sys
+import hashlib
+import logging
+import threading
+from random import randrange
+from Queue import Queue, Full
+
+from Crypto.Cipher import Blowfish
+from Crypto import Random
+
+log = logging.getLogger(__name__)
+
+# Size of the chunks read/written when streaming data between the pipeline stages.
+CHUNK_SIZE = 64 * 1024
+
+
+def get_cipher(password, iv):
+    """Return the Blowfish-CBC cipher used by beefish."""
+    return Blowfish.new(password, Blowfish.MODE_CBC, iv)
+
+
+def generate_iv(block_size=Blowfish.block_size):
+    return Random.get_random_bytes(block_size)
+
+
+def gen_padding(size, block_size=Blowfish.block_size):
+    """Return the beefish padding for a stream of size bytes: random bytes,
+    the last one is the padding length modulo block_size."""
+    pad_bytes = block_size - (size % block_size)
+    padding = Random.get_random_bytes(pad_bytes - 1)
+    bflag = randrange(block_size - 2, 256 - block_size)
+    bflag -= bflag % block_size - pad_bytes
+    return padding + chr(bflag)
+
+
+class Worker(threading.Thread):
+    """Run target in a background thread, re-raise its exception on join.
+
+    :type target: callable
+    :param target: Function to call in the thread, with args as arguments.
+
+    """
+    def __init__(self, target, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.target = target
+        self.args = args
+        self.result = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.result = self.target(*self.args)
+        except:
+            self.exc_info = sys.exc_info()
+
+    def join(self, timeout=None):
+        threading.Thread.join(self, timeout)
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class Pipe(object):
+    """In-memory bounded pipe, connect a writer thread to a reader thread.
+
+    write blocks when maxsize blocks are pending, and read blocks until
+    size bytes are available or the writer closed the pipe,
+    so the memory used stays bounded whatever the stream size is.
+
+    :type maxsize: int
+    :param maxsize: Maximum number of pending blocks.
+
+    """
+    def __init__(self, maxsize=16):
+        self.queue = Queue(maxsize)
+        self.buffer = ""
+        self.eof = False
+        self.aborted = False
+
+    def write(self, data):
+        if not data:
+            return
+        while 1:
+            if self.aborted:
+                raise IOError("Broken pipe")
+            try:
+                self.queue.put(data, timeout=1)
+                return
+            except Full:
+                pass
+
+    def close(self):
+        """Close the writing end, the reader will get an EOF."""
+        while 1:
+            if self.aborted:
+                return
+            try:
+                self.queue.put(None, timeout=1)
+                return
+            except Full:
+                pass
+
+    def abort(self):
+        """Break the pipe, both ends will fail on their next operation."""
+        self.aborted = True
+        # Wake up a reader blocked on an empty queue
+        try:
+            self.queue.put_nowait(None)
+        except Full:
+            pass
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while (size < 0 or length < size) and not self.eof:
+            data = self.queue.get()
+            if self.aborted:
+                raise IOError("Broken pipe")
+            if data is None:
+                self.eof = True
+                break
+            chunks.append(data)
+            length += len(data)
+
+        data = "".join(chunks)
+        if size < 0:
+            self.buffer = ""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+
+class EncryptWriter(object):
+    """File-like object encrypting everything written to it into fileobj.
+
+    The output is compatible with beefish.decrypt (same as beefish.encrypt),
+    encryption runs in a background thread fed through a Pipe.
+
+    :type fileobj: file
+    :param fileobj: Writable file-like object receiving the encrypted data.
+
+    :type password: str
+    :param password: Password.
+
+    """
+    def __init__(self, fileobj, password):
+        self.iv = generate_iv(Blowfish.block_size)
+        self.pipe = Pipe()
+        self.worker = Worker(self._encrypt, fileobj, password)
+        self.worker.start()
+
+    def _encrypt(self, fileobj, password):
+        try:
+            cipher = get_cipher(password, self.iv)
+            fileobj.write(self.iv)
+            size = 0
+            while 1:
+                data = self.pipe.read(CHUNK_SIZE)
+                size += len(data)
+                if len(data) < CHUNK_SIZE:
+                    # Last chunk, CHUNK_SIZE is a multiple of the block size
+                    fileobj.write(cipher.encrypt(data + gen_padding(size, cipher.block_size)))
+                    break
+                fileobj.write(cipher.encrypt(data))
+        except:
+            self.pipe.abort()
+            raise
+
+    def write(self, data):
+        try:
+            self.pipe.write(data)
+        except IOError:
+            # The encryption thread failed, raise its exception instead
+            self.worker.join()
+            raise
+
+    def close(self):
+        self.pipe.close()
+        self.worker.join()
+
+    def abort(self):
+        self.pipe.abort()
+
+
+class DecryptReader(object):
+    """File-like object decrypting a beefish encrypted fileobj on the fly.
+
+    The last decrypted block is held back until the end of the stream,
+    to strip the padding without seeking/truncating the output
+    like beefish.decrypt does.
+
+    Blowfish-CBC blocks can be decrypted from anywhere given the previous
+    encrypted block, so a range of the encrypted data starting one block
+    before the needed blocks can be decrypted too (with padding=False).
+
+    :type fileobj: file
+    :param fileobj: Readable file-like object containing encrypted data.
+
+    :type password: str
+    :param password: Password.
+
+    :type padding: bool
+    :param padding: Strip the padding at the end of the stream.
+
+    """
+    def __init__(self, fileobj, password, padding=True):
+        self.fileobj = fileobj
+        self.padding = padding
+        self.cipher = get_cipher(password, fileobj.read(Blowfish.block_size))
+        self.encrypted = ""
+        self.held = ""
+        self.buffer = ""
+        self.eof = False
+
+    def _decrypt_chunk(self):
+        data = self.encrypted + self.fileobj.read(CHUNK_SIZE)
+        if len(data) == len(self.encrypted):
+            self.eof = True
+            if not self.held or not self.padding:
+                return self.held
+            padding = (ord(self.held[-1]) % Blowfish.block_size) or Blowfish.block_size
+            return self.held[:-padding]
+
+        # Only decrypt whole blocks
+        end = len(data) - len(data) % Blowfish.block_size
+        self.encrypted = data[end:]
+        decrypted = self.held + self.cipher.decrypt(data[:end])
+        self.held = decrypted[-Blowfish.block_size:]
+        return decrypted[:-Blowfish.block_size]
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while (size < 0 or length < size) and not self.eof:
+            data = self._decrypt_chunk()
+            chunks.append(data)
+            length += len(data)
+
+        data = "".join(chunks)
+        if size < 0:
+            self.buffer = ""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        if hasattr(self.fileobj, "close"):
+            self.fileobj.close()
+
+
+class HashWriter(object):
+    """File-like object writing everything written to it into fileobj,
+    hashing it on the way (SHA-256 by default).
+
+    :type fileobj: file
+    :param fileobj: Writable file-like object.
+
+    :type algorithm: str
+    :param algorithm: hashlib algorithm name.
+
+    """
+    def __init__(self, fileobj, algorithm="sha256"):
+        self.fileobj = fileobj
+        self.hash = hashlib.new(algorithm)
+
+    def write(self, data):
+        self.hash.update(data)
+        self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class HashReader(object):
+    """File-like object reading fileobj, hashing it on the way (SHA-256 by default).
+
+    :type fileobj: file
+    :param fileobj: Readable file-like object.
+
+    :type algorithm: str
+    :param algorithm: hashlib algorithm name.
+
+    """
+    def __init__(self, fileobj, algorithm="sha256"):
+        self.fileobj = fileobj
+        self.hash = hashlib.new(algorithm)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+    def verify(self, expected, name):
+        """Read the rest of fileobj, raise an exception if the hash doesn't match expected."""
+        while self.read(CHUNK_SIZE):
+            pass
+        if self.hash.hexdigest() != expected:
+            raise Exception("Checksum mismatch for {0}, the backup is corrupted.".format(name))
+        log.info("Checksum verified")
+
+    def close(self):
+        if hasattr(self.fileobj, "close"):
+            self.fileobj.close()
+
+
+class SliceReader(object):
+    """File-like object returning length bytes of fileobj, after skipping skip bytes.
+
+    :type fileobj: file
+    :param fileobj: Readable file-like object.
+
+    :type skip: int
+    :param skip: Number of bytes to skip.
+
+    :type length: int
+    :param length: Number of bytes to return.
+
+    """
+    def __init__(self, fileobj, skip, length):
+        self.fileobj = fileobj
+        self.skip = skip
+        self.remaining = length
+
+    def read(self, size=-1):
+        while self.skip:
+            data = self.fileobj.read(min(self.skip, CHUNK_SIZE))
+            if not data:
+                break
+            self.skip -= len(data)
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        if hasattr(self.fileobj, "close"):
+            self.fileobj.close()
+
+
+def copy_stream(src, dst, chunk_size=CHUNK_SIZE):
+    """Copy src file-like object into dst, chunk by chunk.
+
+    :rtype: int
+    :return: The number of bytes copied.
+
+    """
+    copied = 0
+    while 1:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        dst.write(data)
+        copied += len(data)
+    return copied
@@ -1,6 +1,7 @@
 # -*- encoding: utf-8 -*-
 import logging
 import socket
+import threading
 from bakthat.models import Backups, Config
 from bakthat.conf import config
 
@@ -12,6 +13,18 @@ import json
 
 log = logging.getLogger(__name__)
 
+# HTTP sessions of the BakSyncers, one per thread (the cache uploader threads sync too)
+local = threading.local()
+
+
+def thread_session():
+    """Return the HTTP session dedicated to the current thread,
+    requests sessions can't be shared between threads, the connections
+    are kept alive between the syncs of the thread."""
+    if not hasattr(local, "session"):
+        local.session = requests.Session()
+    return local.session
+
 
 class BakSyncer():
     """Helper to synchronize change on a backup set via a REST API.
@@ -45,7 +58,7 @@ class BakSyncer():
         """Register/create the current host on the remote server if not already registered."""
         if not Config.get_key("client_id"):
             r_kwargs = self.request_kwargs.copy()
-            r = requests.post(self.get_resource("clients"), **r_kwargs)
+            r = thread_session().post(self.get_resource("clients"), **r_kwargs)
             if r.status_code == 200:
                 client = r.json()
                 if client:
@@ -77,7 +90,7 @@ class BakSyncer():
         r_kwargs = self.request_kwargs.copy()
         log.debug("Initial payload: {0}".format(data))
         r_kwargs.update({"data": json.dumps(data)})
-        r = requests.post(self.get_resource("backups/sync/status"), **r_kwargs)
+        r = thread_session().post(self.get_resource("backups/sync/status"), **r_kwargs)
         if r.status_code != 200:
             log.error("An error occured during sync: {0}".format(r.text))
             return
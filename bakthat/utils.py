@@ -53,3 +53,19 @@ def _interval_string_to_seconds(interval_string):
         else:
             raise Exception(interval_exc)
     return seconds
+
+
+def _size_string_to_bytes(size_string):
+    """Convert a size string like 512M, 10G or 1048576 to bytes.
+
+    :type size_string: str
+    :param size_string: Size in bytes, with an optional K, M, G or T suffix.
+
+    :rtype: int
+    :return: The size in bytes.
+
+    """
+    match = re.match(r"^(?P<num>[0-9]+)(?P<ext>[KMGT]?)$", str(size_string).strip())
+    if not match:
+        raise Exception("Bad size format for {0}".format(size_string))
+    return int(match.group("num")) * 1024 ** " KMGT".index(match.group("ext") or " ")
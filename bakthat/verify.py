@@ -0,0 +1,104 @@
+# -*- encoding: utf-8 -*-
+import logging
+from multiprocessing.pool import ThreadPool
+
+from bakthat.backends import S3Backend
+from bakthat.models import Inventory
+from bakthat.stream import HashReader, CHUNK_SIZE
+
+log = logging.getLogger(__name__)
+
+DEFAULT_VERIFY_WORKERS = 4
+
+
+def verify_backup(storage_backend, backup, deep=False):
+    """Check a stored backup against its catalog entry.
+
+    The quick check compares the size (and the ETag for S3) with a HEAD request,
+    the deep check also downloads the object to compare its SHA-256.
+
+    :type storage_backend: S3Backend or GlacierBackend
+    :param storage_backend: Storage backend.
+
+    :type backup: Backups
+    :param backup: Backup to check.
+
+    :type deep: bool
+    :param deep: Download the object to check its checksum.
+
+    :rtype: dict
+    :return: A dict with the following keys: stored_filename, status
+        (ok|missing|truncated|corrupt|unverified|pending|error), size, expected_size and message.
+
+    """
+    checksums = backup.metadata.get("checksums", {})
+    expected_size = None if backup.metadata.get("dedup") else backup.size
+    report = dict(stored_filename=backup.stored_filename, status="ok",
+                  size=None, expected_size=expected_size, message="")
+
+    if backup.metadata.get("pending_upload"):
+        report.update(status="pending", message="Waiting for upload in the local cache")
+        return report
+
+    try:
+        if not isinstance(storage_backend, S3Backend):
+            # Glacier archives can only be read through a retrieval job
+            if not Inventory.select().where(Inventory.filename == backup.stored_filename).count():
+                report.update(status="missing", message="No archive in the inventory")
+            elif deep:
+                report.update(status="unverified", message="Glacier archives can't be read without a retrieval job")
+            return report
+
+        key = storage_backend.thread_bucket().get_key(backup.stored_filename)
+        if key is None:
+            report.update(status="missing")
+            return report
+        report["size"] = key.size
+
+        if expected_size is not None and key.size != expected_size:
+            report.update(status="truncated" if key.size < expected_size else "corrupt",
+                          message="Size mismatch")
+            return report
+        if checksums.get("etag") and key.etag.strip('"') != checksums["etag"]:
+            report.update(status="corrupt", message="ETag mismatch")
+            return report
+
+        if deep:
+            if not checksums.get("sha256"):
+                report.update(status="unverified", message="No checksum in the catalog")
+                return report
+            # The stored object is checked, not its copy in the local cache
+            download = HashReader(storage_backend.open_download(backup.stored_filename, 0, key.size,
+                                                                use_cache=False))
+            try:
+                while download.read(CHUNK_SIZE):
+                    pass
+            finally:
+                download.close()
+            if download.hash.hexdigest() != checksums["sha256"]:
+                report.update(status="corrupt", message="SHA-256 mismatch")
+    except Exception, exc:
+        log.exception(exc)
+        report.update(status="error", message=str(exc))
+
+    return report
+
+
+def verify_backups(storage_backend, backups, deep=False, workers=DEFAULT_VERIFY_WORKERS):
+    """Check stored backups concurrently, workers backups at a time.
+
+    :rtype: list
+    :return: A report (see verify_backup) for each backup.
+
+    """
+    def run(backup):
+        report = verify_backup(storage_backend, backup, deep)
+        log.info("{0}: {1}".format(report["stored_filename"], report["status"]))
+        return report
+
+    pool = ThreadPool(max(1, int(workers)))
+    try:
+        return pool.map(run, backups)
+    finally:
+        pool.close()
+        pool.join()
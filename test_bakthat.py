@@ -4,6 +4,9 @@ import tempfile
 import json
 import hashlib
 import os
+import shutil
+import tarfile
+import threading
 import time
 import unittest
 import logging
@@ -13,10 +16,108 @@ from bakthat.backends import GlacierBackend
 log = logging.getLogger()
 logging.basicConfig(level=logging.DEBUG)
 
+# Profile of the tests run against a mocked S3
+TEST_PROFILE = "bakthat-test"
+
+
+class FakeGlacierResponse(dict):
+    """Glacier response headers, with a body."""
+    def __init__(self, body="", **headers):
+        dict.__init__(self, **headers)
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class FakeGlacierBackend(object):
+    """In-memory Glacier vault standing for a GlacierBackend, its vault and the vault layer1."""
+    name = "glacier"
+
+    def __init__(self, workers=2):
+        from multiprocessing.pool import ThreadPool
+
+        self.vault = self.layer1 = self
+        self.pool = ThreadPool(workers)
+        self.uploads = {}
+        self.archives = {}
+        self.jobs = {}
+        self.sent = []
+        self.corrupt = set()
+
+    def thread_vault(self):
+        return self
+
+    def worker_pool(self):
+        return self.pool
+
+    def _backup_inventory(self):
+        pass
+
+    def initiate_multipart_upload(self, vault_name, part_size, description):
+        upload_id = os.urandom(8).encode("hex")
+        self.uploads[upload_id] = {}
+        return dict(UploadId=upload_id)
+
+    def upload_part(self, vault_name, upload_id, linear_hash, tree_hash, byte_range, data):
+        from boto.glacier.utils import tree_hash_from_str
+
+        if tree_hash != tree_hash_from_str(data) or linear_hash != hashlib.sha256(data).hexdigest():
+            raise Exception("Checksum mismatch")
+        self.sent.append(byte_range)
+        self.uploads[upload_id][byte_range[0]] = data
+        return FakeGlacierResponse()
+
+    def complete_multipart_upload(self, vault_name, upload_id, tree_hash, size):
+        from boto.glacier.utils import tree_hash_from_str
+
+        data = "".join(part for offset, part in sorted(self.uploads.pop(upload_id).items()))
+        if len(data) != size or tree_hash != tree_hash_from_str(data):
+            raise Exception("Checksum mismatch")
+        archive_id = os.urandom(8).encode("hex")
+        self.archives[archive_id] = data
+        return dict(ArchiveId=archive_id)
+
+    def get_job_output(self, vault_name, job_id, byte_range):
+        from boto.glacier.utils import tree_hash_from_str
+
+        self.sent.append(byte_range)
+        data = self.archives[self.jobs[job_id]][byte_range[0]:byte_range[1] + 1]
+        response = FakeGlacierResponse(data, TreeHash=tree_hash_from_str(data))
+        if byte_range[0] in self.corrupt:
+            # Corrupted once
+            self.corrupt.remove(byte_range[0])
+            response.body = "\0" + data[1:]
+        return response
+
 
 class BakthatTestCase(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # The tests run against a temporary catalog, the user's ~/.bakthat.sqlite is left untouched
+        from bakthat import dedup, models
+
+        cls.database_dir = tempfile.mkdtemp()
+        models.database.init(os.path.join(cls.database_dir, "bakthat.sqlite"))
+        models.create_tables()
+        cls.chunks_lock = dedup.CHUNKS_LOCK
+        dedup.CHUNKS_LOCK = os.path.join(cls.database_dir, "bakthat.sqlite.chunks.lock")
+
+    @classmethod
+    def tearDownClass(cls):
+        from bakthat import dedup, models
+        from bakthat.conf import DATABASE
+
+        models.database.init(DATABASE)
+        dedup.CHUNKS_LOCK = cls.chunks_lock
+        shutil.rmtree(cls.database_dir)
+
     def setUp(self):
+        from bakthat.models import TABLES
+
+        for table in TABLES:
+            table.delete().execute()
         self.test_file = tempfile.NamedTemporaryFile()
         self.test_file.write("Bakthat Test File")
         self.test_file.seek(0)
@@ -24,6 +125,70 @@ class BakthatTestCase(unittest.TestCase):
         self.test_hash = hashlib.sha1(self.test_file.read()).hexdigest()
         self.password = "bakthat_encrypted_test"
 
+    def _mock_s3(self, **conf):
+        """Mock S3 with moto for this test, set up the TEST_PROFILE profile
+        with the given configuration and return its S3 backend."""
+        try:
+            from moto import mock_s3_deprecated
+        except ImportError:
+            self.skipTest("moto not installed")
+        import boto
+        from bakthat.backends import S3Backend, get_backend
+        from bakthat.conf import config
+
+        mock = mock_s3_deprecated()
+        mock.start()
+        self.addCleanup(mock.stop)
+        # The mocked HTTP layer isn't thread safe, requests are sent one at a time
+        conf.setdefault("s3_concurrency", 1)
+        # A bucket per test, the catalog entries of the other tests are ignored
+        bucket = "bakthat-test-{0}".format(os.urandom(4).encode("hex"))
+        boto.connect_s3("AK", "SK").create_bucket(bucket)
+        conf.update(access_key="AK", secret_key="SK", region_name="us-east-1",
+                    s3_bucket=bucket, glacier_vault=bucket)
+        config[TEST_PROFILE] = conf
+        self.addCleanup(config.pop, TEST_PROFILE)
+        return get_backend(S3Backend, profile=TEST_PROFILE)
+
+    def _random_file(self, size):
+        """Return a temporary file holding size random bytes."""
+        source = tempfile.NamedTemporaryFile()
+        source.write(os.urandom(size))
+        source.flush()
+        source.seek(0)
+        return source
+
+    def _restore(self, filename, restored=None, **kwargs):
+        """Restore a backup of the TEST_PROFILE profile in a temporary directory,
+        return the data of the restored file (restored, filename by default)."""
+        cwd = os.getcwd()
+        dirname = tempfile.mkdtemp()
+        os.chdir(dirname)
+        try:
+            self.assertTrue(bakthat.restore(filename, "s3", profile=TEST_PROFILE, **kwargs))
+            with open(restored or filename, "rb") as f:
+                return f.read()
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(dirname)
+
+    def _interrupted_backup(self, filename, **kwargs):
+        """Run a backup failing once the parts are uploaded, before the upload is completed."""
+        from bakthat.backends import S3UploadWriter
+
+        def interrupt(writer):
+            while writer.pending:
+                writer._wait()
+            raise IOError("Interrupted")
+
+        close = S3UploadWriter.close
+        S3UploadWriter.close = interrupt
+        try:
+            with self.assertRaises(IOError):
+                bakthat.backup(filename, "s3", profile=TEST_PROFILE, sync=False, compression="gzip:0", **kwargs)
+        finally:
+            S3UploadWriter.close = close
+
     def test_internals(self):
         with self.assertRaises(Exception):
             bakthat._match_filename("", "s3")
@@ -34,6 +199,891 @@ class BakthatTestCase(unittest.TestCase):
         self.assertEqual(bakthat._interval_string_to_seconds("2D1h"), 86400 * 2 + 3600)
         self.assertEqual(bakthat._interval_string_to_seconds("3M"), 3*30*86400)
 
+    def test_parallel_gzip(self):
+        import zlib
+        from StringIO import StringIO
+        from gzip import GzipFile
+        from bakthat.compression import ParallelGzipWriter
+
+        data = os.urandom(100000) + "bakthat" * 300000
+        out = StringIO()
+        writer = ParallelGzipWriter(out, block_size=64 * 1024, workers=4, frame_size=256 * 1024)
+        for i in range(0, len(data), 10000):
+            writer.write(data[i:i + 10000])
+        writer.close()
+
+        out.seek(0)
+        self.assertEqual(GzipFile(fileobj=out).read(), data)
+
+        # A frame every 256KB, each frame can be inflated on its own
+        frames = writer.frames
+        self.assertEqual(len(frames), 10)
+        self.assertEqual(frames[-1][0], len(data))
+        self.assertEqual([offset for offset, compressed in frames[:-1]], range(0, len(data), 256 * 1024))
+        (start, cstart), (end, cend) = frames[3], frames[5]
+        self.assertEqual(zlib.decompressobj(-zlib.MAX_WBITS).decompress(out.getvalue()[cstart:cend]),
+                         data[start:end])
+
+    def _check_codec(self, name):
+        from StringIO import StringIO
+        from bakthat.compression import get_codec
+
+        codec = get_codec(name)
+        if not codec.available():
+            self.skipTest("{0} module not installed".format(codec.module))
+
+        data = os.urandom(100000) + "bakthat" * 300000
+        self.assertEqual(codec.decompress(codec.compress(data)), data)
+
+        out = StringIO()
+        writer = codec.writer(out, block_size=64 * 1024)
+        for i in range(0, len(data), 10000):
+            writer.write(data[i:i + 10000])
+        writer.close()
+        self.assertTrue(len(out.getvalue()) < len(data))
+
+        out.seek(0)
+        self.assertEqual(codec.reader(out).read(), data)
+
+    def test_codec_gzip(self):
+        self._check_codec("gzip")
+
+    def test_codec_zstd(self):
+        self._check_codec("zstd")
+
+    def test_codec_lz4(self):
+        self._check_codec("lz4")
+
+    def test_codec_xz(self):
+        self._check_codec("xz")
+
+    def test_unknown_codec(self):
+        conf = dict(access_key="bakthat", secret_key="bakthat", s3_bucket="bakthat", region_name="us-east-1",
+                    compression=dict(codec="bogus"))
+        with self.assertRaises(Exception) as cm:
+            bakthat.backup(self.test_file.name, "s3", password="", conf=conf)
+        self.assertTrue("Unknown compression codec bogus" in str(cm.exception))
+
+    def test_incompressible(self):
+        from StringIO import StringIO
+        from gzip import GzipFile
+        import zlib
+        from bakthat.compression import ParallelGzipWriter, CompressorWriter, DecompressorReader, \
+            is_incompressible, is_compressed
+
+        self.assertTrue(is_incompressible(os.urandom(64 * 1024)))
+        self.assertFalse(is_incompressible("bakthat" * 10000))
+        self.assertTrue(is_compressed("\x1f\x8b\x08\x00"))
+        self.assertFalse(is_compressed("Bakthat Test File"))
+
+        data = os.urandom(128 * 1024) + "bakthat" * 30000
+        out = StringIO()
+        writer = ParallelGzipWriter(out, block_size=64 * 1024)
+        writer.write(data)
+        writer.close()
+        self.assertEqual(writer.stats["stored_size"], 128 * 1024)
+
+        out.seek(0)
+        self.assertEqual(GzipFile(fileobj=out).read(), data)
+
+        # Streaming codecs switch to their store level for incompressible blocks
+        out = StringIO()
+        writer = CompressorWriter(out, zlib.compressobj, 9, 0, block_size=64 * 1024)
+        writer.incompressible(256 * 1024, 320 * 1024)
+        data2 = data + "bakthat" * 20000
+        writer.write(data2)
+        writer.close()
+        self.assertEqual(writer.stats["stored_size"], 128 * 1024 + 64 * 1024)
+
+        out.seek(0)
+        self.assertEqual(DecompressorReader(out, zlib.decompressobj).read(), data2)
+
+    def test_decrypt_reader(self):
+        from StringIO import StringIO
+        from beefish import encrypt
+        from bakthat.stream import DecryptReader
+
+        for size in [0, 1, 8, 9, 64 * 1024, 2 * 64 * 1024 + 3]:
+            data = os.urandom(size)
+            encrypted = StringIO()
+            encrypt(StringIO(data), encrypted, self.password)
+            encrypted.seek(0)
+            self.assertEqual(DecryptReader(encrypted, self.password).read(), data)
+
+    def test_chunked_encryption(self):
+        from StringIO import StringIO
+        from bakthat.encryption import ChunkEncryptWriter, ChunkDecryptReader, Header
+
+        data = os.urandom(10 * 4096 + 3)
+        encrypted = StringIO()
+        writer = ChunkEncryptWriter(encrypted, self.password, chunk_size=4096, workers=4)
+        writer.write(data)
+        writer.close()
+        encrypted = encrypted.getvalue()
+
+        self.assertEqual(ChunkDecryptReader(StringIO(encrypted), self.password).read(), data)
+
+        # Random access
+        header = Header.unpack(encrypted)
+        chunk = encrypted[header.record_offset(3):header.record_offset(4)]
+        reader = ChunkDecryptReader(StringIO(chunk), self.password, header, 3, partial=True)
+        self.assertEqual(reader.read(), data[3 * 4096:4 * 4096])
+
+        with self.assertRaises(Exception):
+            ChunkDecryptReader(StringIO(encrypted), "wrong password").read()
+        with self.assertRaises(Exception):
+            ChunkDecryptReader(StringIO(encrypted[:header.record_offset(4)]), self.password).read()
+
+    def test_range_reader(self):
+        from multiprocessing.pool import ThreadPool
+        from bakthat.backends import RangeReader
+
+        data = os.urandom(100000)
+        fetched = []
+
+        class StringRangeReader(RangeReader):
+            def _fetch(self, start, end):
+                fetched.append((start, end))
+                # The first request of a range is incomplete, it's retried
+                if fetched.count((start, end)) == 1:
+                    return data[start:end]
+                return data[start:end + 1]
+
+        pool = ThreadPool(3)
+        self.addCleanup(pool.terminate)
+
+        # Reads of any size across the ranges, from an offset
+        reader = StringRangeReader("test", len(data), pool, chunk_size=7000, concurrency=3, start=1234)
+        chunks = []
+        size = 1
+        while 1:
+            chunk = reader.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size = size * 3 % 9999 + 1
+        reader.close()
+        self.assertEqual("".join(chunks), data[1234:])
+        self.assertEqual(sorted(set(fetched))[:2], [(1234, 8233), (8234, 15233)])
+        self.assertEqual(len(fetched), 2 * len(set(fetched)))
+
+        reader = StringRangeReader("test", 50000, pool, chunk_size=7000, concurrency=3)
+        self.assertEqual(reader.read(), data[:50000])
+        reader.close()
+
+    def _glacier_upload(self, backend, keyname, data, part_size, state=None):
+        """Upload data with a GlacierUploadWriter, return the writer."""
+        from bakthat.backends import GlacierUploadWriter
+
+        writer = GlacierUploadWriter(backend, keyname, part_size, state, concurrency=2)
+        for i in range(0, len(data), 300000):
+            writer.write(data[i:i + 300000])
+        writer.close()
+        return writer
+
+    def test_glacier_upload_writer(self):
+        from bakthat.backends import GlacierUploadWriter
+        from bakthat.models import Inventory, Uploads
+
+        backend = FakeGlacierBackend()
+        self.addCleanup(backend.pool.terminate)
+        keyname = "glacier-test-" + os.urandom(4).encode("hex")
+
+        # Tree hash of a single megabyte of zeros
+        writer = self._glacier_upload(backend, keyname + "-zero", "\0" * 1024 * 1024, 1024 * 1024)
+        self.assertEqual(writer.checksums["tree_hash"],
+                         "30e14955ebf1352266dc2ff8067e68104607e750abb9d3b36582b8af909fcb58")
+
+        # 2MB parts, the tree hash of the archive is built from the hashes of each megabyte
+        data = os.urandom(3 * 1024 * 1024 + 512 * 1024)
+        digests = [hashlib.sha256(data[i:i + 1024 * 1024]).digest() for i in range(0, len(data), 1024 * 1024)]
+        expected = hashlib.sha256(hashlib.sha256(digests[0] + digests[1]).digest() +
+                                  hashlib.sha256(digests[2] + digests[3]).digest()).hexdigest()
+        writer = self._glacier_upload(backend, keyname, data, 2 * 1024 * 1024)
+        self.assertEqual(writer.checksums["tree_hash"], expected)
+        archive_id = Inventory.get_archive_id(keyname)
+        self.assertEqual(backend.archives[archive_id], data)
+
+        # Glacier can't store an empty archive, the upload isn't started
+        writer = GlacierUploadWriter(backend, keyname + "-empty", 1024 * 1024, concurrency=2)
+        writer.write("")
+        with self.assertRaises(Exception):
+            writer.close()
+        self.assertEqual(backend.uploads, {})
+        self.assertFalse(Inventory.select().where(Inventory.filename == keyname + "-empty").count())
+
+        # An interrupted upload is resumed, the uploaded part isn't sent again
+        state = Uploads.create(resume_key=os.urandom(8).encode("hex"), backend="glacier", backend_hash="test",
+                               stored_filename=keyname + "-resumed", part_size=2 * 1024 * 1024,
+                               created=int(time.time()), metadata={}, parts={})
+        writer = GlacierUploadWriter(backend, keyname + "-resumed", 2 * 1024 * 1024, state, concurrency=2)
+        writer.write(data[:3 * 1024 * 1024])
+        while writer.pending:
+            writer._wait()
+        writer.abort()
+        self.assertEqual(state.get_part(1)[:2], [0, 2 * 1024 * 1024])
+
+        backend.sent = []
+        writer = self._glacier_upload(backend, keyname + "-resumed", data, 2 * 1024 * 1024, state)
+        self.assertEqual(backend.sent, [(2 * 1024 * 1024, len(data) - 1)])
+        self.assertEqual(writer.checksums["tree_hash"], expected)
+        self.assertEqual(backend.archives[Inventory.get_archive_id(keyname + "-resumed")], data)
+
+    def test_glacier_download_reader(self):
+        from bakthat.backends import GlacierDownloadReader
+
+        class Job(object):
+            id = "job"
+            archive_size = 5 * 1024 * 1024 + 512 * 1024
+
+        backend = FakeGlacierBackend()
+        self.addCleanup(backend.pool.terminate)
+        data = os.urandom(Job.archive_size)
+        backend.archives["archive"] = data
+        backend.jobs["job"] = "archive"
+        backend.corrupt.add(2 * 1024 * 1024)
+
+        # Ranges of 2MB (rounded down to a megabyte multiplied by a power of two),
+        # the corrupted range doesn't match its tree hash and is downloaded again
+        reader = GlacierDownloadReader(backend, Job(), "glacier-test", 3 * 1024 * 1024, 2)
+        self.assertEqual(reader.read(), data)
+        reader.close()
+        ranges = [(0, 2 * 1024 * 1024 - 1), (2 * 1024 * 1024, 4 * 1024 * 1024 - 1),
+                  (4 * 1024 * 1024, len(data) - 1)]
+        self.assertEqual(sorted(backend.sent), sorted(ranges + ranges[1:2]))
+
+    def test_inventory_parser(self):
+        from StringIO import StringIO
+        from bakthat.inventory import InventoryParser, _parse_date
+
+        archives = [{"ArchiveId": "archive{0}".format(i),
+                     "ArchiveDescription": "backup{0}.20130320170343.tgz".format(i),
+                     "CreationDate": "2013-03-20T17:03:43Z",
+                     "Size": 1234567 * i,
+                     "SHA256TreeHash": hashlib.sha256(str(i)).hexdigest()} for i in range(50)]
+        document = json.dumps({"VaultARN": "arn:aws:glacier:us-east-1:012345678901:vaults/bakthat",
+                               "InventoryDate": "2013-03-21T04:35:42Z",
+                               "ArchiveList": archives}, indent=1)
+
+        # Read by small blocks, values (numbers included) span several blocks
+        for chunk_size in [7, 64, 1024 * 1024]:
+            parser = InventoryParser(StringIO(document), chunk_size)
+            self.assertEqual(list(parser), archives)
+            self.assertEqual(parser.header["InventoryDate"], "2013-03-21T04:35:42Z")
+            self.assertEqual(parser.header["VaultARN"], "arn:aws:glacier:us-east-1:012345678901:vaults/bakthat")
+
+        self.assertEqual(list(InventoryParser(StringIO('{"VaultARN": "bakthat", "ArchiveList": []}'))), [])
+        with self.assertRaises(ValueError):
+            list(InventoryParser(StringIO(document[:len(document) / 2])))
+        self.assertEqual(_parse_date("2013-03-21T04:35:42Z"), 1363840542)
+
+    def test_sync_inventory(self):
+        from StringIO import StringIO
+        from bakthat.inventory import sync_inventory
+        from bakthat.models import Backups, Inventory
+
+        class Backend(object):
+            name = "glacier"
+            backend_hash = os.urandom(8).encode("hex")
+
+            def get_backend_hash(self):
+                return self.backend_hash
+
+        # kept is in the vault, gone was deleted from the vault, recent was uploaded after the inventory
+        for stored_filename, backup_date in [("kept.20130101000000.tgz", 1357000000),
+                                             ("gone.20130101000000.tgz", 1357000000),
+                                             ("recent.20130322000000.tgz", 1363910400)]:
+            archive_id = stored_filename.split(".")[0]
+            Inventory.create(filename=stored_filename, archive_id=archive_id)
+            Backups.create(backend="glacier", backend_hash=Backend.backend_hash, backup_date=backup_date,
+                           filename=archive_id, is_deleted=False, last_updated=backup_date, metadata={},
+                           size=1, stored_filename=stored_filename, tags="")
+
+        archives = [{"ArchiveId": archive_id, "ArchiveDescription": stored_filename,
+                     "CreationDate": "2013-03-20T17:03:43Z", "Size": 1, "SHA256TreeHash": archive_id}
+                    for stored_filename, archive_id in [("kept.20130101000000.tgz", "kept"),
+                                                        ("new.20130320170343.tgz", "new")]]
+        document = json.dumps({"InventoryDate": "2013-03-21T04:35:42Z", "ArchiveList": archives})
+        stats = sync_inventory(Backend(), StringIO(document), batch_size=1)
+        self.assertEqual(stats, dict(archives=2, inserted=1, deleted=1, backups_created=1, backups_deleted=1))
+
+        self.assertEqual(sorted(Inventory.select(Inventory.filename, Inventory.archive_id).tuples()),
+                         [("kept.20130101000000.tgz", "kept"), ("new.20130320170343.tgz", "new"),
+                          ("recent.20130322000000.tgz", "recent")])
+        backups = dict((backup.stored_filename, backup) for backup in
+                       Backups.select().where(Backups.backend_hash == Backend.backend_hash))
+        self.assertTrue(backups["gone.20130101000000.tgz"].is_deleted)
+        self.assertFalse(backups["recent.20130322000000.tgz"].is_deleted)
+        self.assertEqual(backups["new.20130320170343.tgz"].filename, "new")
+        self.assertEqual(backups["new.20130320170343.tgz"].metadata["checksums"], dict(tree_hash="new"))
+
+    def test_inventory_log(self):
+        from bakthat.inventory import InventoryLog
+        from bakthat.models import Inventory, InventoryChanges
+
+        backend = self._mock_s3()
+        inventory_log = InventoryLog(backend.bucket, "inventory", batch_size=1)
+
+        def kinds():
+            return [kind for seq, kind, key_name in inventory_log.segments()]
+
+        def inventory():
+            return sorted(Inventory.select(Inventory.filename, Inventory.archive_id).tuples())
+
+        Inventory.insert_many([dict(filename="a.tgz", archive_id="a"), dict(filename="b.tgz", archive_id="b")]).execute()
+        InventoryChanges.record([("a.tgz", "a"), ("b.tgz", "b")])
+        # The first push is a snapshot
+        self.assertTrue(inventory_log.push())
+        self.assertEqual(kinds(), ["snapshot"])
+        self.assertEqual(InventoryChanges.select().count(), 0)
+
+        Inventory.create(filename="c.tgz", archive_id="c")
+        InventoryChanges.record([("c.tgz", "c")])
+        Inventory.delete().where(Inventory.archive_id == "a").execute()
+        InventoryChanges.record([("a.tgz", "a")], is_deleted=True)
+        self.assertTrue(inventory_log.push())
+        self.assertEqual(kinds(), ["snapshot", "delta"])
+        # Nothing recorded since the last push
+        self.assertEqual(inventory_log.push(), None)
+
+        expected = [("b.tgz", "b"), ("c.tgz", "c")]
+        self.assertEqual(sorted((row["filename"], row["archive_id"]) for row in inventory_log.load()), expected)
+
+        # The snapshot with the delta replayed
+        Inventory.delete().execute()
+        Inventory.create(filename="stale.tgz", archive_id="stale")
+        self.assertEqual(inventory_log.restore(), 2)
+        self.assertEqual(inventory(), expected)
+
+        # An upload whose push failed is kept by a restore, and pushed next
+        Inventory.create(filename="d.tgz", archive_id="d")
+        InventoryChanges.record([("d.tgz", "d")])
+        expected.append(("d.tgz", "d"))
+        self.assertEqual(inventory_log.restore(), 3)
+        self.assertEqual(inventory(), expected)
+        self.assertEqual(InventoryChanges.select().count(), 1)
+
+        # A new snapshot replaces the older segments
+        self.assertTrue(inventory_log.push(snapshot=True))
+        self.assertEqual(kinds(), ["snapshot"])
+        self.assertEqual(len(list(backend.bucket.list(prefix="inventory/"))), 1)
+        self.assertEqual(sorted((row["filename"], row["archive_id"]) for row in inventory_log.load()), expected)
+
+    def test_retrieval_scheduler(self):
+        from StringIO import StringIO
+        from bakthat.retrieval import RetrievalScheduler
+
+        # Status of the job of each archive at each poll
+        statuses = {"a": ["Succeeded"], "b": ["InProgress", "InProgress", "Succeeded"],
+                    "c": ["InProgress", "Failed"], "e": ["Succeeded"]}
+        deleted_jobs = []
+
+        class Job(object):
+            def __init__(self, job_id):
+                self.id = job_id
+                self.status_code = statuses[job_id].pop(0)
+                self.status_message = "Retrieval failed"
+
+        class Backend(object):
+            def __init__(self):
+                self.vault = self
+
+            def retrieval_job(self, keyname):
+                return Job(keyname) if keyname in statuses else None
+
+            def get_job(self, job_id):
+                return Job(job_id)
+
+            def delete_job(self, keyname):
+                deleted_jobs.append(keyname)
+
+            def job_reader(self, job, keyname):
+                return StringIO("archive " + keyname)
+
+        def download(keyname, reader):
+            if keyname == "e":
+                raise IOError("Download failed")
+            return reader.read()
+
+        scheduler = RetrievalScheduler(Backend(), max_jobs=2, workers=2, min_interval=0.01, max_interval=0.05)
+        results = dict((keyname, (result, exc)) for keyname, result, exc in
+                       scheduler.run(["a", "b", "c", "d", "e"], download))
+        self.assertEqual(sorted(results), ["a", "b", "c", "d", "e"])
+        self.assertEqual(results["a"], ("archive a", None))
+        self.assertEqual(results["b"], ("archive b", None))
+        self.assertEqual(results["c"][0], None)
+        self.assertTrue("Retrieval failed" in str(results["c"][1]))
+        self.assertTrue("not in the inventory" in str(results["d"][1]))
+        self.assertTrue(isinstance(results["e"][1], IOError))
+        # The failed job is forgotten, the next retrieval initiates a new job
+        self.assertEqual(deleted_jobs, ["c"])
+
+    def test_dedup_chunker(self):
+        import random
+        from bakthat import dedup
+        from bakthat.dedup import Chunker
+
+        rand = random.Random(0)
+        size = 8 * 1024 * 1024
+        data = "{0:0{1}x}".format(rand.getrandbits(8 * size), 2 * size).decode("hex")
+        chunker = Chunker()
+        chunks = chunker.feed(data) + [chunker.flush()]
+        self.assertEqual("".join(chunks), data)
+
+        # An insertion only changes the chunk containing it (and the next one
+        # if it moves the boundary between them)
+        data2 = data[:3000000] + "bakthat" + data[3000000:]
+        chunker = Chunker()
+        chunks2 = chunker.feed(data2) + [chunker.flush()]
+        self.assertEqual("".join(chunks2), data2)
+        self.assertTrue(1 <= len(set(chunks2) - set(chunks)) <= 2)
+
+        # The byte by byte search finds the same boundaries
+        if dedup.numpy is not None:
+            numpy, dedup.numpy = dedup.numpy, None
+            try:
+                chunker = Chunker()
+                self.assertEqual(chunker.feed(data) + [chunker.flush()], chunks)
+            finally:
+                dedup.numpy = numpy
+
+    def test_dedup_collect_lock(self):
+        from bakthat.dedup import _lock_chunks
+
+        # No collection while a dedup backup is running
+        backup_lock = _lock_chunks()
+        self.assertEqual(_lock_chunks(exclusive=True), None)
+        backup_lock.close()
+
+        collect_lock = _lock_chunks(exclusive=True)
+        self.assertNotEqual(collect_lock, None)
+        collect_lock.close()
+
+    def test_s3_multipart_upload(self):
+        backend = self._mock_s3(s3_part_size=5 * 1024 * 1024)
+        source = self._random_file(12 * 1024 * 1024)
+        backup_data = bakthat.backup(source.name, "s3", profile=TEST_PROFILE, sync=False,
+                                     compression="gzip:0", password="")
+
+        # Sent as 5MB parts, the multipart ETag is computed from the parts MD5
+        checksums = backup_data["metadata"]["checksums"]
+        self.assertEqual(len(checksums["parts_md5"]), 3)
+        self.assertEqual(checksums["part_size"], 5 * 1024 * 1024)
+        etag = hashlib.md5("".join(md5.decode("hex") for md5 in checksums["parts_md5"])).hexdigest()
+        self.assertEqual(checksums["etag"], etag + "-3")
+        self.assertEqual(backend.bucket.get_key(backup_data["stored_filename"]).size, backup_data["size"])
+
+        self.assertEqual(self._restore(backup_data["filename"]), source.read())
+
+    def test_restore_path(self):
+        from bakthat.backends import S3DownloadReader
+
+        self._mock_s3()
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        os.mkdir(os.path.join(dirname, "sub"))
+        # Frames are indexed every 16MB
+        files = {"big": os.urandom(17 * 1024 * 1024), "small": "bakthat", "sub/other": os.urandom(1000)}
+        for name, data in files.items():
+            with open(os.path.join(dirname, name), "wb") as f:
+                f.write(data)
+        arcname = os.path.basename(dirname)
+        backup_data = bakthat.backup(dirname, "s3", profile=TEST_PROFILE, sync=False,
+                                     compression="gzip", password=self.password)
+        self.assertTrue(backup_data["metadata"]["seekable"])
+        threads = threading.active_count()
+        members = bakthat.ls_contents(backup_data["stored_filename"], "s3", profile=TEST_PROFILE)
+        self.assertEqual(sorted(member["path"] for member in members),
+                         sorted([arcname, arcname + "/sub"] + [arcname + "/" + name for name in files]))
+
+        # Only the frames holding the member are downloaded
+        fetch = S3DownloadReader._fetch
+
+        def counting_fetch(reader, start, end):
+            downloaded.append(end - start + 1)
+            return fetch(reader, start, end)
+
+        S3DownloadReader._fetch = counting_fetch
+        try:
+            for name in ["small", "sub/other"]:
+                path = arcname + "/" + name
+                downloaded = []
+                self.assertEqual(self._restore(backup_data["filename"], path, path=path, password=self.password),
+                                 files[name])
+                self.assertTrue(0 < sum(downloaded) < backup_data["size"])
+        finally:
+            S3DownloadReader._fetch = fetch
+
+        # The decryption runs in the backend worker pool, restores don't leave threads behind
+        self.assertEqual(self._restore(backup_data["filename"], arcname + "/small", password=self.password),
+                         files["small"])
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_resume_upload(self):
+        from bakthat.backends import S3UploadWriter
+        from bakthat.models import Uploads
+
+        bucket = self._mock_s3(s3_part_size=5 * 1024 * 1024).bucket
+        source = self._random_file(12 * 1024 * 1024)
+        self._interrupted_backup(source.name, password="")
+        interrupted = bucket.get_all_multipart_uploads()
+        self.assertEqual(len(interrupted), 1)
+        self.assertEqual(len(list(interrupted[0].get_all_parts())), 2)
+
+        # The same backup sends the last part only
+        sent = []
+        send_part = S3UploadWriter._send_part
+
+        def counting_send_part(writer, part_num, data, md5):
+            sent.append(part_num)
+            return send_part(writer, part_num, data, md5)
+
+        S3UploadWriter._send_part = counting_send_part
+        try:
+            backup_data = bakthat.backup(source.name, "s3", profile=TEST_PROFILE, sync=False,
+                                         compression="gzip:0", password="")
+        finally:
+            S3UploadWriter._send_part = send_part
+        self.assertEqual(sent, [3])
+        self.assertEqual(backup_data["stored_filename"], interrupted[0].key_name)
+        self.assertEqual(bucket.get_all_multipart_uploads(), [])
+        self.assertEqual(Uploads.select().where(Uploads.upload_id == interrupted[0].id).count(), 0)
+
+        self.assertEqual(self._restore(backup_data["filename"]), source.read())
+
+    def test_resume_encrypted_upload(self):
+        from bakthat.backends import S3UploadWriter
+        from bakthat.models import Uploads
+
+        bucket = self._mock_s3(s3_part_size=5 * 1024 * 1024).bucket
+        source = self._random_file(12 * 1024 * 1024)
+        self._interrupted_backup(source.name, password=self.password)
+        interrupted = bucket.get_all_multipart_uploads()
+        self.assertEqual(len(interrupted), 1)
+
+        # Encrypted with the same salt, the uploaded parts are skipped
+        sent = []
+        send_part = S3UploadWriter._send_part
+
+        def counting_send_part(writer, part_num, data, md5):
+            sent.append(part_num)
+            return send_part(writer, part_num, data, md5)
+
+        S3UploadWriter._send_part = counting_send_part
+        try:
+            backup_data = bakthat.backup(source.name, "s3", profile=TEST_PROFILE, sync=False,
+                                         compression="gzip:0", password=self.password)
+        finally:
+            S3UploadWriter._send_part = send_part
+        self.assertEqual(sent, [3])
+        self.assertEqual(backup_data["stored_filename"], interrupted[0].key_name)
+        self.assertEqual(self._restore(backup_data["filename"], password=self.password), source.read())
+
+        # A changed part isn't encrypted again with the same salt, the upload is aborted
+        self._interrupted_backup(source.name, password=self.password)
+        interrupted = [mp.id for mp in bucket.get_all_multipart_uploads()]
+        self.assertEqual(len(interrupted), 1)
+        source.seek(0)
+        source.write(os.urandom(1024))
+        source.flush()
+        with self.assertRaises(Exception):
+            bakthat.backup(source.name, "s3", profile=TEST_PROFILE, sync=False,
+                           compression="gzip:0", password=self.password)
+        self.assertEqual(bucket.get_all_multipart_uploads(), [])
+        self.assertEqual(Uploads.select().where(Uploads.upload_id << interrupted).count(), 0)
+
+        # The next backup starts over with a new salt
+        backup_data = bakthat.backup(source.name, "s3", profile=TEST_PROFILE, sync=False,
+                                     compression="gzip:0", password=self.password)
+        source.seek(0)
+        self.assertEqual(self._restore(backup_data["filename"], password=self.password), source.read())
+
+    def test_s3_ls(self):
+        from bakthat import backends
+
+        backend = self._mock_s3()
+        names = ["a/{0}".format(i) for i in range(7)] + ["b/{0}".format(i) for i in range(4)] + ["c"]
+        for name in names:
+            backend.bucket.new_key(name).set_contents_from_string(name)
+
+        # 3 keys per page, the prefixes are filtered by S3
+        pages = []
+        list_page = backend._list_page
+
+        def counting_list_page(listing):
+            pages.append(listing)
+            return list_page(listing)
+
+        list_page_size = backends.LIST_PAGE_SIZE
+        backends.LIST_PAGE_SIZE = 3
+        backend._list_page = counting_list_page
+        try:
+            self.assertEqual(bakthat.ls("a/", "s3", profile=TEST_PROFILE), names[:7])
+            self.assertEqual(pages, [("a/", ""), ("a/", "a/2"), ("a/", "a/5")])
+            self.assertEqual(sorted(bakthat.ls(["b/", "a/", "a/1"], "s3", profile=TEST_PROFILE)), names[:11])
+            self.assertEqual(bakthat.ls("", "s3", profile=TEST_PROFILE), names)
+        finally:
+            backends.LIST_PAGE_SIZE = list_page_size
+            del backend._list_page
+
+    def test_checksums(self):
+        from bakthat.models import Backups
+
+        backend = self._mock_s3()
+        backup_data = bakthat.backup(self.test_file.name, "s3", profile=TEST_PROFILE, sync=False,
+                                     password=self.password)
+        stored_filename = backup_data["stored_filename"]
+
+        # Computed as the backup is uploaded, from the stored (encrypted) data
+        key = backend.bucket.get_key(stored_filename)
+        checksums = backup_data["metadata"]["checksums"]
+        self.assertEqual(checksums["sha256"], hashlib.sha256(key.get_contents_as_string()).hexdigest())
+        self.assertEqual(checksums["etag"], key.etag.strip('"'))
+
+        self.assertEqual(self._restore(self.test_filename, password=self.password), "Bakthat Test File")
+
+        # The restore checks the SHA-256
+        backup = Backups.get(Backups.stored_filename == stored_filename)
+        metadata = backup.metadata
+        metadata["checksums"]["sha256"] = hashlib.sha256("bakthat").hexdigest()
+        backup.metadata = metadata
+        backup.save()
+        with self.assertRaises(Exception) as context:
+            self._restore(self.test_filename, password=self.password)
+        self.assertTrue("Checksum mismatch" in str(context.exception))
+
+    def test_bulk_delete(self):
+        from bakthat import backends
+        from bakthat.models import Backups
+
+        backend = self._mock_s3()
+        stored_filenames = [bakthat.backup(self.test_file.name, "s3", profile=TEST_PROFILE, sync=False,
+                                           password="")["stored_filename"] for i in range(5)]
+        old, recent = stored_filenames[:3], stored_filenames[3:]
+        Backups.update(backup_date=int(time.time()) - 86400 * 2).where(Backups.stored_filename << old).execute()
+
+        # Deleted with multi-object delete requests, 2 keys per request
+        requests = []
+        delete_keys = backend.bucket.__class__.delete_keys
+
+        def counting_delete_keys(bucket, keys, *args, **kwargs):
+            requests.append(list(keys))
+            return delete_keys(bucket, keys, *args, **kwargs)
+
+        max_delete_keys = backends.MAX_DELETE_KEYS
+        backends.MAX_DELETE_KEYS = 2
+        backend.bucket.__class__.delete_keys = counting_delete_keys
+        try:
+            deleted = bakthat.delete_older_than(self.test_filename, "1D", "s3", profile=TEST_PROFILE)
+        finally:
+            backends.MAX_DELETE_KEYS = max_delete_keys
+            backend.bucket.__class__.delete_keys = delete_keys
+
+        self.assertEqual(sorted(deleted), sorted(old))
+        self.assertEqual(sorted(sum(requests, [])), sorted(old))
+        self.assertEqual(len(requests), 2)
+        for stored_filename in stored_filenames:
+            self.assertEqual(backend.bucket.get_key(stored_filename) is None, stored_filename in old)
+        query = Backups.select().where(Backups.stored_filename << stored_filenames, Backups.is_deleted == True)
+        self.assertEqual(sorted(backup.stored_filename for backup in query), sorted(old))
+
+    def test_rotate_all(self):
+        from bakthat.models import Backups
+
+        backend = self._mock_s3(rotation=dict(days=3, weeks=0, months=0, first_week_day=5))
+        other_file = tempfile.NamedTemporaryFile()
+        other_file.write("Bakthat Other File")
+        other_file.flush()
+
+        now = int(time.time())
+        ages = [(self.test_file.name, 3600), (self.test_file.name, 86400 * 5), (self.test_file.name, 86400 * 40),
+                (other_file.name, 3600), (other_file.name, 86400 * 10)]
+        stored_filenames = []
+        for filename, age in ages:
+            stored_filename = bakthat.backup(filename, "s3", profile=TEST_PROFILE, sync=False,
+                                             password="")["stored_filename"]
+            Backups.update(backup_date=now - age).where(Backups.stored_filename == stored_filename).execute()
+            stored_filenames.append(stored_filename)
+
+        # Each filename keeps its backups of the last 3 days
+        expected = sorted(stored_filenames[1:3] + stored_filenames[4:])
+        self.assertEqual(sorted(bakthat.rotate_all("s3", profile=TEST_PROFILE, dry_run=True)), expected)
+        self.assertEqual(len(backend.bucket.get_all_keys()), 5)
+
+        self.assertEqual(sorted(bakthat.rotate_all("s3", profile=TEST_PROFILE)), expected)
+        self.assertEqual(sorted(key.name for key in backend.bucket.get_all_keys()),
+                         sorted(set(stored_filenames) - set(expected)))
+
+    def test_dedup_collect_chunks(self):
+        from bakthat.conf import config
+        from bakthat.dedup import CHUNKS_PREFIX
+        from bakthat.models import Backups
+
+        backend = self._mock_s3()
+        source = self._random_file(300000)
+
+        def chunks():
+            return [key.name for key in backend.bucket.list(prefix=CHUNKS_PREFIX)]
+
+        def backup_and_delete(filename, **kwargs):
+            stored_filename = bakthat.backup(filename, "s3", profile=TEST_PROFILE, sync=False,
+                                             password="", **kwargs)["stored_filename"]
+            Backups.update(backup_date=int(time.time()) - 86400 * 2).where(
+                Backups.stored_filename == stored_filename).execute()
+            self.assertEqual(bakthat.delete_older_than(os.path.basename(filename), "1D", "s3", profile=TEST_PROFILE),
+                             [stored_filename])
+
+        # Unused chunks are kept unless dedup_gc is set
+        backup_and_delete(source.name, dedup=True)
+        self.assertTrue(chunks())
+
+        config[TEST_PROFILE]["dedup_gc"] = True
+        collected = []
+        collect_chunks = bakthat.collect_chunks
+        bakthat.collect_chunks = lambda storage_backend: collected.append(collect_chunks(storage_backend))
+        try:
+            # Chunks are only collected when dedup backups are deleted
+            backup_and_delete(self.test_file.name)
+            self.assertEqual(collected, [])
+            backup_and_delete(source.name, dedup=True)
+        finally:
+            bakthat.collect_chunks = collect_chunks
+        self.assertEqual(len(collected), 1)
+        self.assertEqual(chunks(), [])
+
+    def test_rotation_not_configured(self):
+        self._mock_s3()
+        with self.assertRaises(Exception):
+            bakthat.rotate_backups(self.test_file.name, "s3", profile=TEST_PROFILE)
+        with self.assertRaises(Exception):
+            bakthat.rotate_all("s3", profile=TEST_PROFILE)
+
+    def test_cache_upload(self):
+        from bakthat.cache import CacheWriter, wait_uploaders
+        from bakthat.models import Backups
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        backend = self._mock_s3(cache=dict(path=cache_dir))
+
+        # An uploader draining the cache while the backup is written
+        # doesn't find it before its catalog entry exists
+        drained = []
+        close = CacheWriter.close
+
+        def close_and_drain(writer):
+            close(writer)
+            drained.extend(backend.cache.drain(backend))
+
+        CacheWriter.close = close_and_drain
+        try:
+            backup_data = bakthat.backup(self.test_file.name, "s3", profile=TEST_PROFILE, sync=False, password="")
+        finally:
+            CacheWriter.close = close
+        self.assertEqual(drained, [])
+
+        wait_uploaders()
+        backup = Backups.get(Backups.stored_filename == backup_data["stored_filename"])
+        self.assertFalse(backup.metadata.get("pending_upload"))
+        self.assertTrue(backup.metadata["checksums"].get("etag"))
+        self.assertEqual(backend.bucket.get_key(backup.stored_filename).size, backup.size)
+
+    def test_verify(self):
+        backend = self._mock_s3()
+        ok, missing, truncated, corrupt = [bakthat.backup(self.test_file.name, "s3", profile=TEST_PROFILE, sync=False,
+                                                          password="")["stored_filename"] for i in range(4)]
+        backend.bucket.delete_key(missing)
+        key = backend.bucket.get_key(truncated)
+        key.set_contents_from_string(key.get_contents_as_string()[:-1])
+        key = backend.bucket.get_key(corrupt)
+        key.set_contents_from_string("\0" * key.size)
+
+        output = tempfile.NamedTemporaryFile()
+        report = bakthat.verify(self.test_filename, "s3", profile=TEST_PROFILE, output=output.name, workers=1)
+        statuses = dict((item["stored_filename"], item["status"]) for item in report)
+        self.assertEqual(statuses, {ok: "ok", missing: "missing", truncated: "truncated", corrupt: "corrupt"})
+        self.assertEqual(json.load(output), report)
+
+        statuses = dict((item["stored_filename"], item["status"])
+                        for item in bakthat.verify(self.test_filename, "s3", profile=TEST_PROFILE,
+                                                   deep=True, workers=1))
+        self.assertEqual(statuses[ok], "ok")
+
+    def test_verify_deep_cache(self):
+        from bakthat.cache import wait_uploaders
+        from bakthat.models import Backups
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        backend = self._mock_s3(cache=dict(path=cache_dir))
+        backup_data = bakthat.backup(self.test_file.name, "s3", profile=TEST_PROFILE, sync=False, password="")
+        wait_uploaders()
+        stored_filename = backup_data["stored_filename"]
+        self.assertTrue(backend.cache.contains(backend, stored_filename))
+
+        def check():
+            return bakthat.verify(stored_filename, "s3", profile=TEST_PROFILE, deep=True)[0]["status"]
+
+        self.assertEqual(check(), "ok")
+
+        # The stored object is corrupted (same size, without the ETag in the catalog
+        # only the SHA-256 can tell), the cached copy is still fine
+        key = backend.bucket.get_key(stored_filename)
+        key.set_contents_from_string("\0" * key.size)
+        backup = Backups.get(Backups.stored_filename == stored_filename)
+        metadata = backup.metadata
+        del metadata["checksums"]["etag"]
+        backup.metadata = metadata
+        backup.save()
+        self.assertEqual(check(), "corrupt")
+
+    def test_worker_pool(self):
+        from bakthat import backends
+
+        backend = self._mock_s3(s3_download_chunk_size=1024 * 1024)
+        data = os.urandom(3 * 1024 * 1024 + 100)
+        backend.bucket.new_key("worker-pool").set_contents_from_string(data)
+
+        connections = []
+        connect_s3 = backends.boto.connect_s3
+
+        def counting_connect_s3(*args, **kwargs):
+            connections.append(args)
+            return connect_s3(*args, **kwargs)
+
+        backends.boto.connect_s3 = counting_connect_s3
+        try:
+            # The threads of the worker pool keep their connection from a download to the next
+            for i in range(3):
+                download = backend.open_download("worker-pool")
+                self.assertTrue(download.pool is backend.worker_pool())
+                self.assertEqual(download.read(), data)
+                download.close()
+        finally:
+            backends.boto.connect_s3 = connect_s3
+        self.assertTrue(len(connections) <= 1)
+
+    def test_incremental_manifest(self):
+        from StringIO import StringIO
+        from bakthat.incremental import add_changed
+
+        dirname = tempfile.mkdtemp()
+        for name in ["a", "b"]:
+            with open(os.path.join(dirname, name), "w") as f:
+                f.write(name)
+
+        tar = tarfile.open(fileobj=StringIO(), mode="w|")
+        manifest, changed = add_changed(tar, dirname, "test", {})
+        self.assertEqual(changed, 2)
+        self.assertEqual(sorted(manifest), ["test", "test/a", "test/b"])
+
+        with open(os.path.join(dirname, "b"), "w") as f:
+            f.write("bakthat")
+        manifest, changed = add_changed(tar, dirname, "test", manifest)
+        self.assertEqual(changed, 1)
+
+        shutil.rmtree(dirname)
+
     def test_keyvalue_helper(self):
         from bakthat.helper import KeyValue
         kv = KeyValue()